@@ -0,0 +1,83 @@
+from sqlalchemy import and_, extract
+from sqlalchemy.sql.expression import func, select
+from app import db
+from models import Transaction, ParameterException
+
+def month_label(month):
+    """Convert a month number, year * 12 + (month - 1), into 'YYYY-MM'."""
+    return '%04d-%02d' % (month // 12, month % 12 + 1)
+
+def monthly_totals(user, begin_date=None, end_date=None,
+                   action=Transaction.WITHDRAWAL):
+    """Sum the amounts (cents) of each account by month for one action,
+    with a GROUP BY in the database.
+
+    Returns:
+    (months, totals) with totals as account ID to a list of monthly sums
+
+    """
+    t = Transaction.__table__
+    criteria = [t.c.user_id == user.id, t.c.active == True]
+    if begin_date is not None:
+        criteria.append(t.c.date >= begin_date)
+    if end_date is not None:
+        criteria.append(t.c.date <= end_date)
+    first, last = db.session.execute(
+        select([func.min(t.c.date), func.max(t.c.date)],
+               and_(*criteria))).fetchone()
+    if first is None:
+        return [], {}
+    first = first.year * 12 + first.month - 1
+    months = range(first, last.year * 12 + last.month)
+    month = extract('year', t.c.date) * 12 + extract('month', t.c.date) - 1
+    query = select([t.c.account_id, month, func.sum(t.c.amount)],
+                   and_(t.c.action == action, t.c.account_id != None,
+                        *criteria)).group_by(t.c.account_id, month)
+    totals = {}
+    for account, number, amount in db.session.execute(query):
+        if account not in totals:
+            totals[account] = [0] * len(months)
+        totals[account][int(number) - first] = amount or 0
+    return months, totals
+
+def rolling_average(values, window=3):
+    """Trailing average over a window, shorter at the start of the list."""
+    if window < 1:
+        raise ParameterException('Window must be at least 1')
+    averages = []
+    running = 0
+    for index, value in enumerate(values):
+        running += value
+        if index >= window:
+            running -= values[index - window]
+        averages.append(float(running) / min(index + 1, window))
+    return averages
+
+def percentile(values, pct):
+    """Linearly interpolated percentile (0-100) of a list of numbers."""
+    if not values:
+        return None
+    if pct < 0 or pct > 100:
+        raise ParameterException('Percentile must be in the range 0-100')
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * \
+           (position - lower)
+
+def spending_summary(user, begin_date=None, end_date=None, window=3):
+    """Monthly spending of each account with its trends.
+
+    Returns:
+    (months, summary) where summary is a list of (Account, spent,
+    rolling, median, 90th percentile) tuples in cents
+
+    """
+    months, totals = monthly_totals(user, begin_date, end_date)
+    summary = []
+    for account in user.accounts:
+        spent = totals.get(account.id, [0] * len(months))
+        summary.append((account, spent, rolling_average(spent, window),
+                        percentile(spent, 50), percentile(spent, 90)))
+    return [month_label(m) for m in months], summary
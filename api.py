@@ -0,0 +1,662 @@
+import datetime
+import hashlib
+import json
+from flask import Response, abort, jsonify, request, stream_with_context
+from sqlalchemy import and_, or_, desc, func
+from sqlalchemy.sql.expression import case, select
+from app import app, db
+from models import (Account, Batch, BudseException, Deduction, Deposit,
+                    DuplicateException, Group, GroupMember,
+                    ParameterException, SubDeposit, Transaction, Transfer,
+                    User, Withdrawal, _format_out_amount)
+import balances
+import membership
+from cli import tracing
+
+# Transactions on a page when the client does not ask for a size
+default_page_size = 50
+max_page_size = 500
+# Most transactions accepted by one batch request
+max_batch_size = 1000
+
+class Split(object):
+    """Sub-deposit given with a deposit request.
+
+    It has the attributes that Deposit reads from a SubDeposit, but is
+    not mapped, so splitting one deposit does not save the split for
+    the user.
+
+    """
+    def __init__(self, account, amount, percentage_or_fixed=None,
+                 affect_gross=False):
+        self.account = account
+        self.amount = amount
+        self.percentage_or_fixed = (percentage_or_fixed
+                                    if percentage_or_fixed is not None
+                                    else SubDeposit.PERCENTAGE)
+        self.affect_gross = affect_gross
+
+def _error(status, message, **extra):
+    """JSON error response."""
+    response = jsonify(error=message, **extra)
+    response.status_code = status
+    return response
+
+@app.errorhandler(ParameterException)
+def _invalid(e):
+    return _error(400, str(e))
+
+def _body():
+    """JSON object posted with the request."""
+    body = request.json
+    if not isinstance(body, dict):
+        raise ParameterException('Expected a JSON object')
+    return body
+
+def _amount(body, name='amount'):
+    """Positive amount from a request body."""
+    try:
+        amount = float(body[name])
+    except (KeyError, TypeError, ValueError):
+        raise ParameterException('%s is not a number' % name)
+    if amount <= 0:
+        raise ParameterException('%s must be positive' % name)
+    return amount
+
+def _date(body, name='date'):
+    """Date from a request body, today when it is left out."""
+    value = body.get(name)
+    if value is None:
+        return datetime.date.today()
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ParameterException('%s is not a YYYY-MM-DD date' % name)
+
+def _account(user, account_id, accounts=None):
+    """One of the accounts the user can use, by ID.
+
+    Keyword arguments:
+    user -- User using the account
+    account_id -- ID of the account
+    accounts -- Dictionary of the user's accounts by ID, to look the
+        account up in instead of querying (default None)
+
+    """
+    if account_id is None:
+        raise ParameterException('An account is required')
+    if accounts is not None:
+        account = accounts.get(account_id)
+    else:
+        account = Account.query.filter(Account.id == account_id).\
+                  filter(membership.accounts_clause(user.id)).first()
+    if account is None:
+        raise ParameterException('Unknown account %s' % account_id)
+    return account
+
+def _account_dict(id, name, active, balance):
+    return {'id': id, 'name': name, 'active': active,
+            'balance': _format_out_amount(balance)}
+
+def _transaction_dict(t, children=True):
+    values = {'id': t.id,
+              'date': t.date.isoformat(),
+              'action': t.action,
+              'amount': _format_out_amount(t._amount),
+              'account_id': t._account,
+              'description': t.description,
+              'parent_id': t._parent,
+              'active': bool(t._active)}
+    if children:
+        values['children'] = [_transaction_dict(c, False)
+                              for c in t.children]
+    return values
+
+def _save(transaction):
+    """Activate and commit a new transaction, returning the response."""
+    transaction.commit()
+    db.session.add(transaction)
+    db.session.commit()
+    with tracing.span('render'):
+        response = jsonify(transaction=_transaction_dict(transaction))
+    response.status_code = 201
+    return response
+
+def _create(build):
+    """Create a transaction, turning the library's errors into responses.
+
+    Keyword arguments:
+    build -- Function that constructs the new Transaction
+
+    """
+    try:
+        return _save(build())
+    except DuplicateException, e:
+        db.session.rollback()
+        return _error(409, str(e), duplicates=[_transaction_dict(t, False)
+                                               for t in e.duplicates])
+    except BudseException, e:
+        db.session.rollback()
+        return _error(400, str(e))
+
+def _etag(*values):
+    return hashlib.md5(repr(values)).hexdigest()
+
+def _not_modified(etag):
+    """304 response when the client already has the current version."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+@app.route('/api/users/<int:user_id>/accounts')
+def api_accounts(user_id):
+    """The user's accounts with their balances."""
+    user = User.query.get_or_404(user_id)
+    accounts, total = balances.balances(user)
+    return jsonify(accounts=[_account_dict(*a) for a in accounts])
+
+@app.route('/api/users/<int:user_id>/balances')
+def api_balances(user_id):
+    """Balance of each account and their total, with an ETag."""
+    user = User.query.get_or_404(user_id)
+    accounts, total = balances.balances(
+        user, active_only=request.args.get('active', 0, type=int) == 1)
+    etag = _etag(accounts, total)
+    response = _not_modified(etag)
+    if response is None:
+        response = jsonify(accounts=[_account_dict(*a) for a in accounts],
+                           total=_format_out_amount(total))
+        response.set_etag(etag)
+    return response
+
+@app.route('/api/users/<int:user_id>/transactions')
+def api_transactions(user_id):
+    """A page of the user's transactions, newest first.
+
+    Pages are found by keyset rather than offset: the "next" value of
+    a page is passed back as the "after" argument for the page after
+    it.  The ETag changes whenever a transaction of the user is added
+    or reversed, and the page is streamed out as it is serialized.
+
+    """
+    user = User.query.get_or_404(user_id)
+    limit = request.args.get('limit', default_page_size, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, max_page_size)
+    account_id = request.args.get('account', type=int)
+    after = request.args.get('after')
+
+    t = Transaction.__table__
+    version = db.session.execute(select(
+        [func.count(t.c.id), func.max(t.c.id),
+         func.sum(case([(t.c.active == True, t.c.id)], else_=0))],
+        membership.transactions_clause(user.id))).first()
+    etag = _etag(tuple(version), limit, account_id, after)
+    response = _not_modified(etag)
+    if response is not None:
+        return response
+
+    query = Transaction.query.filter(
+        membership.transactions_clause(user.id))
+    if account_id is not None:
+        query = query.filter(Transaction._account == account_id)
+    else:
+        query = query.filter(Transaction._parent == None)
+    if after is not None:
+        try:
+            date, id = after.split(':')
+            date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            id = int(id)
+        except ValueError:
+            abort(400)
+        query = query.filter(or_(Transaction.date < date,
+                                 and_(Transaction.date == date,
+                                      Transaction.id < id)))
+    # One extra tells whether there is a page after this one
+    page = query.order_by(desc(Transaction.date), desc(Transaction.id)).\
+           limit(limit + 1).all()
+
+    def generate():
+        yield '{"transactions": ['
+        for index, transaction in enumerate(page[:limit]):
+            if index:
+                yield ', '
+            yield json.dumps(_transaction_dict(transaction,
+                                               account_id is None))
+        next = None
+        if len(page) > limit:
+            last = page[limit - 1]
+            next = '%s:%d' % (last.date.isoformat(), last.id)
+        yield '], "next": %s}' % json.dumps(next)
+
+    response = Response(stream_with_context(generate()),
+                        mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+def _deposit(user, body, accounts=None):
+    """Check a deposit request and return a function that makes it.
+
+    Without an account_id the deposit is split by the sub_deposits of
+    the request ({"account_id", "amount", "percentage_or_fixed",
+    "affect_gross"}), or by the user's active sub-deposits of a
+    "group" when none are given.
+
+    Keyword arguments:
+    user -- User depositing
+    body -- Dictionary of the request
+    accounts -- Dictionary of the user's accounts by ID (default None)
+
+    Returns:
+    Function taking duplicate_override that creates the Deposit
+
+    """
+    amount = _amount(body)
+    date = _date(body)
+    account = splits = None
+    if body.get('account_id') is not None:
+        account = _account(user, body['account_id'], accounts)
+    elif body.get('sub_deposits'):
+        splits = []
+        for split in body['sub_deposits']:
+            if not isinstance(split, dict) or split.get(
+                    'percentage_or_fixed', SubDeposit.PERCENTAGE) not in \
+                    (SubDeposit.PERCENTAGE, SubDeposit.FIXED):
+                raise ParameterException('Invalid sub-deposit')
+            splits.append(Split(_account(user, split.get('account_id'),
+                                         accounts),
+                                _amount(split),
+                                split.get('percentage_or_fixed'),
+                                bool(split.get('affect_gross'))))
+    else:
+        splits = [sd for sd in user.sub_deposits
+                  if sd.active and sd.group == body.get('group')]
+    deductions = body.get('deductions') or []
+    if not isinstance(deductions, list) or \
+           [d for d in deductions if not isinstance(d, dict)]:
+        raise ParameterException('Invalid deductions')
+    deductions = [(_amount(d), d.get('description')) for d in deductions]
+
+    def build(duplicate_override):
+        return Deposit(user=user, amount=amount, date=date, account=account,
+                       sub_deposits=splits,
+                       description=body.get('description'),
+                       deductions=[Deduction(user=user, amount=a, date=date,
+                                             description=description)
+                                   for a, description in deductions] or None,
+                       duplicate_override=duplicate_override)
+    return build
+
+def _withdrawal(user, body, accounts=None):
+    """Check a withdrawal request and return a function that makes it."""
+    amount = _amount(body)
+    date = _date(body)
+    account = _account(user, body.get('account_id'), accounts)
+    return lambda duplicate_override: Withdrawal(
+        user=user, amount=amount, date=date,
+        description=body.get('description'), account=account,
+        duplicate_override=duplicate_override)
+
+def _transfer(user, body, accounts=None):
+    """Check a transfer request and return a function that makes it."""
+    amount = _amount(body)
+    date = _date(body)
+    from_account = _account(user, body.get('from_account_id'), accounts)
+    to_account = _account(user, body.get('to_account_id'), accounts)
+    if from_account is to_account:
+        raise ParameterException('Cannot transfer to the same account')
+    return lambda duplicate_override: Transfer(
+        user=user, amount=amount, date=date, to_account=to_account,
+        from_account=from_account, description=body.get('description'),
+        duplicate_override=duplicate_override)
+
+# Request parser of each type of transaction in a batch
+_parsers = {'deposit': _deposit, 'withdrawal': _withdrawal,
+            'transfer': _transfer}
+
+@app.route('/api/users/<int:user_id>/deposits', methods=['POST'])
+def api_deposit(user_id):
+    """Deposit into one account, or split it over several (see _deposit)."""
+    user = User.query.get_or_404(user_id)
+    body = _body()
+    build = _deposit(user, body)
+    return _create(lambda: build(bool(body.get('duplicate_override'))))
+
+@app.route('/api/users/<int:user_id>/withdrawals', methods=['POST'])
+def api_withdrawal(user_id):
+    """Withdraw from one of the user's accounts."""
+    user = User.query.get_or_404(user_id)
+    body = _body()
+    build = _withdrawal(user, body)
+    return _create(lambda: build(bool(body.get('duplicate_override'))))
+
+@app.route('/api/users/<int:user_id>/transfers', methods=['POST'])
+def api_transfer(user_id):
+    """Move an amount from one of the user's accounts to another."""
+    user = User.query.get_or_404(user_id)
+    body = _body()
+    build = _transfer(user, body)
+    return _create(lambda: build(bool(body.get('duplicate_override'))))
+
+def _duplicate_keys(transaction):
+    """(date, account ID, amount) of each part of a new transaction that
+    is checked for duplicates."""
+    return [(t.date, t.account.id, t._amount)
+            for t in [transaction] + list(transaction.children)
+            if t.account is not None and
+            t.action in (Transaction.DEPOSIT, Transaction.WITHDRAWAL)]
+
+def _find_duplicates(account_ids, transactions):
+    """Check a batch of new transactions for duplicates in one query.
+
+    A transaction is a possible duplicate when one of its deposits or
+    withdrawals has the date, account and amount of an active one that
+    is already saved, or of one earlier in the batch.  The saved ones
+    may have been entered by anyone who can use the account (e.g., the
+    other members of a group it is shared with).
+
+    Keyword arguments:
+    account_ids -- IDs of the accounts the user can use
+    transactions -- List of (index, Transaction) to check
+
+    Returns:
+    Dictionary of index to the list of saved duplicates (empty for a
+    duplicate within the batch)
+
+    """
+    keys = {}
+    for index, transaction in transactions:
+        keys[index] = _duplicate_keys(transaction)
+    usable = set(account_ids)
+    wanted = set()
+    for index_keys in keys.values():
+        wanted.update([key for key in index_keys if key[1] in usable])
+    saved = {}
+    if wanted:
+        dates, accounts, amounts = [set(values) for values in zip(*wanted)]
+        # The batch itself must not be flushed by the query
+        with db.session.no_autoflush:
+            for t in Transaction.query.\
+                    filter(Transaction._active == True).\
+                    filter(Transaction.action.in_([Transaction.DEPOSIT,
+                                                   Transaction.WITHDRAWAL])).\
+                    filter(Transaction.date.in_(dates)).\
+                    filter(Transaction._account.in_(accounts)).\
+                    filter(Transaction._amount.in_(amounts)):
+                saved.setdefault((t.date, t._account, t._amount), []).\
+                        append(t)
+    duplicates = {}
+    seen = set()
+    for index, transaction in transactions:
+        found = None
+        for key in keys[index]:
+            if key in saved:
+                found = (found or []) + saved[key]
+            elif key in seen:
+                found = found or []
+        if found is not None:
+            duplicates[index] = found
+        seen.update(keys[index])
+    return duplicates
+
+@app.route('/api/users/<int:user_id>/transactions/batch', methods=['POST'])
+def api_batch(user_id):
+    """Create a batch of deposits, withdrawals and transfers at once.
+
+    The request is {"transactions": [...]} where each item is the body
+    of a single deposit, withdrawal or transfer request plus its
+    "type", and optionally the "description" of the batch.  Every item
+    is checked first and the duplicates of the whole batch are found
+    with one query; the batch is only saved, in a single commit, when
+    every item is valid.  The response lists the result of each item
+    in order.
+
+    """
+    user = User.query.get_or_404(user_id)
+    body = _body()
+    items = body.get('transactions')
+    if not isinstance(items, list) or not items:
+        raise ParameterException('Expected a list of transactions')
+    description = body.get('description')
+    if description is not None and not isinstance(description, basestring):
+        raise ParameterException('Expected a description string')
+    if len(items) > max_batch_size:
+        raise ParameterException('At most %d transactions per batch' %
+                                 max_batch_size)
+    accounts = dict([(a.id, a) for a in Account.query.filter(
+        membership.accounts_clause(user.id))])
+    results = [None] * len(items)
+    builders = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict) or item.get('type') not in _parsers:
+                raise ParameterException('Unknown transaction type')
+            builders.append((index, _parsers[item['type']](user, item,
+                                                           accounts)))
+        except ParameterException, e:
+            results[index] = {'status': 400, 'error': str(e)}
+
+    status = 201
+    if len(builders) < len(items):
+        status = 400
+    else:
+        created = []
+        with db.session.no_autoflush:
+            for index, build in builders:
+                try:
+                    created.append((index, build(True)))
+                except BudseException, e:
+                    results[index] = {'status': 400, 'error': str(e)}
+                    status = 400
+        if status == 201:
+            duplicates = _find_duplicates(accounts.keys(),
+                                          [(index, t) for index, t in created
+                                           if not items[index].get(
+                                               'duplicate_override')])
+            for index, found in duplicates.items():
+                results[index] = {'status': 409,
+                                  'error': 'Possible duplicate found',
+                                  'duplicates': [_transaction_dict(t, False)
+                                                 for t in found]}
+                status = 409
+        if status == 201:
+            batch = Batch(user, description)
+            for index, transaction in created:
+                transaction.commit()
+                db.session.add(transaction)
+            for obj in db.session.new:
+                if isinstance(obj, Transaction):
+                    obj.batch = batch
+            db.session.commit()
+            for index, transaction in created:
+                results[index] = {'status': 201, 'transaction':
+                                  _transaction_dict(transaction)}
+    if status != 201:
+        # Nothing is saved unless everything is
+        db.session.rollback()
+        for index in range(len(items)):
+            if results[index] is None:
+                results[index] = {'status': 424,
+                                  'error': 'Not saved with the batch'}
+    if status == 201:
+        response = jsonify(results=results, batch=batch.id)
+    else:
+        response = jsonify(results=results)
+    response.status_code = status
+    return response
+
+@app.route('/api/users/<int:user_id>/batches')
+def api_batches(user_id):
+    """The batches of transactions the user made, newest first."""
+    User.query.get_or_404(user_id)
+    active = func.sum(case([(Transaction._active == True, 1)], else_=0))
+    rows = db.session.query(Batch, func.count(Transaction.id), active).\
+           join(Transaction, Transaction._batch == Batch.id).\
+           filter(membership.transactions_clause(user_id)).\
+           group_by(Batch.id).\
+           order_by(desc(Batch.id))
+    return jsonify(batches=[{'batch': batch.id,
+                             'timestamp': batch.timestamp.isoformat(),
+                             'description': batch.description,
+                             'transactions': count,
+                             'active': active_count or 0}
+                            for batch, count, active_count in rows])
+
+def _batch_criteria(user_id, batch):
+    t = Transaction.__table__
+    return and_(t.c.batch_id == batch, t.c.active == True,
+                membership.transactions_clause(user_id))
+
+def _batch_changes(criteria):
+    """Net change of each account's total, in cents, of the matching
+    transactions."""
+    t = Transaction.__table__
+    change = func.sum(case([(t.c.action == Transaction.DEPOSIT, t.c.amount),
+                            (t.c.action == Transaction.WITHDRAWAL,
+                             -t.c.amount)], else_=0))
+    return dict(db.session.execute(
+        select([t.c.account_id, change],
+               and_(criteria, t.c.account_id != None)).\
+        group_by(t.c.account_id)).fetchall())
+
+def _get_batch(user_id, batch):
+    """The batch, if the user can see any of its transactions."""
+    User.query.get_or_404(user_id)
+    made = Batch.query.get_or_404(batch)
+    if not db.session.query(Transaction.id).\
+           filter(Transaction._batch == batch).\
+           filter(membership.transactions_clause(user_id)).first():
+        abort(404)
+    return made
+
+@app.route('/api/users/<int:user_id>/batches/<int:batch>')
+def api_batch_changes(user_id, batch):
+    """What the active transactions of a batch did to each account."""
+    _get_batch(user_id, batch)
+    changes = _batch_changes(_batch_criteria(user_id, batch))
+    return jsonify(batch=batch, changes=[
+        {'account_id': account_id,
+         'change': _format_out_amount(change or 0)}
+        for account_id, change in sorted(changes.items())])
+
+@app.route('/api/users/<int:user_id>/batches/<int:batch>/rollback',
+           methods=['POST'])
+def api_batch_rollback(user_id, batch):
+    """Reverse every active transaction of a batch at once.
+
+    The statuses are flipped with one UPDATE and each account's total
+    changes by the net of its reversed transactions in one UPDATE.
+
+    """
+    made = _get_batch(user_id, batch)
+    criteria = _batch_criteria(user_id, batch)
+    changes = _batch_changes(criteria)
+    t = Transaction.__table__
+    count = db.session.execute(t.update().where(criteria).
+                               values(active=False)).rowcount
+    a = Account.__table__
+    for account_id, change in changes.items():
+        if change:
+            db.session.execute(a.update().where(a.c.id == account_id).
+                               values(total=a.c.total - change))
+    made.active = False
+    db.session.commit()
+    return jsonify(batch=batch, reversed=count)
+
+@app.route('/api/users/<int:user_id>/transactions/<int:transaction_id>/'
+           'reversal', methods=['POST'])
+def api_reversal(user_id, transaction_id):
+    """Reverse a transaction along with its sub-transactions."""
+    transaction = Transaction.query.\
+                  filter(Transaction.id == transaction_id).\
+                  filter(membership.transactions_clause(user_id)).\
+                  filter(Transaction._parent == None).first_or_404()
+    if not transaction.active:
+        return _error(409, 'Transaction is already reversed')
+    transaction.active = False
+    db.session.commit()
+    return jsonify(transaction=_transaction_dict(transaction))
+
+def _group(user, group_id, role=None):
+    """One of the user's groups, optionally one they own or can share in.
+    """
+    member = membership.memberships(user.id).get(group_id)
+    if member is None:
+        abort(404)
+    if role == 'owner' and not member[0] or \
+           role == 'share' and not member[1]:
+        return None
+    return Group.query.get_or_404(group_id)
+
+@app.route('/api/users/<int:user_id>/groups')
+def api_groups(user_id):
+    """The groups of the user and the accounts shared with each."""
+    user = User.query.get_or_404(user_id)
+    groups = membership.memberships(user.id)
+    if not groups:
+        return jsonify(groups=[])
+    accounts = {}
+    for account in Account.query.filter(Account._group.in_(groups.keys())).\
+            order_by(Account.id):
+        accounts.setdefault(account._group, []).append(account.id)
+    return jsonify(groups=[{'id': group.id, 'name': group.name,
+                            'is_owner': groups[group.id][0],
+                            'can_share': groups[group.id][1],
+                            'account_ids': accounts.get(group.id, [])}
+                           for group in Group.query.\
+                               filter(Group.id.in_(groups.keys())).\
+                               order_by(Group.id)])
+
+@app.route('/api/users/<int:user_id>/groups', methods=['POST'])
+def api_create_group(user_id):
+    """Create a group owned by the user."""
+    user = User.query.get_or_404(user_id)
+    name = _body().get('name')
+    if not name or not name.strip():
+        raise ParameterException('A group name is required')
+    group = Group(name.strip())
+    db.session.add(GroupMember(user, group))
+    db.session.commit()
+    membership.forget(user.id)
+    response = jsonify(group={'id': group.id, 'name': group.name})
+    response.status_code = 201
+    return response
+
+@app.route('/api/users/<int:user_id>/groups/<int:group_id>/members',
+           methods=['POST'])
+def api_add_member(user_id, group_id):
+    """Add a user to a group the user owns."""
+    user = User.query.get_or_404(user_id)
+    group = _group(user, group_id, 'owner')
+    if group is None:
+        return _error(403, 'Only an owner can add members')
+    body = _body()
+    member = User.query.get(body.get('user_id'))
+    if member is None:
+        raise ParameterException('Unknown user %s' % body.get('user_id'))
+    if group.id in membership.memberships(member.id):
+        return _error(409, 'Already a member')
+    db.session.add(GroupMember(member, group,
+                               bool(body.get('is_owner', False)),
+                               bool(body.get('can_share', True))))
+    db.session.commit()
+    membership.forget(member.id)
+    response = jsonify(member={'user_id': member.id, 'group_id': group.id})
+    response.status_code = 201
+    return response
+
+@app.route('/api/users/<int:user_id>/groups/<int:group_id>/accounts',
+           methods=['POST'])
+def api_share_account(user_id, group_id):
+    """Share one of the user's accounts with a group's members."""
+    user = User.query.get_or_404(user_id)
+    group = _group(user, group_id, 'share')
+    if group is None:
+        return _error(403, 'Not allowed to share with this group')
+    account = _account(user, _body().get('account_id'))
+    membership.share(user, account, group)
+    db.session.commit()
+    return jsonify(account={'id': account.id, 'group_id': group.id})
@@ -1,10 +1,121 @@
 import os
-from flask import Flask
+from flask import Flask, g, request
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+from cli import tracing
+
+def _env(name, default, type=int):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return type(value)
+
+def _flag(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL','postgresql://derek:@localhost/postgres')
-db = SQLAlchemy(app)
+# Each gunicorn worker has its own pool and a sync worker serves one
+# request at a time, so the connections used add up to about
+# workers * (pool size + overflow); keep that under the server's
+# max_connections (or the pgbouncer pool size).
+app.config['SQLALCHEMY_POOL_SIZE'] = _env('DATABASE_POOL_SIZE', 2)
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = _env('DATABASE_MAX_OVERFLOW', 2)
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = _env('DATABASE_POOL_TIMEOUT', 10)
+# Replace connections before the server or a proxy drops them as idle
+app.config['SQLALCHEMY_POOL_RECYCLE'] = _env('DATABASE_POOL_RECYCLE', 300)
+# Test each connection as it is checked out of the pool
+app.config['SQLALCHEMY_POOL_PRE_PING'] = _env('DATABASE_POOL_PRE_PING',
+                                              True, _flag)
+# Behind pgbouncer (transaction pooling) connections are pooled there,
+# so each one is closed as soon as the session is done with it
+app.config['SQLALCHEMY_PGBOUNCER'] = _env('DATABASE_PGBOUNCER', False, _flag)
+# Timing spans of each request and the operations within it, appended
+# to a JSON lines file and/or kept in memory (tracing.sinks)
+app.config['TRACE_FILE'] = os.environ.get('TRACE_FILE')
+app.config['TRACE_BUFFER'] = _env('TRACE_BUFFER', 0)
+tracing.configure(app.config['TRACE_FILE'], app.config['TRACE_BUFFER'])
+
+class _SQLAlchemy(SQLAlchemy):
+    """Adds the overflow and pgbouncer settings to the engine options."""
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite' or app.config['SQLALCHEMY_PGBOUNCER']:
+            # The pool settings are for a database server
+            for option in ('pool_size', 'pool_timeout', 'pool_recycle'):
+                options.pop(option, None)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername == 'sqlite':
+            return
+        if app.config['SQLALCHEMY_PGBOUNCER']:
+            options['poolclass'] = NullPool
+        else:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+db = _SQLAlchemy(app)
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    """Swap out a connection the server has closed before it is used."""
+    if not app.config['SQLALCHEMY_POOL_PRE_PING'] or \
+           app.config['SQLALCHEMY_PGBOUNCER']:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool retries the checkout with a new connection
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+# On the application's pool only, not every pool in the process (e.g.,
+# the snapshot tool's)
+event.listen(db.engine.pool, 'checkout', _ping)
+
+@app.before_request
+def _begin_request():
+    g.request_span = tracing.begin('request', method=request.method,
+                                   path=request.path)
+
+@app.teardown_request
+def _end_session(exception):
+    """Give the request's connection back to the pool, rolling back
+    anything a failed request left uncommitted."""
+    if exception is not None:
+        db.session.rollback()
+    db.session.remove()
+    tracing.finish(getattr(g, 'request_span', None),
+                   exception.__class__.__name__ if exception else None)
+
+# Flushes (the inserts and updates) and commits are timed as spans
+# between the session events around them
+def _begin_flush(session, flush_context, instances):
+    session._flush_span = tracing.begin('flush', new=len(session.new),
+                                        dirty=len(session.dirty))
+
+def _finish_flush(session, flush_context):
+    tracing.finish(getattr(session, '_flush_span', None))
+    session._flush_span = None
+
+def _begin_commit(session):
+    session._commit_span = tracing.begin('commit')
+
+def _finish_commit(session):
+    tracing.finish(getattr(session, '_commit_span', None))
+    session._commit_span = None
+
+def _abandon_spans(session):
+    for name in ('_flush_span', '_commit_span'):
+        tracing.finish(getattr(session, name, None), 'rollback')
+        setattr(session, name, None)
+
+if tracing.enabled():
+    event.listen(Session, 'before_flush', _begin_flush)
+    event.listen(Session, 'after_flush_postexec', _finish_flush)
+    event.listen(Session, 'before_commit', _begin_commit)
+    event.listen(Session, 'after_commit', _finish_commit)
+    event.listen(Session, 'after_rollback', _abandon_spans)
 
 @app.route('/')
 def hello():
@@ -14,7 +125,13 @@ def hello():
 def bye():
     return 'suck'
 
+import api
+import views
+
 if __name__ == '__main__':
+    # The views are registered on the imported module's app rather
+    # than the one in __main__
+    from app import app
     # Bind to PORT if defined, otherwise default to 5000.
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,29 @@
+from sqlalchemy.sql.expression import select
+from app import db
+from models import Account
+import membership
+
+def balances(user, active_only=False):
+    """Balance of each account a user can see and their total.
+
+    That is their own accounts and those shared with their groups.
+
+    Keyword arguments:
+    user -- User whose accounts are wanted
+    active_only -- Leave out the deactivated accounts (default False)
+
+    Returns:
+    (accounts, total) where accounts is a list of (account ID, name,
+    active, balance) tuples and total is the sum of their balances,
+    all in integer cents
+
+    """
+    a = Account.__table__
+    criteria = membership.accounts_clause(user.id)
+    if active_only:
+        criteria = criteria & (a.c.active == True)
+    query = select([a.c.id, a.c.name, a.c.active, a.c.total], criteria).\
+            order_by(a.c.id)
+    accounts = [(id, name, bool(active), total or 0)
+                for id, name, active, total in db.session.execute(query)]
+    return accounts, sum([account[3] for account in accounts])
@@ -0,0 +1,146 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Spending analytics over the transaction log
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+from sqlalchemy import and_, extract
+from sqlalchemy.sql.expression import func, select
+
+import budse
+
+def _month(column):
+    """Month number of a date column, year * 12 + (month - 1)."""
+    return extract('year', column) * 12 + extract('month', column) - 1
+
+def month_label(month):
+    """Convert a month number into 'YYYY-MM'."""
+    return '%04d-%02d' % (month // 12, month % 12 + 1)
+
+def monthly_totals(session, user, begin_date=None, end_date=None,
+                   action=budse.Transaction.WITHDRAWAL):
+    """Sum the amounts of each account by month for one action.
+
+    The sums are made by the database with a GROUP BY, so only a row
+    per account and month comes back.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User whose transactions are summed
+    begin_date -- datetime.date of the earliest transaction (default None)
+    end_date -- datetime.date of the latest transaction (default None)
+    action -- Transaction action to sum (default withdrawals)
+
+    Returns:
+    (months, totals) where months is the sorted list of every month
+    from the first to the last transaction and totals is a dictionary
+    of account ID to a list of the sums in cents, one for each month
+
+    """
+    t = budse.transactions_table(session, user.id, begin_date)
+    criteria = [t.c.user_id == user.id, t.c.status == True]
+    if begin_date is not None:
+        criteria.append(t.c.date >= begin_date)
+    if end_date is not None:
+        criteria.append(t.c.date <= end_date)
+    first, last = session.execute(
+        select([func.min(t.c.date), func.max(t.c.date)],
+               and_(*criteria))).fetchone()
+    if first is None:
+        return [], {}
+    first = first.year * 12 + first.month - 1
+    months = range(first, last.year * 12 + last.month)
+    month = _month(t.c.date)
+    query = select([t.c.account_id, month, func.sum(t.c.amount)],
+                   and_(t.c.action == action, t.c.account_id != None,
+                        *criteria)).group_by(t.c.account_id, month)
+    totals = {}
+    for account, number, amount in session.execute(query):
+        if account not in totals:
+            totals[account] = [0] * len(months)
+        totals[account][int(number) - first] = amount or 0
+    return months, totals
+
+def rolling_average(values, window=3):
+    """Trailing average over a window, shorter at the start of the list.
+
+    Keyword arguments:
+    values -- List of numbers
+    window -- How many values to average (default 3)
+
+    Returns:
+    List of floats the same length as values
+
+    """
+    if window < 1:
+        raise budse.ParameterException('Window must be at least 1')
+    averages = []
+    running = 0
+    for index, value in enumerate(values):
+        running += value
+        if index >= window:
+            running -= values[index - window]
+        averages.append(float(running) / min(index + 1, window))
+    return averages
+
+def percentile(values, pct):
+    """Linearly interpolated percentile of a list of numbers.
+
+    Keyword arguments:
+    values -- List of numbers
+    pct -- Percentile in the range 0-100
+
+    Returns:
+    Float value, or None for an empty list
+
+    """
+    if not values:
+        return None
+    if pct < 0 or pct > 100:
+        raise budse.ParameterException('Percentile must be in the range 0-100')
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * \
+           (position - lower)
+
+def spending_summary(session, user, begin_date=None, end_date=None,
+                     window=3):
+    """Monthly spending of each account with its trends.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User to summarize
+    begin_date -- datetime.date to start from (default None)
+    end_date -- datetime.date to end on (default None)
+    window -- Months in the rolling average (default 3)
+
+    Returns:
+    (months, summary) where months is a list of 'YYYY-MM' labels and
+    summary is a list of (Account, spent, rolling, median, 90th
+    percentile) tuples; spent is in cents per month and the rest are
+    floats in cents
+
+    """
+    months, totals = monthly_totals(session, user, begin_date, end_date)
+    summary = []
+    for account in user.accounts:
+        spent = totals.get(account.id, [0] * len(months))
+        summary.append((account, spent, rolling_average(spent, window),
+                        percentile(spent, 50), percentile(spent, 90)))
+    return [month_label(m) for m in months], summary
@@ -0,0 +1,381 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Online, incremental backups of the database (and its archive)
+#     as checkpoints of page snapshots, and restores of any checkpoint
+#     to a new database file
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+from __future__ import with_statement
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import zlib
+from optparse import OptionParser
+
+default_database = 'data.db'
+# Pages copied under one read lock; writers wait at most this long
+step_pages = 256
+# Times a copy starts over because the database changed under it before
+# the backup fails (or, when asked to, holds the read lock for the
+# whole copy)
+max_restarts = 5
+
+class BackupException(Exception):
+    """A backup could not be made or restored."""
+    pass
+
+def _archive_file(database_file):
+    # Named like the library names it
+    return '%s_archive%s' % os.path.splitext(database_file)
+
+def _page_path(backup_dir, digest):
+    return os.path.join(backup_dir, 'pages', digest[:2], digest)
+
+def _checkpoint_path(backup_dir, number):
+    return os.path.join(backup_dir, 'checkpoints', '%06d.json' % number)
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+def _store_page(backup_dir, page):
+    """Keep a page by its checksum, unless an earlier backup already did.
+
+    Returns:
+    (checksum, whether the page was new)
+
+    """
+    digest = hashlib.sha1(page).hexdigest()
+    path = _page_path(backup_dir, digest)
+    if os.path.exists(path):
+        return digest, False
+    _makedirs(os.path.dirname(path))
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as page_file:
+        page_file.write(zlib.compress(page))
+    os.rename(temporary, path)
+    return digest, True
+
+def _data_version(connection):
+    return connection.execute('PRAGMA data_version').fetchone()[0]
+
+def _read_lock(connection):
+    """Take a read (shared) lock that writers wait on only to commit."""
+    connection.execute('BEGIN')
+    connection.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+
+def _snapshot(database_file, backup_dir, on_step=None, hold_lock=False):
+    """Copy the pages of a database as they are at one moment.
+
+    The pages are read a step at a time, each under its own read lock,
+    so that other connections can write in between.  When one does,
+    the copy starts over, up to max_restarts times.  After that the
+    last try keeps the lock throughout if hold_lock, which blocks every
+    writer until the copy is done, and otherwise the backup fails.
+
+    Returns:
+    (snapshot dictionary of the checkpoint, new pages, connection still
+    holding the read lock the snapshot was taken under)
+
+    """
+    connection = sqlite3.connect(database_file, isolation_level=None)
+    if connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+        # The pages that are only in the write-ahead log go to the file
+        connection.execute('PRAGMA wal_checkpoint(FULL)')
+    for attempt in range(max_restarts + 1):
+        hold = hold_lock and attempt == max_restarts
+        _read_lock(connection)
+        version = connection.execute('PRAGMA data_version').fetchone()[0]
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        digests = []
+        new_pages = 0
+        changed = False
+        database = open(database_file, 'rb')
+        try:
+            for first in range(0, page_count, step_pages):
+                if first and not hold:
+                    _read_lock(connection)
+                    if connection.execute(
+                            'PRAGMA data_version').fetchone()[0] != version:
+                        changed = True
+                        break
+                database.seek(first * page_size)
+                for index in range(first, min(first + step_pages,
+                                              page_count)):
+                    page = database.read(page_size)
+                    if len(page) != page_size:
+                        raise BackupException('%s ended at page %d of %d' %
+                                              (database_file, index,
+                                               page_count))
+                    digest, new = _store_page(backup_dir, page)
+                    digests.append(digest)
+                    new_pages += new
+                if on_step is not None:
+                    on_step(database_file, len(digests), page_count)
+                if not hold and first + step_pages < page_count:
+                    connection.execute('COMMIT')
+        finally:
+            database.close()
+        if changed:
+            connection.execute('COMMIT')
+            continue
+        return ({'file': os.path.basename(database_file),
+                 'page_size': page_size, 'pages': digests},
+                new_pages, connection)
+    raise BackupException('%s kept changing; try again when it is less '
+                          'busy, or hold the lock for the copy' %
+                          database_file)
+
+def checkpoints(backup_dir):
+    """The checkpoints of a backup directory, oldest first.
+
+    Returns:
+    List of checkpoint dictionaries (without their pages)
+
+    """
+    directory = os.path.join(backup_dir, 'checkpoints')
+    if not os.path.isdir(directory):
+        return []
+    result = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name)) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            for snapshot in checkpoint['databases'].values():
+                snapshot['page_count'] = len(snapshot.pop('pages'))
+            result.append(checkpoint)
+    return result
+
+def _load_checkpoint(backup_dir, number):
+    path = _checkpoint_path(backup_dir, number)
+    if not os.path.exists(path):
+        raise BackupException('There is no checkpoint %d' % number)
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def _last_event(connection):
+    """ID of the last ledger event, or None if the database has none."""
+    if not connection.execute("SELECT name FROM sqlite_master WHERE "
+                              "name = 'ledger_events'").fetchone():
+        return None
+    return connection.execute('SELECT max(event_id) FROM ledger_events').\
+           fetchone()[0]
+
+def create(database_file, backup_dir, on_step=None, hold_lock=False):
+    """Back up the database and its archive as a new checkpoint.
+
+    Only the pages no earlier checkpoint has are written, so backing
+    up a large database that changed a little writes a little.  The
+    archive is copied while the database is still read locked, and the
+    backup starts over (up to max_restarts times) if either file
+    changed before both were copied, so the checkpoint never has a
+    transaction in both files or in neither.
+
+    Keyword arguments:
+    database_file -- Database to back up
+    backup_dir -- Directory of the backups
+    on_step -- Function called with (database file, pages copied, page
+        count) after each step of the copy (default None)
+    hold_lock -- Hold the read lock for the whole copy, blocking the
+        writers, once it has had to start over max_restarts times,
+        rather than fail (default False)
+
+    Returns:
+    The new checkpoint dictionary (without its pages) and the number of
+    pages that were new
+
+    """
+    if not os.path.exists(database_file):
+        raise BackupException('There is no %s' % database_file)
+    _makedirs(backup_dir)
+    previous = checkpoints(backup_dir)
+    number = previous and previous[-1]['checkpoint'] + 1 or 1
+    archive_file = _archive_file(database_file)
+    for attempt in range(max_restarts + 1):
+        checkpoint = {'checkpoint': number,
+                      'created': datetime.datetime.now().isoformat(),
+                      'databases': {}}
+        new_pages = 0
+        connections = []
+        try:
+            snapshot, new, connection = _snapshot(database_file, backup_dir,
+                                                  on_step, hold_lock)
+            connections.append((connection, _data_version(connection)))
+            # Still under the lock of the snapshot, so they agree
+            checkpoint['schema_version'] = connection.execute(
+                'PRAGMA user_version').fetchone()[0]
+            checkpoint['last_event_id'] = _last_event(connection)
+            checkpoint['databases']['main'] = snapshot
+            new_pages += new
+            if os.path.exists(archive_file):
+                # The database is still read locked, and archiving moves
+                # transactions by writing both files in one transaction,
+                # so none can be moved while the archive is copied
+                snapshot, new, connection = _snapshot(archive_file,
+                                                      backup_dir, on_step,
+                                                      hold_lock)
+                connections.append((connection, _data_version(connection)))
+                checkpoint['databases']['archive'] = snapshot
+                new_pages += new
+            # A write-ahead log lets writers commit under a read lock, so
+            # make sure neither file changed since it was copied
+            unchanged = True
+            for connection, version in connections:
+                connection.execute('COMMIT')
+                _read_lock(connection)
+                unchanged = unchanged and \
+                            _data_version(connection) == version
+        finally:
+            for connection, version in connections:
+                connection.execute('COMMIT')
+                connection.close()
+        if unchanged:
+            break
+    else:
+        raise BackupException('%s kept changing; try again when it is less '
+                              'busy' % database_file)
+    path = _checkpoint_path(backup_dir, number)
+    _makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(path + '.tmp', path)
+    for snapshot in checkpoint['databases'].values():
+        snapshot['page_count'] = len(snapshot.pop('pages'))
+    return checkpoint, new_pages
+
+def _assemble(backup_dir, snapshot, path):
+    """Write the pages of a snapshot to a file, checking every one."""
+    with open(path, 'wb') as database:
+        for digest in snapshot['pages']:
+            page_path = _page_path(backup_dir, digest)
+            if not os.path.exists(page_path):
+                raise BackupException('Page %s is missing' % digest)
+            with open(page_path, 'rb') as page_file:
+                page = zlib.decompress(page_file.read())
+            if hashlib.sha1(page).hexdigest() != digest:
+                raise BackupException('Page %s is corrupt' % digest)
+            database.write(page)
+    connection = sqlite3.connect(path)
+    try:
+        result = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        connection.close()
+    if result != 'ok':
+        raise BackupException('The restored database is damaged: %s' % result)
+
+def restore(database_file, backup_dir, number, target_file):
+    """Write the database and its archive as they were at a checkpoint.
+
+    They are written to a new database file (and its archive) rather
+    than over the database itself: SQLite cannot tell whether another
+    connection has it open, and one that does would go on using the
+    replaced file.  Moving them into place is left for when nothing is
+    using the database.
+
+    Keyword arguments:
+    database_file -- Database that was backed up
+    backup_dir -- Directory of the backups
+    number -- Number of the checkpoint to restore
+    target_file -- New database file to restore to
+
+    Returns:
+    The checkpoint dictionary
+
+    """
+    checkpoint = _load_checkpoint(backup_dir, number)
+    targets = [('main', target_file),
+               ('archive', _archive_file(target_file))]
+    for name, path in targets:
+        if os.path.abspath(path) in (os.path.abspath(database_file),
+                                     os.path.abspath(_archive_file(
+                                         database_file))):
+            raise BackupException('Cannot restore over %s' % path)
+        if os.path.exists(path):
+            raise BackupException('%s already exists' % path)
+    for name, path in targets:
+        if name in checkpoint['databases']:
+            _assemble(backup_dir, checkpoint['databases'][name],
+                      path + '.restoring')
+    for name, path in targets:
+        if name in checkpoint['databases']:
+            os.rename(path + '.restoring', path)
+    return checkpoint
+
+def _describe(checkpoint):
+    sizes = ', '.join(['%s %d pages' % (name, snapshot['page_count'])
+                       for name, snapshot in
+                       sorted(checkpoint['databases'].items())])
+    return '%d - %s (%s; through ledger event %s)' % (
+        checkpoint['checkpoint'], checkpoint['created'], sizes,
+        checkpoint.get('last_event_id'))
+
+def main(argv=None):
+    parser = OptionParser(usage='python backup.py [options] create | list | '
+                          'restore CHECKPOINT')
+    parser.set_defaults(database=default_database, directory=None,
+                        hold_lock=False, target=None)
+    parser.add_option('-f', '--file', dest='database',
+                      help='Database file to back up or restore')
+    parser.add_option('-b', '--backups', dest='directory',
+                      help='Directory of the backups (default the database '
+                      'name followed by _backups)')
+    parser.add_option('-l', '--hold-lock', dest='hold_lock',
+                      action='store_true',
+                      help='Block writers for the whole copy rather than '
+                      'fail when the database keeps changing')
+    parser.add_option('-o', '--output', dest='target',
+                      help='New database file to restore to (default the '
+                      'database name followed by _checkpoint and its '
+                      'number)')
+    opts, args = parser.parse_args(argv)
+    if opts.directory is None:
+        opts.directory = '%s_backups' % os.path.splitext(opts.database)[0]
+    if not args or args[0] not in ('create', 'list', 'restore') or \
+           (args[0] == 'restore') != (len(args) == 2):
+        parser.error('Expected create, list or restore CHECKPOINT')
+    try:
+        if args[0] == 'create':
+            checkpoint, new_pages = create(opts.database, opts.directory,
+                                           hold_lock=opts.hold_lock)
+            print('Created checkpoint %s, %d new pages' %
+                  (_describe(checkpoint), new_pages))
+        elif args[0] == 'list':
+            for checkpoint in checkpoints(opts.directory):
+                print(_describe(checkpoint))
+        else:
+            try:
+                number = int(args[1])
+            except ValueError:
+                parser.error('Invalid checkpoint %s' % args[1])
+            if opts.target is None:
+                root, extension = os.path.splitext(opts.database)
+                opts.target = '%s_checkpoint%d%s' % (root, number, extension)
+            restore(opts.database, opts.directory, number, opts.target)
+            print('Restored checkpoint %d to %s; move it into place once '
+                  'nothing is using %s' % (number, opts.target,
+                                           opts.database))
+    except BackupException, e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
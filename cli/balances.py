@@ -0,0 +1,88 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Account balances of a user, cached per ledger version
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import threading
+
+from sqlalchemy.sql.expression import select
+
+import budse
+
+# Dictionary of user ID to (ledger version, [(account ID, name, active,
+# balance in cents), ...])
+_balances = {}
+_lock = threading.Lock()
+
+def _load(session, user_id):
+    """Query the balance of every account of a user at once."""
+    a = budse.Account.__table__
+    query = select([a.c.account_id, a.c.account_name, a.c.status,
+                    a.c.account_total], a.c.user_id == user_id).\
+            order_by(a.c.account_id)
+    return [(id, name, bool(status), total or 0)
+            for id, name, status, total in session.execute(query)]
+
+def balances(session, user_id, active_only=False):
+    """Balance of each of a user's accounts and their total.
+
+    The balances come from a single query and are kept until the
+    user's ledger version (see budse.ledger_version) changes, which
+    happens with any commit that changes their transactions or
+    accounts.
+
+    Keyword arguments:
+    session -- Session to query with
+    user_id -- ID of the user
+    active_only -- Leave out the deactivated accounts (default False)
+
+    Returns:
+    (accounts, total) where accounts is a list of (account ID, name,
+    active, balance) tuples and total is the sum of their balances,
+    all in integer cents
+
+    """
+    version = budse.ledger_version(user_id)
+    _lock.acquire()
+    try:
+        cached = _balances.get(user_id)
+    finally:
+        _lock.release()
+    if cached is not None and cached[0] == version:
+        accounts = cached[1]
+    else:
+        accounts = _load(session, user_id)
+        _lock.acquire()
+        try:
+            _balances[user_id] = (version, accounts)
+        finally:
+            _lock.release()
+    if active_only:
+        accounts = [account for account in accounts if account[2]]
+    return list(accounts), sum([account[3] for account in accounts])
+
+def invalidate(user_id=None):
+    """Forget the cached balances of a user (default everyone)."""
+    _lock.acquire()
+    try:
+        if user_id is None:
+            _balances.clear()
+        else:
+            _balances.pop(user_id, None)
+    finally:
+        _lock.release()
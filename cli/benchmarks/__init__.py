@@ -0,0 +1,25 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Benchmarks of the budget library over synthetic ledgers
+#
+#     Run from the cli directory:
+#         python -m benchmarks.run --rows 100000 --output results.json
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+# Sizes of the ledger, in transaction rows, the suite is usually run at
+sizes = {'small': 10000, 'medium': 100000, 'large': 1000000}
@@ -0,0 +1,236 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Deterministic generator of synthetic users, accounts and
+#     transactions
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import datetime
+import random
+
+from sqlalchemy import and_
+from sqlalchemy.sql.expression import func, select
+
+import budse
+
+# Last day of every generated ledger, so the same seed always makes
+# the same rows
+default_end_date = datetime.date(2012, 12, 31)
+# Rows written by a single INSERT
+chunk_size = 10000
+
+# Share of the transactions of each kind (the rest are withdrawals)
+whole_deposit_share = 0.08
+deposit_share = 0.07
+transfer_share = 0.10
+# Share of the transactions that are reversed
+reversal_share = 0.02
+
+# Descriptions picked from for the transactions
+descriptions = ('Rent', 'Groceries', 'Spam', 'Eggs', 'Coffee', 'Gas',
+                'Electric bill', 'Books', 'Dinner out', 'Gift', 'Insurance',
+                'Phone', 'Travel', 'Movie', 'Doctor', 'Haircut')
+
+class _Ledger(object):
+    """Transaction rows of one user as they are being generated."""
+    def __init__(self, random, user_id, accounts, start, end):
+        self.random = random
+        self.user_id = user_id
+        self.accounts = accounts
+        self.start = start
+        self.days = (end - start).days + 1
+        self.rows = []
+
+    def _date(self):
+        return self.start + datetime.timedelta(
+            days=self.random.randrange(self.days))
+
+    def _row(self, id, date, action, amount, account_id=None, parent=None,
+             description=None):
+        self.rows.append({
+            'transaction_id': id,
+            'timestamp': datetime.datetime.combine(date, datetime.time(12)),
+            'date': date,
+            'user_id': self.user_id,
+            'account_id': account_id,
+            'amount': amount,
+            'description': description,
+            'action': action,
+            'root_transaction_id': parent,
+            'status': True})
+
+    def whole_deposit(self, next_id):
+        """Paycheck split over every account, with deductions."""
+        date = self._date()
+        gross = self.random.randrange(100000, 500000)
+        root = next_id
+        self._row(root, date, budse.Transaction.DEPOSIT, gross,
+                  description='Paycheck')
+        next_id += 1
+        net = gross
+        for i in range(self.random.randrange(3)):
+            amount = self.random.randrange(1000, gross // 10)
+            self._row(next_id, date, budse.Transaction.DEDUCTION, amount,
+                      parent=root, description='Taxes')
+            net -= amount
+            next_id += 1
+        remaining = net
+        percentages = [(id, amount) for id, kind, amount in self.accounts
+                       if kind == budse.Account.PERCENTAGE]
+        for id, kind, amount in self.accounts:
+            if kind == budse.Account.FIXED:
+                self._row(next_id, date, budse.Transaction.DEPOSIT, amount,
+                          id, root, 'Paycheck')
+                remaining -= amount
+                next_id += 1
+        share = remaining
+        for index, (id, basis_points) in enumerate(percentages):
+            if index == len(percentages) - 1:
+                amount = remaining
+            else:
+                amount = share * basis_points // 10000
+            self._row(next_id, date, budse.Transaction.DEPOSIT, amount, id,
+                      root, 'Paycheck')
+            remaining -= amount
+            next_id += 1
+        return next_id
+
+    def deposit(self, next_id):
+        self._row(next_id, self._date(), budse.Transaction.DEPOSIT,
+                  self.random.randrange(500, 50000),
+                  self.random.choice(self.accounts)[0],
+                  description=self.random.choice(descriptions))
+        return next_id + 1
+
+    def withdrawal(self, next_id):
+        self._row(next_id, self._date(), budse.Transaction.WITHDRAWAL,
+                  self.random.randrange(100, 20000),
+                  self.random.choice(self.accounts)[0],
+                  description=self.random.choice(descriptions))
+        return next_id + 1
+
+    def transfer(self, next_id):
+        date = self._date()
+        amount = self.random.randrange(1000, 30000)
+        from_id, to_id = [a[0] for a in self.random.sample(self.accounts, 2)]
+        description = self.random.choice(descriptions)
+        self._row(next_id, date, budse.Transaction.TRANSFER, amount,
+                  description='[%d -> %d] %s' % (from_id, to_id,
+                                                 description))
+        self._row(next_id + 1, date, budse.Transaction.WITHDRAWAL, amount,
+                  from_id, next_id, description)
+        self._row(next_id + 2, date, budse.Transaction.DEPOSIT, amount,
+                  to_id, next_id, description)
+        return next_id + 3
+
+def _insert(session, table, rows):
+    for index in range(0, len(rows), chunk_size):
+        session.execute(table.insert(), rows[index:index + chunk_size])
+
+def generate(session, rows, users=1, accounts=8, years=3, seed=0,
+             end_date=default_end_date):
+    """Fill an empty database with a synthetic ledger.
+
+    The rows are written directly instead of through Deposit and the
+    other transaction classes, so that a million of them take minutes
+    rather than hours, but they are laid out the way the library lays
+    them out: whole account deposits with a child per account and
+    deductions, transfers with a withdrawal and a deposit, and a share
+    of reversed transaction groups.  The same arguments always make
+    the same ledger.
+
+    Keyword arguments:
+    session -- Session of the (empty) database to fill
+    rows -- About how many transaction rows to make in all
+    users -- Number of users to spread the rows over (default 1)
+    accounts -- Accounts of each user (default 8)
+    years -- How many years the transactions span (default 3)
+    seed -- Seed of the random numbers (default 0)
+    end_date -- Date of the newest transactions (default 2012-12-31)
+
+    Returns:
+    List of the IDs of the users made
+
+    """
+    if rows < 1 or users < 1 or accounts < 3 or years < 1:
+        raise budse.ParameterException('Invalid ledger size')
+    rng = random.Random(seed)
+    start = datetime.date(end_date.year - years, end_date.month,
+                          min(end_date.day, 28)) + datetime.timedelta(days=1)
+    user_ids = []
+    next_account = next_transaction = 1
+    for user_number in range(users):
+        user_id = user_number + 1
+        session.execute(budse.User.__table__.insert(), {
+            'user_id': user_id, 'user_name': 'bench%d' % user_id,
+            'status': True, 'whole_account_actions': True})
+        # Two fixed accounts, the rest split the net by percentage
+        account_rows = []
+        ledger_accounts = []
+        percentages = accounts - 2
+        for index in range(accounts):
+            if index < 2:
+                kind, amount = budse.Account.FIXED, rng.randrange(2000, 20000)
+            else:
+                kind, amount = budse.Account.PERCENTAGE, 10000 // percentages
+            account_rows.append({
+                'account_id': next_account, 'user_id': user_id,
+                'account_name': 'Account %d' % (index + 1), 'status': True,
+                'account_total': 0, 'percentage_or_fixed': kind,
+                'transaction_amount': amount, 'affect_gross': False,
+                'account_description': None})
+            ledger_accounts.append((next_account, kind, amount))
+            next_account += 1
+        _insert(session, budse.Account.__table__, account_rows)
+
+        ledger = _Ledger(rng, user_id, ledger_accounts, start, end_date)
+        target = rows // users
+        roots = []
+        while len(ledger.rows) < target:
+            roots.append(next_transaction)
+            kind = rng.random()
+            if kind < whole_deposit_share:
+                next_transaction = ledger.whole_deposit(next_transaction)
+            elif kind < whole_deposit_share + deposit_share:
+                next_transaction = ledger.deposit(next_transaction)
+            elif kind < whole_deposit_share + deposit_share + transfer_share:
+                next_transaction = ledger.transfer(next_transaction)
+            else:
+                next_transaction = ledger.withdrawal(next_transaction)
+        reversed = set(rng.sample(roots, int(len(roots) * reversal_share)))
+        for row in ledger.rows:
+            if row['transaction_id'] in reversed or \
+                   row['root_transaction_id'] in reversed:
+                row['status'] = False
+        _insert(session, budse.Transaction.__table__, ledger.rows)
+        user_ids.append(user_id)
+
+    # Written directly, so the ledger events are too
+    budse.post_existing_transactions(session)
+    # Account totals are the sum of their active transactions
+    t = budse.Transaction.__table__
+    a = budse.Account.__table__
+    def total(action):
+        return select([func.coalesce(func.sum(t.c.amount), 0)],
+                      and_(t.c.account_id == a.c.account_id,
+                           t.c.status == True,
+                           t.c.action == action)).as_scalar()
+    session.execute(a.update().values(
+        account_total=total(budse.Transaction.DEPOSIT) -
+        total(budse.Transaction.WITHDRAWAL)))
+    session.commit()
+    return user_ids
@@ -0,0 +1,142 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Operations of the budget library that are benchmarked
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import datetime
+import os
+import tempfile
+
+from sqlalchemy import desc, func
+
+import budse
+import budsecli
+
+class ScriptedCLI(budsecli.BudseCLI):
+    """Command line interface that reads its input from a list.
+
+    The menus of the interface are timed as they are, with the answers
+    to their prompts given up front instead of typed.
+
+    """
+    def __init__(self, session, user):
+        budsecli.BudseCLI.__init__(self, session, user)
+        self.answers = []
+
+    def _handle_input(self, prompt, base_type=str):
+        if not self.answers:
+            raise budse.ParameterException('No answer for %r' % prompt)
+        return base_type(self.answers.pop(0))
+
+    def ask(self, answers, method, *args):
+        """Call a method of the interface with the answers to its prompts.
+        """
+        self.answers = list(answers)
+        return method(*args)
+
+def _date(date):
+    return date.strftime('%m/%d/%Y')
+
+def operations(session, user):
+    """Operations to time against a user's ledger.
+
+    Anything an operation changes is rolled back after it is timed, so
+    every run sees the same ledger.
+
+    Keyword arguments:
+    session -- Session of the ledger's database
+    user -- User whose ledger is used
+
+    Returns:
+    List of (name, operation, setup, teardown) tuples for
+    benchmarks.run.time_operation
+
+    """
+    cli = ScriptedCLI(session, user)
+    newest = session.query(func.max(budse.Transaction.date)).scalar()
+    account = [a for a in user.accounts if a.status][0]
+    existing = session.query(budse.Transaction).\
+               filter(budse.Transaction.account == account).\
+               filter(budse.Transaction.status == True).\
+               filter(budse.Transaction.action ==
+                      budse.Transaction.WITHDRAWAL).\
+               order_by(desc(budse.Transaction.date)).first()
+    reversible = session.query(budse.Transaction).\
+                 filter(budse.Transaction._user == user.id).\
+                 filter(budse.Transaction.parent == None).\
+                 filter(budse.Transaction.status == True).\
+                 filter(budse.Transaction.account == None).\
+                 filter(budse.Transaction.action ==
+                        budse.Transaction.DEPOSIT).\
+                 order_by(desc(budse.Transaction.id)).first()
+    handle, report = tempfile.mkstemp(suffix='.xls', prefix='budse_bench_')
+    os.close(handle)
+
+    def deposit():
+        budse.Deposit(user, 2500.00, newest, 'Benchmark',
+                      duplicate_override=True)
+
+    def duplicate_check():
+        try:
+            budse.Withdrawal(user, existing.amount, existing.date,
+                             'Benchmark', existing.account)
+        except budse.DuplicateException:
+            pass
+        else:
+            raise budse.BudseException('Duplicate was not found')
+
+    def search_date_range():
+        cli.ask(['1', _date(newest - datetime.timedelta(days=90)),
+                 _date(newest)], cli.output_search)
+
+    def search_keywords():
+        # Keyword, done entering keywords, no other limit
+        cli.ask(['4', 'Rent', '', ''], cli.output_search)
+
+    def report_by_date():
+        # Dates, not the default file, then the file
+        cli.ask([_date(newest - datetime.timedelta(days=365)), _date(newest),
+                 'n', report], cli._create_report_by_date)
+
+    def recalculate():
+        budse.recalculate_account_totals(user.accounts)
+
+    def reversal():
+        reversible.status = False
+        session.flush()
+
+    def clear_cache():
+        cli.search_cache.clear()
+
+    def remove_report():
+        if os.path.exists(report):
+            os.remove(report)
+
+    result = [('deposit_construction', deposit, None, session.rollback),
+              ('recalculate_account_totals', recalculate, None, None),
+              ('search_date_range', search_date_range, clear_cache, None),
+              ('search_date_range_cached', search_date_range, None, None),
+              ('search_keywords', search_keywords, clear_cache, None),
+              ('create_report_by_date', report_by_date, remove_report,
+               remove_report)]
+    if existing is not None:
+        result.append(('duplicate_check', duplicate_check, None,
+                       session.rollback))
+    if reversible is not None:
+        result.append(('reversal', reversal, None, session.rollback))
+    return result
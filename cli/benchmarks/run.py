@@ -0,0 +1,212 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Time the key operations of the budget library over a synthetic
+#     ledger and write the results as JSON
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from optparse import OptionParser
+
+import budse
+import instrument
+from benchmarks import generator, operations, sizes
+
+parser = OptionParser(usage='python -m benchmarks.run [options]')
+parser.set_defaults(rows=sizes['small'], users=1, accounts=8, years=3, seed=0,
+                    repeat=5, tolerance=0.25)
+parser.add_option('-n', '--rows', type='int', dest='rows',
+                  help='Transaction rows in the ledger (default %d)' %
+                  sizes['small'])
+parser.add_option('-s', '--size', dest='size', choices=sorted(sizes),
+                  help='Rows by name: %s' % ', '.join(
+                      ['%s (%d)' % (name, sizes[name])
+                       for name in sorted(sizes, key=sizes.get)]))
+parser.add_option('-u', '--users', type='int', dest='users',
+                  help='Users to spread the rows over (default 1)')
+parser.add_option('-a', '--accounts', type='int', dest='accounts',
+                  help='Accounts of each user (default 8)')
+parser.add_option('-y', '--years', type='int', dest='years',
+                  help='Years the transactions span (default 3)')
+parser.add_option('--seed', type='int', dest='seed',
+                  help='Seed of the generated ledger (default 0)')
+parser.add_option('-r', '--repeat', type='int', dest='repeat',
+                  help='Times each operation is timed (default 5)')
+parser.add_option('-f', '--file', dest='database',
+                  help='Database to run against; it is generated when it '
+                  'does not exist (default a temporary file)')
+parser.add_option('-o', '--output', dest='output',
+                  help='File to write the results to (default stdout)')
+parser.add_option('-b', '--baseline', dest='baseline',
+                  help='Results of an earlier run to compare against')
+parser.add_option('-t', '--tolerance', type='float', dest='tolerance',
+                  help='Slowdown of the median over the baseline that is '
+                  'a regression (default 0.25)')
+
+def _revision():
+    """Git revision of the library, if it is in a git checkout."""
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(
+                                       os.path.abspath(__file__)))
+        output = process.communicate()[0].strip()
+    except OSError:
+        return None
+    return output or None
+
+def _statistics(times):
+    times = sorted(times)
+    middle = len(times) // 2
+    if len(times) % 2:
+        median = times[middle]
+    else:
+        median = (times[middle - 1] + times[middle]) / 2
+    return {'runs': len(times), 'min': times[0], 'median': median,
+            'mean': sum(times) / len(times), 'max': times[-1]}
+
+def time_operation(operation, repeat, setup=None, teardown=None):
+    """Time an operation, in seconds, a number of times.
+
+    Keyword arguments:
+    operation -- Function to time
+    repeat -- Times to run it
+    setup -- Function run (untimed) before each run (default None)
+    teardown -- Function run (untimed) after each run (default None)
+
+    Returns:
+    Dictionary of the statistics of the runs, with the queries and rows
+    of the last one
+
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        with instrument.profile() as stats:
+            start = timeit.default_timer()
+            try:
+                operation()
+            finally:
+                times.append(timeit.default_timer() - start)
+        if teardown is not None:
+            teardown()
+    statistics = _statistics(times)
+    # Of the last run; the first can differ as caches warm up
+    statistics['queries'] = stats.queries
+    statistics['rows'] = stats.rows
+    return statistics
+
+def compare(results, baseline, tolerance):
+    """Operations whose median got slower than the baseline's.
+
+    Returns:
+    List of (operation, baseline median, median) tuples
+
+    """
+    regressions = []
+    for name, statistics in sorted(results['operations'].items()):
+        before = baseline.get('operations', {}).get(name)
+        if before and statistics['median'] > \
+               before['median'] * (1 + tolerance):
+            regressions.append((name, before['median'],
+                                statistics['median']))
+    return regressions
+
+def main(argv=None):
+    opts, args = parser.parse_args(argv)
+    if opts.size is not None:
+        opts.rows = sizes[opts.size]
+    temporary = opts.database is None
+    if temporary:
+        handle, opts.database = tempfile.mkstemp(suffix='.db',
+                                                 prefix='budse_bench_')
+        os.close(handle)
+        os.remove(opts.database)
+    generate = not os.path.exists(opts.database)
+
+    budse.configure(opts.database)
+    instrument.install()
+    session = budse.initialize()
+    try:
+        if generate:
+            start = timeit.default_timer()
+            generator.generate(session, opts.rows, opts.users, opts.accounts,
+                               opts.years, opts.seed)
+            generated = timeit.default_timer() - start
+        else:
+            generated = None
+        user = session.query(budse.User).order_by(budse.User.id).first()
+        if user is None:
+            parser.error('%s has no users' % opts.database)
+        rows = session.query(budse.Transaction).count()
+        timings = {}
+        # The menus print as they go, keep that out of the results
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            for name, operation, setup, teardown in \
+                    operations.operations(session, user):
+                timings[name] = time_operation(operation, opts.repeat, setup,
+                                               teardown)
+        finally:
+            sys.stdout = stdout
+    finally:
+        session.close()
+        if temporary:
+            os.remove(opts.database)
+
+    results = {'generated_at': datetime.datetime.now().isoformat(),
+               'revision': _revision(),
+               'python': platform.python_version(),
+               'sqlalchemy': __import__('sqlalchemy').__version__,
+               'platform': platform.platform(),
+               'ledger': {'rows': rows, 'users': opts.users,
+                          'accounts': opts.accounts, 'years': opts.years,
+                          'seed': opts.seed,
+                          'generate_seconds': generated},
+               'operations': timings}
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output is None:
+        print(output)
+    else:
+        with open(opts.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+    if opts.baseline is not None:
+        with open(opts.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('ledger', {}).get('rows') != rows:
+            sys.stderr.write('The baseline was run against %s rows, not %d\n'
+                             % (baseline.get('ledger', {}).get('rows'), rows))
+        regressions = compare(results, baseline, opts.tolerance)
+        for name, before, after in regressions:
+            sys.stderr.write('Regression in %s: %0.4fs -> %0.4fs\n' %
+                             (name, before, after))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,44 +22,109 @@
 ############################
 
 import datetime
+import os
+from contextlib import contextmanager
 #import pdb
 from optparse import OptionParser
 
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, desc
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, desc, asc
 from sqlalchemy import create_engine, DateTime, Date, MetaData, Boolean, or_
+from sqlalchemy import and_, event, Index, DDL, PrimaryKeyConstraint
 from sqlalchemy.ext.declarative import declarative_base, synonym_for
+from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy.orm import sessionmaker, scoped_session, relation, backref
 from sqlalchemy.orm import synonym
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from sqlalchemy.orm.properties import ColumnProperty
-from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import func, select, text, union_all
+from sqlalchemy.sql.expression import literal_column, literal, case
+from sqlalchemy.sql.visitors import replacement_traverse
 from sqlalchemy.orm.exc import NoResultFound
 
+import tracing
+
 default_database = 'data.db'
-parser = OptionParser()
-parser.set_defaults(debug=False, database=default_database)
-parser.add_option('-f', '--file',
-                  dest='database', help='Database file to utilize')
-parser.add_option('-d', '--debug',
-                  action='store_true', dest='debug',
-                  help='Display debugging information')
-opts, args = parser.parse_args()
-
-debug = opts.debug
-database_file = opts.database
+# Bump whenever the tables change, so that existing databases get them
+# created (and any migration in _migrations run) the next time they are
+# opened
+schema_version = 4
+
+debug = False
+profile = False
+database_file = None
+archive_file = None
+engine = None
 
 # Homegrown XML/S-expressions
 # Strings that are unlikely to be used by the user in descriptions, etc
 str_delimiter = ',|,'  
 tag_delimiter = ',:,'
 
-if debug:
-    engine = create_engine('sqlite:///%s' % database_file, echo=True)
-else:
-    engine = create_engine('sqlite:///%s' % database_file)
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
+# Bound to the engine by configure
+Session = sessionmaker()
 session = None
 
+def option_parser():
+    """Parser of the command line options shared by the interfaces."""
+    parser = OptionParser()
+    parser.set_defaults(debug=False, profile=False, trace=None,
+                        database=default_database)
+    parser.add_option('-f', '--file',
+                      dest='database', help='Database file to utilize')
+    parser.add_option('-d', '--debug',
+                      action='store_true', dest='debug',
+                      help='Display debugging information')
+    parser.add_option('-p', '--profile',
+                      action='store_true', dest='profile',
+                      help='Count the queries, rows and SQL time of each '
+                      'action')
+    parser.add_option('-t', '--trace', dest='trace', metavar='FILE',
+                      help='Append timing spans of each operation to FILE '
+                      'as JSON lines')
+    return parser
+
+def configure(database=default_database, debug=False, profile=False,
+              trace=None):
+    """Set up the database and options of the library.
+
+    Nothing is read from the command line; the interfaces pass along
+    what option_parser parsed.  Until this is called (initialize calls
+    it with the defaults) there is no engine.
+
+    Keyword arguments:
+    database -- Database file to utilize (default data.db)
+    debug -- Echo the SQL and display debugging information
+        (default False)
+    profile -- Count the queries, rows and SQL time of each action
+        (default False)
+    trace -- File to append the timing spans to (default None)
+
+    Returns:
+    The Engine of the database
+
+    """
+    global engine, database_file, archive_file
+    # The arguments have the names of the settings they set
+    globals().update(debug=debug, profile=profile)
+    if trace:
+        tracing.configure(trace)
+    if engine is not None:
+        engine.dispose()
+    database_file = database
+    # Old transactions are moved into a second database file that is
+    # attached to every connection as 'archive' once it exists
+    archive_file = '%s_archive%s' % os.path.splitext(database_file)
+    engine = create_engine('sqlite:///%s' % database_file, echo=debug)
+    event.listen(engine, 'connect', _attach_archive)
+    Session.configure(bind=engine)
+    return engine
+
+def _attach_archive(dbapi_connection, connection_record):
+    if os.path.exists(archive_file):
+        dbapi_connection.execute("ATTACH DATABASE ? AS archive",
+                                 (archive_file,))
+
 class UpperComparator(ColumnProperty.Comparator):
     """Upper case strings to compare them without regard to case."""
     def __eq__(self, other):
@@ -227,9 +292,15 @@ class User(Base):
     _name = Column('user_name', String, nullable=False)
     status = Column(Boolean, default=True)
     _last_login = Column('last_login', DateTime)
-    _deductions = Column('automatic_deductions', String)
     whole_account_actions = Column(Boolean)
 
+    # Loaded once and kept by the session, so every deposit that uses
+    # them reuses the same list
+    deductions = relation('StoredDeduction',
+                          order_by='StoredDeduction.position',
+                          collection_class=ordering_list('position'),
+                          cascade='all, delete-orphan', backref='user')
+
     def _get_name(self):
         return self._name
     def _set_name(self, name):
@@ -245,13 +316,15 @@ class User(Base):
         Keyword arguments:
         name -- Login name
         whole -- Prompt for whole account actions (default False)
-        deductions -- List of deductions to use (default None)
+        deductions -- List of StoredDeduction objects to use
+            (default None)
         accounts -- List of Account objects (default None)
 
         """
         self.name = name
         self.whole_account_actions = whole
-        self.deductions = deductions
+        if deductions is not None:
+            self.deductions = deductions
         self.accounts = []
         if accounts is not None:
             for account in accounts:
@@ -272,55 +345,18 @@ class User(Base):
         except AttributeError:
             return 'Never'
         
-    # General delimiters that are used within the string that is stored
-    # in the database.
-    # This can be a problem if the user attempts to use them in the deduction
-    # description
-    _deduction_delimiter = ';'
-    _deduction_separater = ':'
-    def _get_deductions(self):
-        """Parse deductions in database and convert to a list of tuples.
-
-        Deductions in database should be stored as a continuous list of:
-        <amount>:<description>;
-
-        Example:
-        10:Taxes;20:More taxes;
-        
-        Deductions are currently only allowed to be a fixed amount.  
-        Allowing percentage amounts is a possibility in the future.
-
-        Returns:
-        List of (amount, description) tuples
-
-        """
-        all_deductions = self._deductions
-        deductions = []
-        while all_deductions.find(self._deduction_delimiter) > 0:
-            separater_index = all_deductions.find(self._deduction_separater)    
-            delimiter_index = all_deductions.find(self._deduction_delimiter)
-            amount = float(all_deductions[:separater_index])
-            description = all_deductions[separater_index+1:delimiter_index]
-            deductions.append((amount, description))
-            all_deductions = all_deductions[delimiter_index+1:]
-        return deductions
-    def _set_deductions(self, deductions):
-        """Convert list of deductions into the proper format.
+    def deductions_for(self, gross):
+        """Stored deductions to make on a deposit.
 
         Keyword arguments:
-        deductions -- List of (amount, description) tuples
+        gross -- Gross amount of the deposit
+
+        Returns:
+        List of (amount, description) tuples, in order
 
         """
-        deduction_repr = ''
-        if deductions is not None:
-            for amount, description in deductions:
-                deduction_repr += '%0.2f%s%s%s' % (amount,
-                                                   self._deduction_separater,
-                                                   description,
-                                                   self._deduction_delimiter)
-        self._deductions = deduction_repr
-    deductions = synonym('_deductions', descriptor=property(_get_deductions,
-                                                            _set_deductions))
+        return [(deduction.amount_of(gross), deduction.description)
+                for deduction in self.deductions]
 
     def __repr__(self):
         return ('%s %s %s %s' % (self.__class__.__name__, self.name,
@@ -344,6 +380,54 @@ class User(Base):
                 self.status))
 
 
+class StoredDeduction(Base):
+    """A deduction the user makes on deposits again and again.
+
+    Fixed deductions are an amount of money, percentage deductions a
+    share (e.g., 0.15) of the gross amount of the deposit.
+
+    """
+
+    __tablename__ = 'stored_deductions'
+
+    id = Column('deduction_id', Integer, primary_key=True)
+    _user = Column('user_id', Integer, ForeignKey('users.user_id'),
+                   index=True)
+    position = Column(Integer, nullable=False)
+    percentage_or_fixed = Column(String, nullable=False)
+    _amount = Column('amount', Integer, nullable=False)
+    description = Column(String)
+
+    def __init__(self, amount, description=None,
+                 percentage_or_fixed=Account.FIXED):
+        self.percentage_or_fixed = percentage_or_fixed
+        self.amount = amount
+        self.description = description
+
+    def _get_amount(self):
+        if self.percentage_or_fixed == Account.PERCENTAGE:
+            return _format_out_amount(self._amount, 10000)
+        else:
+            return _format_out_amount(self._amount)
+    def _set_amount(self, amount):
+        if self.percentage_or_fixed == Account.PERCENTAGE:
+            self._amount = int(round(float(amount) * 10000))
+        else:
+            self._amount = _format_db_amount(amount)
+    amount = synonym('_amount', descriptor=property(_get_amount, _set_amount))
+
+    def amount_of(self, gross):
+        """Amount deducted from a deposit of the gross amount."""
+        if self.percentage_or_fixed == Account.PERCENTAGE:
+            return round(gross * self.amount, 2)
+        return self.amount
+
+    def __repr__(self):
+        return ('%s %s %s %s' % (self.__class__.__name__,
+                                 self.percentage_or_fixed, self._amount,
+                                 self.description))
+
+
 class Transaction(Base):
     """Base class for all transactions."""
 
@@ -367,10 +451,16 @@ class Transaction(Base):
     _parent = Column('root_transaction_id', Integer,
                      ForeignKey('transactions.transaction_id'))
     _status = Column('status', Boolean, default=False)
+    # Last, as it is added to the end of the tables of older databases
+    _batch = Column('batch_id', Integer, ForeignKey('batches.batch_id'),
+                    index=True)
     __mapper_args__ = {'polymorphic_on':action,
                        'polymorphic_identity':INFORMATIONAL}
+    # Never reuse the ID of a transaction that was moved to the archive
+    __table_args__ = {'sqlite_autoincrement':True}
 
     user = relation('User', backref=backref('transactions', order_by=id))
+    batch = relation('Batch')
     account = relation('Account', backref=backref('transactions', order_by=id))
     children = relation('Transaction', primaryjoin=_parent == id, cascade='all',
                         backref=backref('parent', remote_side=id),
@@ -389,19 +479,18 @@ class Transaction(Base):
         self.timestamp = datetime.datetime.now()
 
         if not duplicate_override:
-            duplicates = []
-            for t in session.query(Transaction).\
-                filter(or_(Transaction.parent != parent,
-                           Transaction.parent == None)).\
-                filter(Transaction.action != Transaction.TRANSFER).\
-                filter(Transaction.action != Transaction.DEDUCTION).\
-                filter(Transaction.action != Transaction.INFORMATIONAL).\
-                filter(Transaction.date == date).\
-                filter(Transaction.status == True).\
-                filter(Transaction.account == account).\
-                filter(Transaction.amount ==
-                       _format_db_amount(amount)).all():
-                duplicates.append(t)
+            with tracing.span('duplicate_check'):
+                duplicates = session.query(Transaction).\
+                    filter(or_(Transaction.parent != parent,
+                               Transaction.parent == None)).\
+                    filter(Transaction.action != Transaction.TRANSFER).\
+                    filter(Transaction.action != Transaction.DEDUCTION).\
+                    filter(Transaction.action != Transaction.INFORMATIONAL).\
+                    filter(Transaction.date == date).\
+                    filter(Transaction.status == True).\
+                    filter(Transaction.account == account).\
+                    filter(Transaction.amount ==
+                           _format_db_amount(amount)).all()
             if len(duplicates) > 0:
                 if len(duplicates) == 1:
                     error = 'Possible duplicate found'
@@ -445,9 +534,10 @@ class Transaction(Base):
             return self._status
     def _set_status(self, status):
         if status != self._status:
-            self._undo_action(status)
-            for t in self.children:
-                t._undo_action(status)
+            with tracing.span('balance_update', transaction=self.id):
+                self._undo_action(status)
+                for t in self.children:
+                    t._undo_action(status)
     status = synonym('_status', descriptor=property(_get_status, _set_status))
 
     def _undo_action(self, status):
@@ -654,109 +744,117 @@ class Deposit(Transaction):
             if accounts is None or len(accounts) == 0:
                 raise DepositException('Accounts are required.')
             
-            # lists of separated accounts
-            gross_accounts = []
-            fixed_accounts = []
-            net_accounts = []
-            # lists of (Account, amount) tuples
-            gross_deposits = []
-            fixed_deposits = []
-            net_deposits = []
-
-            # Calculate minimum deposit for error message
-            minimum_deposit = deduction_total
-
-            for (a, affect_gross, percentage_or_fixed, amount) in accounts:
-                # Fixed
-                if percentage_or_fixed == Account.FIXED:
-                    minimum_deposit += amount
-                    fixed_accounts.append((a, amount))
-                # Percentage, gross
-                elif affect_gross:
-                    minimum_deposit += self.amount * amount
-                    gross_accounts.append((a, amount))
-                else:
-                    net_accounts.append((a, amount))
+            with tracing.span('allocation', accounts=len(accounts)):
+                # lists of separated accounts
+                gross_accounts = []
+                fixed_accounts = []
+                net_accounts = []
+                # lists of (Account, amount) tuples
+                gross_deposits = []
+                fixed_deposits = []
+                net_deposits = []
+
+                # Calculate minimum deposit for error message
+                minimum_deposit = deduction_total
+
+                for (a, affect_gross, percentage_or_fixed, amount) in accounts:
+                    # Fixed
+                    if percentage_or_fixed == Account.FIXED:
+                        minimum_deposit += amount
+                        fixed_accounts.append((a, amount))
+                    # Percentage, gross
+                    elif affect_gross:
+                        minimum_deposit += self.amount * amount
+                        gross_accounts.append((a, amount))
+                    else:
+                        net_accounts.append((a, amount))
             
-            if self.amount < minimum_deposit:
-                raise FundsException('Insufficient funds for whole account'
-                                     ' deposit.  (Minimum $%0.2f)' %
-                                     minimum_deposit)
-
-            total = 0.00
-            gross = running_total = self.amount
-            # Calculate gross deposits
-            for (a, amt) in gross_accounts:
-                amount = gross * amt
-                if amount > 0:
-                    amount = round(amount, 2)
-                    total += amount
-                    running_total -= amount
-                    gross_deposits.append((a, amount))
-
-            # Execute deductions
-            running_total -= deduction_total
-            total += deduction_total
-
-            # Calculate fixed deposits
-            for (a, amt) in fixed_accounts:
-                if running_total > 0:
-                    if amt > 0:
-                        running_total -= amt
-                        total += amt
-                        fixed_deposits.append((a, amt))
-                    elif amt < 0:
-                        raise DepositException('Invalid negative deposit')
-                else:
+                if self.amount < minimum_deposit:
                     raise FundsException('Insufficient funds for whole account'
-                                         ' deposit')
+                                         ' deposit.  (Minimum $%0.2f)' %
+                                         minimum_deposit)
+
+                total = 0.00
+                gross = running_total = self.amount
+                # Calculate gross deposits
+                for (a, amt) in gross_accounts:
+                    amount = gross * amt
+                    if amount > 0:
+                        amount = round(amount, 2)
+                        total += amount
+                        running_total -= amount
+                        gross_deposits.append((a, amount))
+
+                # Execute deductions
+                running_total -= deduction_total
+                total += deduction_total
+
+                # Calculate fixed deposits
+                for (a, amt) in fixed_accounts:
+                    if running_total > 0:
+                        if amt > 0:
+                            running_total -= amt
+                            total += amt
+                            fixed_deposits.append((a, amt))
+                        elif amt < 0:
+                            raise DepositException('Invalid negative deposit')
+                    else:
+                        raise FundsException('Insufficient funds for whole '
+                                             'account deposit')
                 
-            # Calculate net deposits
-            if running_total > 0:
-                net = running_total
-                if net_accounts:
-                    for (a, amt) in net_accounts:
-                        amount = net * amt
-                        if amount > 0:
-                            amount = round(amount, 2)
-                            total += amount
-                            running_total -= amount
-                            net_deposits.append((a, amount))
-                    else: 
-                        difference = gross - total
-                        if difference != 0.00:
-                            a, amount = net_deposits.pop()
-                            amount += difference
-                            net_deposits.append((a, amount))
+                # Calculate net deposits
+                if running_total > 0:
+                    net = running_total
+                    if net_accounts:
+                        for (a, amt) in net_accounts:
+                            amount = net * amt
+                            if amount > 0:
+                                amount = round(amount, 2)
+                                total += amount
+                                running_total -= amount
+                                net_deposits.append((a, amount))
+                        else: 
+                            difference = gross - total
+                            if difference != 0.00:
+                                a, amount = net_deposits.pop()
+                                amount += difference
+                                net_deposits.append((a, amount))
                 
-            # Process gross percentage accounts
-            for account, amount in gross_deposits:
-                deposit = Deposit(user=self.user, amount=amount, parent=self,
-                                  date=self.date, account=account, 
-                                  description=self.description,
-                                  duplicate_override=duplicate_override)
-                session.add(deposit)
-                self.deposits.append(deposit)
-            # Process all (gross and net) fixed amounts at once
-            for account, amount in fixed_deposits:
-                deposit = Deposit(user=self.user, amount=amount,
-                                  date=self.date, account=account, 
-                                  description=self.description, parent=self,
-                                  duplicate_override=duplicate_override)
-                session.add(deposit)
-                self.deposits.append(deposit)
-            # Process remaining with the net percentage accounts
-            for account, amount in net_deposits:
-                deposit = Deposit(user=self.user, amount=amount,
-                                  date=self.date, account=account,
-                                  description=self.description, parent=self,
-                                  duplicate_override=duplicate_override)
-                session.add(deposit)
-                self.deposits.append(deposit)
+            with tracing.span('fan_out',
+                              children=len(gross_deposits) +
+                              len(fixed_deposits) + len(net_deposits)):
+                # Process gross percentage accounts
+                for account, amount in gross_deposits:
+                    deposit = Deposit(user=self.user, amount=amount,
+                                      parent=self, date=self.date,
+                                      account=account,
+                                      description=self.description,
+                                      duplicate_override=duplicate_override)
+                    session.add(deposit)
+                    self.deposits.append(deposit)
+                # Process all (gross and net) fixed amounts at once
+                for account, amount in fixed_deposits:
+                    deposit = Deposit(user=self.user, amount=amount,
+                                      date=self.date, account=account, 
+                                      description=self.description,
+                                      parent=self,
+                                      duplicate_override=duplicate_override)
+                    session.add(deposit)
+                    self.deposits.append(deposit)
+                # Process remaining with the net percentage accounts
+                for account, amount in net_deposits:
+                    deposit = Deposit(user=self.user, amount=amount,
+                                      date=self.date, account=account,
+                                      description=self.description,
+                                      parent=self,
+                                      duplicate_override=duplicate_override)
+                    session.add(deposit)
+                    self.deposits.append(deposit)
             
         else:
             self.amount -= deduction_total
-            self.account.total += self.amount
+            with tracing.span('balance_update', account=self.account.id):
+                self.account.total += self.amount
 
     def __str__(self):
         if self.account is not None:
@@ -796,7 +894,8 @@ class Withdrawal(Transaction):
         Transaction.__init__(self, user=user, amount=amount, account=account,
                              description=description, parent=parent, date=date,
                              duplicate_override=duplicate_override)
-        self.account.total -= self.amount
+        with tracing.span('balance_update', account=self.account.id):
+            self.account.total -= self.amount
 
     def __str__(self):
         return('Type%s Withdrawal%sAmount%s $%0.2f%sTransaction Date%s %s%s'
@@ -808,21 +907,357 @@ class Withdrawal(Transaction):
                 self.status))
     
 
+class Period(Base):
+    """A month of a user's transactions that has been closed.
+
+    The aggregates of a closed period are frozen in PeriodSummary rows
+    so that reports over past months do not have to go back to the
+    transaction log.  A transaction added, changed or reversed within a
+    closed period re-opens it (status False) until it is closed again.
+
+    """
+
+    __tablename__ = 'periods'
+
+    id = Column('period_id', Integer, primary_key=True)
+    _user = Column('user_id', Integer, ForeignKey('users.user_id'))
+    period = Column(Integer, nullable=False)
+    status = Column(Boolean, default=True)
+    _timestamp = Column('closed_timestamp', DateTime)
+    __table_args__ = (Index('ix_periods_user_period', 'user_id', 'period'),)
+
+    user = relation('User', backref=backref('periods', order_by=period))
+
+    def __init__(self, user, period):
+        self.user = user
+        self.period = period
+
+    def close(self):
+        """Record that the period is closed."""
+        self.status = True
+        self._timestamp = datetime.datetime.now()
+
+    def __repr__(self):
+        return '%s %s %s' % (self.__class__.__name__, period_label(self.period),
+                             self.status)
+
+
+class PeriodSummary(Base):
+    """Aggregates of an account for a closed Period, in integer cents.
+
+    Transfers are the net of the transfers into and out of the account
+    and are not included in the deposits and withdrawals.  Deductions
+    do not belong to an account, so they are kept on the summary
+    without an account.
+
+    """
+
+    __tablename__ = 'period_summaries'
+
+    id = Column('summary_id', Integer, primary_key=True)
+    _user = Column('user_id', Integer, ForeignKey('users.user_id'))
+    _account = Column('account_id', Integer, ForeignKey('accounts.account_id'))
+    period = Column(Integer, nullable=False)
+    deposits = Column(Integer, default=0)
+    withdrawals = Column(Integer, default=0)
+    deductions = Column(Integer, default=0)
+    transfers = Column(Integer, default=0)
+    closing_balance = Column(Integer, default=0)
+    __table_args__ = (Index('ix_period_summaries_user_period', 'user_id',
+                            'period'),)
+
+    account = relation('Account')
+
+
+class Checkpoint(Base):
+    """Balance of an account's transactions that were archived.
+
+    Deposits and withdrawals are the sums (in integer cents) of the
+    active transactions moved to the archive, so the total of an
+    account is the checkpoint plus what remains in the transaction log.
+    A checkpoint without an account records how far the archive goes.
+
+    """
+
+    __tablename__ = 'checkpoints'
+
+    id = Column('checkpoint_id', Integer, primary_key=True)
+    _user = Column('user_id', Integer, ForeignKey('users.user_id'),
+                   index=True)
+    _account = Column('account_id', Integer, ForeignKey('accounts.account_id'))
+    archived_through = Column(Date)
+    deposits = Column(Integer, default=0)
+    withdrawals = Column(Integer, default=0)
+
+    account = relation('Account')
+
+
+class LedgerEvent(Base):
+    """A change to the ledger, in the order it was made.
+
+    The events are only ever appended: posting a transaction (or
+    re-activating it), reversing it, and reconfiguring an account.  The
+    amount is that of the transaction in integer cents; what it does to
+    a balance follows from the kind and the action.  The projections
+    (see the ledger module) are built from them.
+
+    """
+
+    POST = 'post'
+    REVERSE = 'reverse'
+    RECONFIGURE = 'reconfigure'
+
+    __tablename__ = 'ledger_events'
+
+    id = Column('event_id', Integer, primary_key=True)
+    timestamp = Column(DateTime)
+    _user = Column('user_id', Integer, ForeignKey('users.user_id'),
+                   index=True)
+    kind = Column(String, nullable=False)
+    _transaction = Column('transaction_id', Integer)
+    _account = Column('account_id', Integer,
+                      ForeignKey('accounts.account_id'))
+    date = Column(Date)
+    action = Column(String)
+    amount = Column(Integer, default=0)
+    # The account configuration after a RECONFIGURE
+    detail = Column(String)
+    __table_args__ = {'sqlite_autoincrement':True}
+
+    def __repr__(self):
+        return ('%s %s %s %s %s' % (self.__class__.__name__, self.id,
+                                    self.kind, self._transaction, self.amount))
+
+# Changing or removing an event would silently change every projection
+for _statement in ('UPDATE', 'DELETE'):
+    event.listen(LedgerEvent.__table__, 'after_create', DDL(
+        "CREATE TRIGGER ledger_events_no_%s BEFORE %s ON ledger_events "
+        "BEGIN SELECT RAISE(ABORT, 'ledger_events is append-only'); END" %
+        (_statement.lower(), _statement)))
+
+
+class Batch(Base):
+    """Transactions that a bulk operation (e.g., an import) created.
+
+    The status is False once the batch has been rolled back.
+
+    """
+
+    __tablename__ = 'batches'
+
+    id = Column('batch_id', Integer, primary_key=True)
+    _user = Column('user_id', Integer, ForeignKey('users.user_id'),
+                   index=True)
+    timestamp = Column(DateTime)
+    description = Column(String)
+    status = Column(Boolean, default=True)
+
+    user = relation('User')
+
+    def __init__(self, user, description=None):
+        self.user = user
+        self.description = description
+        self.timestamp = datetime.datetime.now()
+
+    def add(self, transaction):
+        """Tag a transaction and its sub-transactions with the batch.
+
+        For transactions made before the batch block, which the
+        duplicate check has already flushed untagged.
+
+        """
+        transaction.batch = self
+        for t in transaction.children:
+            t.batch = self
+
+    def __repr__(self):
+        return '%s %s %s %s' % (self.__class__.__name__, self.id,
+                                self.description, self.status)
+
+
+class ProjectionMark(Base):
+    """Last LedgerEvent applied to a projection."""
+
+    __tablename__ = 'projection_marks'
+
+    name = Column(String, primary_key=True)
+    last_event = Column('last_event_id', Integer, default=0)
+
+
+class AccountBalance(Base):
+    """Balance of an account projected from the ledger events."""
+
+    __tablename__ = 'account_balances'
+
+    _account = Column('account_id', Integer,
+                      ForeignKey('accounts.account_id'), primary_key=True)
+    balance = Column(Integer, default=0)
+
+
+class DailyBalance(Base):
+    """Net change of an account's balance on a day."""
+
+    __tablename__ = 'daily_balances'
+
+    _account = Column('account_id', Integer,
+                      ForeignKey('accounts.account_id'))
+    date = Column(Date)
+    change = Column(Integer, default=0)
+    __table_args__ = (PrimaryKeyConstraint('account_id', 'date'),)
+
+
+class PeriodActivity(Base):
+    """Deposits, withdrawals and deductions of an account in a period.
+
+    Unlike PeriodSummary these are kept for every period, closed or
+    not, and transfers count as the deposits and withdrawals they are
+    made of.  Deductions do not belong to an account.
+
+    """
+
+    __tablename__ = 'period_activity'
+
+    id = Column('activity_id', Integer, primary_key=True)
+    _user = Column('user_id', Integer, ForeignKey('users.user_id'))
+    _account = Column('account_id', Integer,
+                      ForeignKey('accounts.account_id'))
+    period = Column(Integer, nullable=False)
+    deposits = Column(Integer, default=0)
+    withdrawals = Column(Integer, default=0)
+    deductions = Column(Integer, default=0)
+    __table_args__ = (Index('ix_period_activity_user_period', 'user_id',
+                            'period'),)
+
+
 ######
 # UTILITY FUNCTIONS
 ######
+def _move_deductions(connection):
+    """Move the stored deductions of the users to their own table.
+
+    They used to be a string of <amount>:<description>; entries in
+    users.automatic_deductions, which is emptied once they are moved.
+
+    """
+    columns = [row[1] for row in
+               connection.execute('PRAGMA table_info(users)')]
+    if 'automatic_deductions' not in columns:
+        return
+    table = StoredDeduction.__table__
+    for user_id, stored in connection.execute(
+            "SELECT user_id, automatic_deductions FROM users "
+            "WHERE automatic_deductions != ''").fetchall():
+        rows = []
+        for entry in stored.split(';'):
+            amount, separater, description = entry.partition(':')
+            if not separater:
+                continue
+            rows.append({'user_id': user_id, 'position': len(rows),
+                         'percentage_or_fixed': Account.FIXED,
+                         'amount': _format_db_amount(amount),
+                         'description': description})
+        if rows:
+            connection.execute(table.insert(), rows)
+    connection.execute("UPDATE users SET automatic_deductions = ''")
+
+def post_existing_transactions(bind):
+    """Post a LedgerEvent for every active transaction.
+
+    For databases whose transactions were written before the ledger
+    events were (or directly, like the benchmark ledgers).  Archived
+    transactions are posted as the deposits and withdrawals of their
+    checkpoints, on the last day the archive goes up to.
+
+    Keyword arguments:
+    bind -- Session or Connection of the database
+
+    """
+    bind.execute(text(
+        "INSERT INTO ledger_events (timestamp, user_id, kind, "
+        "transaction_id, account_id, date, action, amount) "
+        "SELECT timestamp, user_id, :kind, transaction_id, account_id, date, "
+        "action, amount FROM main.transactions WHERE status = 1 "
+        "ORDER BY transaction_id"), {'kind': LedgerEvent.POST})
+    for action, column in ((Transaction.DEPOSIT, 'deposits'),
+                           (Transaction.WITHDRAWAL, 'withdrawals')):
+        bind.execute(text(
+            "INSERT INTO ledger_events (timestamp, user_id, kind, account_id, "
+            "date, action, amount) "
+            "SELECT :now, user_id, :kind, account_id, "
+            "date(archived_through, '-1 day'), :action, %s FROM checkpoints "
+            "WHERE account_id IS NOT NULL AND %s != 0" % (column, column)),
+            {'now': datetime.datetime.now(), 'kind': LedgerEvent.POST,
+             'action': action})
+
+def _add_batch_column(connection):
+    """Tag the transactions with the batch that created them."""
+    databases = [row[1] for row in
+                 connection.execute('PRAGMA database_list')]
+    for database in ('main', 'archive'):
+        if database not in databases:
+            continue
+        columns = [row[1] for row in connection.execute(
+            'PRAGMA %s.table_info(transactions)' % database)]
+        if columns and 'batch_id' not in columns:
+            references = ''
+            if database == 'main':
+                references = ' REFERENCES batches(batch_id)'
+            connection.execute('ALTER TABLE %s.transactions ADD COLUMN '
+                               'batch_id INTEGER%s' % (database, references))
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_transactions_batch_id '
+                       'ON transactions (batch_id)')
+
+# Dictionary of schema version to the function that brings the data of
+# an older database up to it, after the new tables are created
+_migrations = {2: _move_deductions, 3: post_existing_transactions,
+               4: _add_batch_column}
+
+def verify_schema():
+    """Create the tables the database is missing and migrate its data.
+
+    The database records the schema version it has (SQLite's
+    user_version), so the tables are only checked when it is older
+    than the library's; otherwise this is a single PRAGMA.
+
+    Returns:
+    True if the tables were checked and created as needed
+
+    """
+    if engine is None:
+        configure()
+    connection = engine.connect()
+    try:
+        version = connection.execute('PRAGMA user_version').scalar()
+        if version >= schema_version:
+            return False
+        Base.metadata.create_all(connection)
+        transaction = connection.begin()
+        try:
+            for upgrade in range(version + 1, schema_version + 1):
+                if upgrade in _migrations:
+                    _migrations[upgrade](connection)
+            connection.execute('PRAGMA user_version = %d' % schema_version)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+    finally:
+        connection.close()
+    return True
+
 def initialize():
     """Initialize the library.
 
     This must be called by any user program before utilizing to ensure
-    that the database is established and a session is created.
+    that the database is established and a session is created.  The
+    library is configured with the defaults if configure has not been
+    called.
 
     Returns:
         Session object to access the database
 
     """
-
-    Base.metadata.create_all(engine)
+    verify_schema()
     global session    # Each instance can only have a single session
     session = Session()
     return session
@@ -862,8 +1297,17 @@ def filter_accounts(accounts, fixed=True, percentage=True, gross=None,
 
 def recalculate_account_totals(accounts):
     """Recalculate the account totals based on the transaction log.
+
+    Archived transactions are counted through their checkpoint.
     """
     amounts = [] # Set of tuples (Account, old total, new total)
+    archived = {}
+    if accounts:
+        for account_id, deposits, withdrawals in session.query(
+                Checkpoint._account, Checkpoint.deposits,
+                Checkpoint.withdrawals).\
+                filter(Checkpoint._account.in_([a.id for a in accounts])):
+            archived[account_id] = (deposits or 0) - (withdrawals or 0)
     for account in accounts:
         deposit_sum = session.query(func.sum(Transaction.amount).\
                                     label('deposit_sum')).\
@@ -880,7 +1324,8 @@ def recalculate_account_totals(accounts):
         if debug:
             print('Deposits: %s; Withdrawals: %s' % (deposit_sum, withdraw_sum))
         new_total = ((deposit_sum if deposit_sum is not None else 0) -
-                     (withdraw_sum if withdraw_sum is not None else 0))
+                     (withdraw_sum if withdraw_sum is not None else 0) +
+                     archived.get(account.id, 0))
         amounts.append((account, account.total, _format_out_amount(new_total)))
     return amounts
 
@@ -984,6 +1429,852 @@ def _harmless_require_reconfiguration(accounts, check_gross=True,
     return gross_reconfiguration, net_reconfiguration
 
 
+def period_of(date):
+    """Period number (year * 12 + month - 1) that a date falls in."""
+    return date.year * 12 + date.month - 1
+
+def period_label(period):
+    """Convert a period number into 'YYYY-MM'."""
+    return '%04d-%02d' % (period // 12, period % 12 + 1)
+
+def period_bounds(period):
+    """First and last datetime.date of a period."""
+    begin = datetime.date(period // 12, period % 12 + 1, 1)
+    following = period + 1
+    end = datetime.date(following // 12, following % 12 + 1, 1) - \
+          datetime.timedelta(days=1)
+    return begin, end
+
+def summarize_dates(session, user_id, begin, end, by_period=False):
+    """Aggregate a user's transaction log between two dates.
+
+    Transfers are the net of the transfers into and out of each account
+    and are not included in the deposits and withdrawals, as in a
+    PeriodSummary.
+
+    Keyword arguments:
+    session -- Session to query with
+    user_id -- ID of the user to aggregate
+    begin -- First datetime.date to include
+    end -- Last datetime.date to include
+    by_period -- Aggregate each period separately, still with one query
+        (default False)
+
+    Returns:
+    Dictionary of account ID (None for the whole account) to a list of
+    [deposits, withdrawals, deductions, transfers] in integer cents, or
+    of period number to such a dictionary when by_period
+
+    """
+    t = transactions_table(session, user_id, begin)
+    root = t.alias('root')
+    root_action = func.coalesce(root.c.action, '')
+    groups = [t.c.account_id, t.c.action, root_action]
+    if by_period:
+        groups.append(func.strftime('%Y-%m', t.c.date))
+    query = select(groups + [func.sum(t.c.amount)],
+                   and_(t.c.user_id == user_id,
+                        t.c.status == True,
+                        t.c.date >= begin,
+                        t.c.date <= end),
+                   from_obj=[t.outerjoin(root, t.c.root_transaction_id ==
+                                         root.c.transaction_id)]).\
+            group_by(*groups)
+    periods = {}
+    for row in session.execute(query):
+        account_id, action, parent_action = row[:3]
+        amount = row[len(groups)] or 0
+        if account_id is None and action != Transaction.DEDUCTION:
+            continue    # Whole account deposits and transfers are split up
+        if by_period:
+            year, month = row[3].split('-')
+            period = int(year) * 12 + int(month) - 1
+        else:
+            period = None
+        values = periods.setdefault(period, {}).setdefault(account_id,
+                                                           [0, 0, 0, 0])
+        if action == Transaction.DEDUCTION:
+            values[2] += amount
+        elif parent_action == Transaction.TRANSFER:
+            if action == Transaction.DEPOSIT:
+                values[3] += amount
+            elif action == Transaction.WITHDRAWAL:
+                values[3] -= amount
+        elif action == Transaction.DEPOSIT:
+            values[0] += amount
+        elif action == Transaction.WITHDRAWAL:
+            values[1] += amount
+    if by_period:
+        return periods
+    return periods.get(None, {})
+
+def _summarize_period(session, user_id, period):
+    """Aggregate a period of a user's transaction log.
+
+    Keyword arguments:
+    session -- Session to query with
+    user_id -- ID of the user to aggregate
+    period -- Period number to aggregate
+
+    Returns:
+    Dictionary of account ID (None for the whole account) to a list of
+    [deposits, withdrawals, deductions, transfers, closing balance]
+    in integer cents
+
+    """
+    begin, end = period_bounds(period)
+    summary = dict([(account_id, values + [0]) for account_id, values in
+                    summarize_dates(session, user_id, begin, end).items()])
+    t = transactions_table(session, user_id)
+    query = select([t.c.account_id, t.c.action, func.sum(t.c.amount)],
+                   and_(t.c.user_id == user_id,
+                        t.c.account_id != None,
+                        t.c.status == True,
+                        t.c.date <= end,
+                        t.c.action.in_([Transaction.DEPOSIT,
+                                        Transaction.WITHDRAWAL]))).\
+            group_by(t.c.account_id, t.c.action)
+    for account_id, action, amount in session.execute(query):
+        values = summary.setdefault(account_id, [0, 0, 0, 0, 0])
+        if action == Transaction.DEPOSIT:
+            values[4] += amount or 0
+        else:
+            values[4] -= amount or 0
+    return summary
+
+def close_period(session, user, period, today=None):
+    """Freeze the aggregates of a month that has ended.
+
+    Closing a period again (e.g., after it was re-opened) recomputes
+    only that period.  Any difference in its closing balances is
+    carried forward to the periods closed after it.
+
+    Keyword arguments:
+    session -- Session to use
+    user -- User to close the period for
+    period -- Period number to close
+    today -- datetime.date used to decide what has ended (default today)
+
+    """
+    if today is None:
+        today = datetime.date.today()
+    if period >= period_of(today):
+        raise ParameterException('Cannot close %s before it has ended' %
+                                 period_label(period))
+    s = PeriodSummary.__table__
+    summary = _summarize_period(session, user.id, period)
+    in_period = and_(s.c.user_id == user.id, s.c.period == period)
+    previous = dict(session.execute(select([s.c.account_id,
+                                            s.c.closing_balance],
+                                           in_period)).fetchall())
+    session.execute(s.delete().where(in_period))
+    if summary:
+        session.execute(s.insert(), [{'user_id': user.id,
+                                      'account_id': account_id,
+                                      'period': period,
+                                      'deposits': values[0],
+                                      'withdrawals': values[1],
+                                      'deductions': values[2],
+                                      'transfers': values[3],
+                                      'closing_balance': values[4]}
+                                     for account_id, values in summary.items()])
+    later = and_(s.c.user_id == user.id, s.c.period > period)
+    later_periods = None
+    for account_id in set(previous) | set(summary):
+        if account_id is None:
+            continue
+        difference = summary.get(account_id, [0] * 5)[4] - \
+                     (previous.get(account_id) or 0)
+        if not difference:
+            continue
+        session.execute(s.update().
+                        where(and_(later, s.c.account_id == account_id)).
+                        values(closing_balance=s.c.closing_balance +
+                               difference))
+        # An account whose first transaction is in this period has no
+        # summaries in the later periods to carry its balance in
+        if later_periods is None:
+            later_periods = set([row[0] for row in session.execute(
+                select([s.c.period], later).distinct())])
+        carried = set([row[0] for row in session.execute(
+            select([s.c.period], and_(later, s.c.account_id == account_id)))])
+        missing = later_periods - carried
+        if missing:
+            session.execute(s.insert(), [{'user_id': user.id,
+                                          'account_id': account_id,
+                                          'period': missing_period,
+                                          'deposits': 0,
+                                          'withdrawals': 0,
+                                          'deductions': 0,
+                                          'transfers': 0,
+                                          'closing_balance': difference}
+                                         for missing_period in missing])
+    try:
+        closed = session.query(Period).filter(Period.user == user).\
+                 filter(Period.period == period).one()
+    except NoResultFound:
+        closed = Period(user, period)
+        session.add(closed)
+    closed.close()
+    return closed
+
+def close_periods(session, user, reopened_only=False, today=None):
+    """Close every month that has ended but is not closed.
+
+    Keyword arguments:
+    session -- Session to use
+    user -- User to close the periods for
+    reopened_only -- Only recompute the periods that were closed and
+        have been re-opened (default False)
+    today -- datetime.date used to decide what has ended (default today)
+
+    Returns:
+    List of the period numbers that were closed
+
+    """
+    if today is None:
+        today = datetime.date.today()
+    closed = session.query(Period).filter(Period.user == user).all()
+    if reopened_only:
+        periods = [p.period for p in closed if not p.status]
+    else:
+        first = session.query(func.min(Transaction.date)).\
+                filter(Transaction.user == user).scalar()
+        if first is None:
+            return []
+        already = set([p.period for p in closed if p.status])
+        periods = [p for p in range(period_of(first), period_of(today))
+                   if p not in already]
+    periods.sort()
+    for period in periods:
+        close_period(session, user, period, today)
+    return periods
+
+def closed_summaries(session, user, first, last):
+    """Frozen aggregates of the closed periods in a range, with one query.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User to summarize
+    first -- First period number
+    last -- Last period number
+
+    Returns:
+    Dictionary of the closed period numbers to {account ID: [deposits,
+    withdrawals, deductions, transfers, closing balance]} in integer
+    cents
+
+    """
+    p = Period.__table__
+    s = PeriodSummary.__table__
+    closed = set([period for (period,) in session.execute(
+        select([p.c.period], and_(p.c.user_id == user.id,
+                                  p.c.status == True,
+                                  p.c.period >= first,
+                                  p.c.period <= last)))])
+    stored = dict([(period, {}) for period in closed])
+    if closed:
+        for row in session.execute(select([s], and_(s.c.user_id == user.id,
+                                                     s.c.period >= first,
+                                                     s.c.period <= last))):
+            if row['period'] in closed:
+                stored[row['period']][row['account_id']] = \
+                    [row['deposits'], row['withdrawals'], row['deductions'],
+                     row['transfers'], row['closing_balance']]
+    return stored
+
+def summarize_range(session, user, begin, end):
+    """Aggregates of each account between two dates.
+
+    The whole months of the range that are closed are read from their
+    summaries, so only the rest of it (usually the open months after
+    the last closed one) is aggregated from the transaction log.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User to summarize
+    begin -- First datetime.date to include
+    end -- Last datetime.date to include
+
+    Returns:
+    Dictionary of account ID (None for the whole account) to a list of
+    [deposits, withdrawals, deductions, transfers] in integer cents
+
+    """
+    first = period_of(begin)
+    if begin > period_bounds(first)[0]:
+        first += 1    # Part of a month is never read from its summary
+    last = period_of(end)
+    if end < period_bounds(last)[1]:
+        last -= 1
+    stored = {}
+    if first <= last:
+        stored = closed_summaries(session, user, first, last)
+    summary = {}
+    day = datetime.timedelta(days=1)
+    start = begin
+    for period in sorted(stored):
+        period_begin, period_end = period_bounds(period)
+        if start < period_begin:
+            _add_summary(summary, summarize_dates(session, user.id, start,
+                                                  period_begin - day))
+        _add_summary(summary, stored[period])
+        start = period_end + day
+    if start <= end:
+        _add_summary(summary, summarize_dates(session, user.id, start, end))
+    return summary
+
+def _add_summary(summary, accounts):
+    """Add the deposits, withdrawals, deductions and transfers of each
+    account to a summary."""
+    for account_id, values in accounts.items():
+        totals = summary.setdefault(account_id, [0, 0, 0, 0])
+        for index in range(4):
+            totals[index] += values[index]
+
+def period_summaries(session, user, first, last):
+    """Aggregates of each account for a range of periods.
+
+    Closed periods are read from their summaries, all with one query.
+    Any other period is aggregated from the transaction log.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User to summarize
+    first -- First period number
+    last -- Last period number
+
+    Returns:
+    List of (period label, closed, {account ID: [deposits, withdrawals,
+    deductions, transfers, closing balance]}) tuples in integer cents
+
+    """
+    if first > last:
+        raise ParameterException('First period is after the last')
+    stored = closed_summaries(session, user, first, last)
+    summaries = []
+    for period in range(first, last + 1):
+        if period in stored:
+            summaries.append((period_label(period), True, stored[period]))
+        else:
+            summaries.append((period_label(period), False,
+                              _summarize_period(session, user.id, period)))
+    return summaries
+
+def _reopen_periods(session, flush_context):
+    """Re-open the closed periods that flushed transactions fall in."""
+    current = period_of(datetime.date.today())
+    touched = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Transaction):
+            added, unchanged, deleted = get_history(obj, 'date')
+            for date in list(added or ()) + list(unchanged or ()) + \
+                        list(deleted or ()):
+                # The current month cannot have been closed yet
+                if date is not None and period_of(date) < current:
+                    touched.add((obj._user, period_of(date)))
+    p = Period.__table__
+    for user_id, period in touched:
+        session.execute(p.update().where(and_(p.c.user_id == user_id,
+                                              p.c.period == period,
+                                              p.c.status == True)).
+                        values(status=False))
+
+event.listen(Session, 'after_flush', _reopen_periods)
+
+# Number of commits that have changed each user's transactions or
+# accounts so that anything derived from them can be cached against it
+# Dictionary of user ID to version
+_ledger_versions = {}
+
+def ledger_version(user_id):
+    """Version of a user's transaction log.
+
+    The version goes up with every commit that changes one of the
+    user's transactions or accounts (e.g., their totals), so a cached
+    result is still valid as long as the version it was computed at
+    is the current one.
+
+    """
+    return _ledger_versions.get(user_id, 0)
+
+def bump_ledger_version(user_id):
+    """Mark a user's transaction log as changed outside of the ORM."""
+    _ledger_versions[user_id] = ledger_version(user_id) + 1
+
+def _note_ledger_changes(session, flush_context):
+    """Remember whose transactions were flushed until the commit."""
+    changed = getattr(session, '_ledger_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Transaction, Account)) and obj._user is not None:
+            changed.add(obj._user)
+    session._ledger_changes = changed
+
+def _commit_ledger_changes(session):
+    for user_id in getattr(session, '_ledger_changes', ()):
+        bump_ledger_version(user_id)
+    session._ledger_changes = set()
+
+def _discard_ledger_changes(session):
+    session._ledger_changes = set()
+
+event.listen(Session, 'after_flush', _note_ledger_changes)
+event.listen(Session, 'after_commit', _commit_ledger_changes)
+event.listen(Session, 'after_rollback', _discard_ledger_changes)
+
+# Account settings whose changes are RECONFIGURE events
+_configuration = ('percentage_or_fixed', '_transaction_amount',
+                  'affect_gross', 'status')
+
+def _record_ledger_events(session, flush_context):
+    """Append a LedgerEvent for each change the flush made to the ledger.
+    """
+    now = datetime.datetime.now()
+    events = []
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Transaction):
+            if obj in session.new:
+                if not obj._status:
+                    continue
+                kind = LedgerEvent.POST
+            else:
+                added, unchanged, deleted = get_history(obj, '_status')
+                if not added or (deleted and
+                                 bool(added[0]) == bool(deleted[0])):
+                    continue
+                if added[0]:
+                    kind = LedgerEvent.POST
+                else:
+                    kind = LedgerEvent.REVERSE
+            events.append({'timestamp': now, 'user_id': obj._user,
+                           'kind': kind, 'transaction_id': obj.id,
+                           'account_id': obj._account, 'date': obj.date,
+                           'action': obj.action, 'amount': obj._amount or 0,
+                           'detail': None})
+        elif isinstance(obj, Account):
+            if obj not in session.new and not \
+                   [name for name in _configuration
+                    if get_history(obj, name).has_changes()]:
+                continue
+            events.append({'timestamp': now, 'user_id': obj._user,
+                           'kind': LedgerEvent.RECONFIGURE,
+                           'transaction_id': None, 'account_id': obj.id,
+                           'date': None, 'action': None, 'amount': 0,
+                           'detail': '%s %s %s %s' % (
+                               obj.percentage_or_fixed,
+                               obj._transaction_amount,
+                               'gross' if obj.affect_gross else 'net',
+                               'active' if obj.status else 'inactive')})
+    if events:
+        session.execute(LedgerEvent.__table__.insert(), events)
+
+event.listen(Session, 'after_flush', _record_ledger_events)
+
+@contextmanager
+def batch(session, user, description=None):
+    """Tag every transaction made in a block with a new Batch.
+
+        with budse.batch(session, user, 'Bank import') as imported:
+            ...
+
+    The transactions are flushed at the end of the block, so that they
+    are tagged; nothing is committed.  Those made before the block are
+    tagged with Batch.add.
+
+    Keyword arguments:
+    session -- Session the transactions are made in
+    user -- User the batch belongs to
+    description -- What the batch is (default None)
+
+    """
+    made = Batch(user, description)
+    session.add(made)
+    previous = getattr(session, '_batch', None)
+    session._batch = made
+    try:
+        yield made
+        session.flush()
+    finally:
+        session._batch = previous
+
+def _tag_batch(session, flush_context, instances):
+    made = getattr(session, '_batch', None)
+    if made is None:
+        return
+    for obj in session.new:
+        if isinstance(obj, Transaction) and obj.batch is None:
+            obj.batch = made
+
+event.listen(Session, 'before_flush', _tag_batch)
+
+def batches(session, user):
+    """A user's batches with how many transactions each made.
+
+    Returns:
+    List of (Batch, transactions, active transactions) tuples, newest
+    first
+
+    """
+    active = func.sum(case([(Transaction._status == True, 1)], else_=0))
+    return [(made, count or 0, active_count or 0)
+            for made, count, active_count in
+            session.query(Batch, func.count(Transaction.id), active).\
+            outerjoin(Transaction, Transaction._batch == Batch.id).\
+            filter(Batch._user == user.id).\
+            group_by(Batch.id).order_by(desc(Batch.id))]
+
+def batch_changes(session, made):
+    """What the active transactions of a batch did to each account.
+
+    Returns:
+    Dictionary of account ID to the net change of its total in integer
+    cents
+
+    """
+    t = Transaction.__table__
+    change = func.sum(case([(t.c.action == Transaction.DEPOSIT, t.c.amount),
+                            (t.c.action == Transaction.WITHDRAWAL,
+                             -t.c.amount)], else_=0))
+    return dict(session.execute(
+        select([t.c.account_id, change],
+               and_(t.c.batch_id == made.id, t.c.status == True,
+                    t.c.account_id != None)).group_by(t.c.account_id)).\
+        fetchall())
+
+def rollback_batch(session, made):
+    """Reverse every transaction of a batch (see reverse_transactions).
+
+    Nothing is committed.
+
+    Returns:
+    Number of transactions reversed
+
+    """
+    count = reverse_transactions(session, made.user, batch=made.id)
+    made.status = False
+    return count
+
+# Flushes (the inserts and updates) and commits are timed as spans
+# between the session events around them
+def _begin_flush(session, flush_context, instances):
+    session._flush_span = tracing.begin('flush', new=len(session.new),
+                                        dirty=len(session.dirty))
+
+def _finish_flush(session, flush_context):
+    tracing.finish(getattr(session, '_flush_span', None))
+    session._flush_span = None
+
+def _begin_commit(session):
+    session._commit_span = tracing.begin('commit')
+
+def _finish_commit(session):
+    tracing.finish(getattr(session, '_commit_span', None))
+    session._commit_span = None
+
+def _abandon_spans(session):
+    for name in ('_flush_span', '_commit_span'):
+        tracing.finish(getattr(session, name, None), 'rollback')
+        setattr(session, name, None)
+
+event.listen(Session, 'before_flush', _begin_flush)
+event.listen(Session, 'after_flush_postexec', _finish_flush)
+event.listen(Session, 'before_commit', _begin_commit)
+event.listen(Session, 'after_commit', _finish_commit)
+event.listen(Session, 'after_rollback', _abandon_spans)
+
+# Dictionary of user ID to the datetime.date the archive goes up to
+_archived_through = {}
+
+def archived_through(session, user_id):
+    """Date that a user's transactions are archived up to (exclusive).
+
+    Returns:
+    datetime.date or None if nothing has been archived
+
+    """
+    if user_id not in _archived_through:
+        _archived_through[user_id] = session.query(
+            func.max(Checkpoint.archived_through)).\
+            filter(Checkpoint._user == user_id).scalar()
+    return _archived_through[user_id]
+
+def _archive_needed(session, user_id, begin_date):
+    through = archived_through(session, user_id)
+    return through is not None and (begin_date is None or
+                                    begin_date < through)
+
+def _archive_table():
+    """The transactions table of the attached archive database."""
+    t = Transaction.__table__
+    return Table(t.name, MetaData(), schema='archive',
+                 *[Column(c.name, c.type) for c in t.c])
+
+def transactions_table(session, user_id, begin_date=None):
+    """Transaction log to select from for a range of dates.
+
+    Core queries that use the result in place of Transaction.__table__
+    only read the archive when the range reaches back into it.
+
+    Keyword arguments:
+    session -- Session to query with
+    user_id -- ID of the user whose transactions are wanted
+    begin_date -- Earliest datetime.date needed (default None for all)
+
+    Returns:
+    The transactions table, or an alias of it and the archive combined
+
+    """
+    t = Transaction.__table__
+    if not _archive_needed(session, user_id, begin_date):
+        return t
+    a = _archive_table()
+    return union_all(select([t], t.c.user_id == user_id),
+                     select([a], a.c.user_id == user_id)).alias(t.name)
+
+def query_transactions(session, user_id, criteria, begin_date=None,
+                       descending=True, limit=None, order_by=None):
+    """Transactions matching criteria, from the archive when needed.
+
+    Keyword arguments:
+    session -- Session to query with
+    user_id -- ID of the user whose transactions are wanted
+    criteria -- List of clauses on the Transaction columns
+    begin_date -- Earliest datetime.date needed (default None for all)
+    descending -- Order by the newest date first (default True)
+    limit -- Maximum number of transactions (default None)
+    order_by -- List of expressions on the Transaction columns to sort
+        by (default None for the date)
+
+    Returns:
+    Query of Transaction objects, or a list when the archive is used
+
+    """
+    direction = desc if descending else asc
+    keys = order_by or [Transaction.date]
+    if not _archive_needed(session, user_id, begin_date):
+        query = session.query(Transaction).filter(and_(*criteria)).\
+                order_by(*[direction(key) for key in keys])
+        return query.limit(limit) if limit is not None else query
+    t = Transaction.__table__
+    archive = _archive_table()
+    where = and_(*criteria)
+    def to_archive(element):
+        if isinstance(element, Column) and element.table is t:
+            return archive.c[element.name]
+    # Each tier selects the sort keys under the same names, which the
+    # combined rows are ordered by
+    keys = [expression.__clause_element__()
+            if hasattr(expression, '__clause_element__') else expression
+            for expression in keys]
+    names = ['sort_%d' % i for i in range(len(keys))]
+    statement = union_all(
+        select([t] + [key.label(name) for key, name in zip(keys, names)],
+               where),
+        select([archive] +
+               [replacement_traverse(key, {}, to_archive).label(name)
+                for key, name in zip(keys, names)],
+               replacement_traverse(where, {}, to_archive))).\
+        order_by(*[direction(literal_column(name)) for name in names])
+    if limit is not None:
+        statement = statement.limit(limit)
+    transactions = session.query(Transaction).from_statement(statement).all()
+    # Archived children have to be loaded from the archive as well
+    roots = [tr.id for tr in transactions if tr._parent is None]
+    if roots:
+        children = {}
+        # As text the rows are matched to the mapper by column name
+        # rather than by the columns of the main table
+        typemap = dict([(c.name, c.type) for c in Transaction.__table__.c])
+        for child in session.query(Transaction).from_statement(text(
+                'SELECT * FROM archive.transactions WHERE '
+                'root_transaction_id IN (%s)' %
+                ', '.join([str(int(id)) for id in roots]),
+                typemap=typemap)):
+            children.setdefault(child._parent, []).append(child)
+        for tr in transactions:
+            if tr.id in children:
+                set_committed_value(tr, 'children', children[tr.id])
+    return transactions
+
+def reverse_transactions(session, user, ids=None, begin=None, end=None,
+                         batch=None):
+    """Reverse many transaction groups at once.
+
+    The groups are picked by the IDs of any of their transactions, a
+    date range and/or a Batch ID, and only their active transactions are
+    reversed.  Rather than toggling each through Transaction.status,
+    the statuses are flipped with one UPDATE, each account's total
+    changes by the net of its reversed transactions in one UPDATE, and
+    the REVERSE ledger events are appended with one INSERT.  Closed
+    periods the transactions fall in are re-opened.  Nothing is
+    committed.
+
+    Keyword arguments:
+    session -- Session to use
+    user -- User whose transactions are reversed
+    ids -- List of transaction IDs (default None)
+    begin -- datetime.date of the first day to reverse (default None)
+    end -- datetime.date of the last day to reverse (default None)
+    batch -- ID of the Batch to reverse (default None)
+
+    Returns:
+    Number of transactions reversed
+
+    """
+    if not ids and begin is None and end is None and batch is None:
+        raise ParameterException('No transactions to reverse')
+    if begin is not None and end is not None and begin > end:
+        raise ParameterException('The range begins after it ends')
+    session.flush()
+    t = Transaction.__table__
+    match = t.alias('matching')
+    criteria = [match.c.user_id == user.id]
+    if ids:
+        criteria.append(match.c.transaction_id.in_(ids))
+    if begin is not None:
+        criteria.append(match.c.date >= begin)
+    if end is not None:
+        criteria.append(match.c.date <= end)
+    if batch is not None:
+        criteria.append(match.c.batch_id == batch)
+    roots = select([func.coalesce(match.c.root_transaction_id,
+                                  match.c.transaction_id)], and_(*criteria))
+    reversing = and_(t.c.user_id == user.id, t.c.status == True,
+                     or_(t.c.transaction_id.in_(roots),
+                         t.c.root_transaction_id.in_(roots)))
+
+    change = func.sum(case([(t.c.action == Transaction.DEPOSIT, t.c.amount),
+                            (t.c.action == Transaction.WITHDRAWAL,
+                             -t.c.amount)], else_=0))
+    changes = session.execute(select([t.c.account_id, change],
+                                     and_(reversing, t.c.account_id != None)).\
+                              group_by(t.c.account_id)).fetchall()
+    current = period_of(datetime.date.today())
+    periods = set()
+    for (date,) in session.execute(select([t.c.date], reversing).distinct()):
+        if period_of(date) < current:
+            periods.add(period_of(date))
+    e = LedgerEvent.__table__
+    session.execute(e.insert().from_select(
+        ['timestamp', 'user_id', 'kind', 'transaction_id', 'account_id',
+         'date', 'action', 'amount'],
+        select([literal(datetime.datetime.now(), DateTime), t.c.user_id,
+                literal(LedgerEvent.REVERSE), t.c.transaction_id,
+                t.c.account_id, t.c.date, t.c.action, t.c.amount],
+               reversing).order_by(t.c.transaction_id)))
+    count = session.execute(t.update().where(reversing).
+                            values(status=False)).rowcount
+    a = Account.__table__
+    for account_id, amount in changes:
+        if amount:
+            session.execute(a.update().where(a.c.account_id == account_id).
+                            values(account_total=a.c.account_total - amount))
+    p = Period.__table__
+    for period in periods:
+        session.execute(p.update().where(and_(p.c.user_id == user.id,
+                                              p.c.period == period,
+                                              p.c.status == True)).
+                        values(status=False))
+    for obj in session.identity_map.values():
+        if isinstance(obj, Transaction):
+            session.expire(obj, ['_status'])
+        elif isinstance(obj, Account):
+            session.expire(obj, ['_total'])
+    # The rows were changed with SQL, which the ORM events do not see
+    bump_ledger_version(user.id)
+    return count
+
+def archive_transactions(session, user, cutoff):
+    """Move a user's settled transactions into the archive database.
+
+    A transaction is settled when it and all of its sub-transactions
+    are dated before the cutoff, which cannot be later than the start
+    of the current month.  The months being archived are closed first
+    and the archived amounts are kept as a Checkpoint of each account.
+    The session is committed.
+
+    Keyword arguments:
+    session -- Session to use
+    user -- User whose transactions are archived
+    cutoff -- datetime.date to archive the transactions before
+
+    Returns:
+    Number of transactions archived
+
+    """
+    if cutoff > period_bounds(period_of(datetime.date.today()))[0]:
+        raise ParameterException('Only months that have ended can be archived')
+    close_periods(session, user)
+    session.commit()
+    if not os.path.exists(archive_file):
+        # The engine attaches it to every connection from now on
+        create_archive = Table('transactions', MetaData(), schema='archive',
+                               *[Column(c.name, c.type, index=(c.name in
+                                                               ('date',
+                                                                'user_id')))
+                                 for c in Transaction.__table__.c])
+        connection = engine.connect()
+        connection.execute('ATTACH DATABASE ? AS archive', (archive_file,))
+        create_archive.create(connection)
+        connection.close()
+        engine.dispose()
+    params = {'user': user.id, 'cutoff': cutoff}
+    # Never move the newest transaction, so that its ID is not reused on
+    # a database created without AUTOINCREMENT
+    roots = ('SELECT transaction_id FROM main.transactions '
+             'WHERE user_id = :user AND root_transaction_id IS NULL '
+             'AND date < :cutoff AND transaction_id < '
+             '(SELECT MAX(transaction_id) FROM main.transactions)')
+    # Fix the set of rows first: a subquery on main.transactions would be
+    # re-evaluated by the DELETE and miss sub-transactions of deleted roots
+    session.execute('DROP TABLE IF EXISTS temp.archive_moving')
+    session.execute(text('CREATE TEMP TABLE archive_moving AS '
+                         'SELECT transaction_id FROM main.transactions '
+                         'WHERE transaction_id IN (%s) OR '
+                         'root_transaction_id IN (%s)' % (roots, roots)),
+                    params)
+    moving = ('main.transactions WHERE transaction_id IN '
+              '(SELECT transaction_id FROM temp.archive_moving)')
+    sums = {}
+    for account_id, action, amount in session.execute(text(
+            'SELECT account_id, action, SUM(amount) FROM %s AND status = 1 '
+            'AND account_id IS NOT NULL GROUP BY account_id, action' %
+            moving), params):
+        deposits, withdrawals = sums.get(account_id, (0, 0))
+        if action == Transaction.DEPOSIT:
+            deposits += amount or 0
+        elif action == Transaction.WITHDRAWAL:
+            withdrawals += amount or 0
+        sums[account_id] = (deposits, withdrawals)
+    count = session.execute(text('INSERT INTO archive.transactions '
+                                 'SELECT * FROM %s' % moving), params).rowcount
+    session.execute(text('DELETE FROM %s' % moving), params)
+    session.execute('DROP TABLE temp.archive_moving')
+    checkpoints = {}
+    for checkpoint in session.query(Checkpoint).\
+            filter(Checkpoint._user == user.id):
+        checkpoints[checkpoint._account] = checkpoint
+    for account_id in [None] + sums.keys():
+        if account_id not in checkpoints:
+            checkpoints[account_id] = Checkpoint(_user=user.id,
+                                                 _account=account_id,
+                                                 deposits=0, withdrawals=0)
+            session.add(checkpoints[account_id])
+        deposits, withdrawals = sums.get(account_id, (0, 0))
+        checkpoint = checkpoints[account_id]
+        checkpoint.deposits += deposits
+        checkpoint.withdrawals += withdrawals
+        if checkpoint.archived_through is None or \
+               checkpoint.archived_through < cutoff:
+            checkpoint.archived_through = cutoff
+    session.commit()
+    session.expire_all()
+    _archived_through[user.id] = max(cutoff, _archived_through.get(user.id)
+                                     or cutoff)
+    # The rows were moved with SQL, which the ORM events do not see
+    bump_ledger_version(user.id)
+    return count
+
 def _format_db_amount(amount):
     return int(round(float(amount) * 100))
 
@@ -1028,6 +2319,15 @@ class DuplicateException(BudseException):
     def __str__(self):
         return str(self.expression)
 
+class QueryBudgetException(BudseException):
+    """More queries were run than an operation is allowed."""
+    def __init__(self, expression, stats):
+        self.expression = expression
+        self.stats = stats
+
+    def __str__(self):
+        return str(self.expression)
+
 class MetaException(BudseException):
     """Exception raised for meta actions in the input.
     """
@@ -22,9 +22,19 @@
 ############################
 
 from __future__ import with_statement
+import analytics
+import balances
 import budse
+import forecast
+import instrument
+import ledger
+import searchcache
+import tracing
+import variance
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy import desc, or_, and_
+from contextlib import contextmanager
+import atexit
 import datetime
 import os
 import random
@@ -40,6 +50,7 @@ class BudseCLI(object):
         self.session = session
         self.user = user
         self._status = []
+        self.search_cache = searchcache.SearchCache()
         
     def _handle_input(self, prompt, base_type=str):
         """Take all input, passing back errors as appropriate.
@@ -229,33 +240,70 @@ class BudseCLI(object):
         Returns:
         A list Transaction objects
 
+        """
+        search = self._ask_search()
+        if search is None:
+            return None
+        return self._find_transactions(*search[1:])
+
+    def output_search(self):
+        """Search the database and output the matching transactions.
+
+        The output of recent searches is cached until the user's
+        transactions change, so going back and forth between the same
+        searches neither queries nor formats the transactions again.
+
+        """
+        search = self._ask_search()
+        if search is None:
+            return
+        key = search[0]
+        output = self.search_cache.get(key)
+        if output is None:
+            version = budse.ledger_version(self.user.id)
+            transactions = self._find_transactions(*search[1:])
+            with tracing.span('render'):
+                output = self.format_transactions(transactions)
+            self.search_cache.put(key, output, version)
+        print(output)
+
+    def _ask_search(self):
+        """Ask for the criteria of a search.
+
+        Returns:
+        (cache key, list of criteria, earliest date searched, limit,
+        whether a single transaction is wanted), or None when there is
+        no search
+
         """
         choice = self._ask_string('Search\n\n1 - Date Range\n2 - Date\n3 - '
                                   'ID\n4 - Keywords\n5 - Amount\n%s\n\n'
                                   'Choice: ' % BudseCLI.meta_actions)
-        limit = 10
+        limit = None
+        begin_date = None
         if choice == '1':
             begin_date = self._ask_date(prompt='Start of transactions')
             end_date = self._ask_date(prompt='End of transactions')
-            return self.session.query(budse.Transaction).\
-                filter(budse.Transaction.date >= begin_date).\
-                filter(budse.Transaction.date <= end_date).\
-                filter(budse.Transaction.parent == None).\
-                order_by(desc(budse.Transaction.date))
+            key = searchcache.search_key(self.user.id, begin_date=begin_date,
+                                         end_date=end_date)
+            criteria = [budse.Transaction.date >= begin_date,
+                        budse.Transaction.date <= end_date,
+                        budse.Transaction.parent == None]
         elif choice == '2':
-            date = self._ask_date(prompt='Transaction date')
-            return self.session.query(budse.Transaction).\
-                filter(budse.Transaction.date == date).\
-                filter(budse.Transaction.parent == None).\
-                order_by(desc(budse.Transaction.date))
+            begin_date = self._ask_date(prompt='Transaction date')
+            # Same transactions as a date range of a single day
+            key = searchcache.search_key(self.user.id, begin_date=begin_date,
+                                         end_date=begin_date)
+            criteria = [budse.Transaction.date == begin_date,
+                        budse.Transaction.parent == None]
         elif choice == '3':
             id = self._ask_amount('Unique ID of transaction: ', int)
-            try:
-                return [self.session.query(budse.Transaction).\
-                        filter(budse.Transaction.id == id).\
-                        filter(budse.Transaction.parent == None).one()]
-            except NoResultFound:
-                return None
+            # Archived transactions keep their IDs, so check both
+            limit = 1
+            key = searchcache.search_key(self.user.id, None, None, None, None,
+                                         limit, 'id', id)
+            criteria = [budse.Transaction.id == id,
+                        budse.Transaction.parent == None]
         elif choice == '4':
             done = False
             print 'Transaction description matching all of the keywords:\n'
@@ -263,19 +311,44 @@ class BudseCLI(object):
             while not done:
                 keywords.append('%%%s%%' % self._ask_string('Keyword: '))
                 done = self._confirm('Done entering keywords?', True)
+            limit = 10
             if self._confirm('Limit transactions to search for?'):
                 limit = self._ask_amount(type=int, prompt='Limit: ')
-            return self.session.query(budse.Transaction).\
-                filter(budse.Transaction.parent == None).\
-                filter(and_(*[budse.Transaction.description.contains(keyword) \
-                                 for keyword in keywords])).\
-                order_by(desc(budse.Transaction.date))[:limit]
+            key = searchcache.search_key(self.user.id, keywords=[keywords],
+                                         limit=limit)
+            criteria = [budse.Transaction.parent == None] + \
+                       [budse.Transaction.description.contains(keyword)
+                        for keyword in keywords]
         elif choice == '5':
             amount = self._ask_amount('Amount of transaction: ')
             amount = budse._format_db_amount(amount)
-            return self.session.query(budse.Transaction).\
-                filter(budse.Transaction.amount == amount).\
-                order_by(desc(budse.Transaction.date))[:5]
+            limit = 5
+            key = searchcache.search_key(self.user.id, None, None, None, None,
+                                         limit, 'amount', amount)
+            criteria = [budse.Transaction.amount == amount]
+        else:
+            return None
+        return (key, criteria, begin_date, limit, choice == '3')
+
+    def _find_transactions(self, criteria, begin_date, limit, single):
+        """Transactions matching the criteria of a search.
+
+        Keyword arguments:
+        criteria -- List of clauses on the Transaction columns
+        begin_date -- Earliest datetime.date searched
+        limit -- Maximum number of transactions
+        single -- Whether a single transaction is wanted
+
+        Returns:
+        A list of Transaction objects, or None when a single transaction
+        is wanted and was not found
+
+        """
+        transactions = list(budse.query_transactions(self.session,
+            self.user.id, criteria, begin_date, limit=limit))
+        if single:
+            return transactions or None
+        return transactions
         
     def output_transactions(self, transactions, pre='', breaks='', post=''):
         """Output a list of transactions.
@@ -286,20 +359,36 @@ class BudseCLI(object):
         breaks -- Output in between transactions
         post -- Output after the transactions
         
+        """
+        with tracing.span('render'):
+            print(self.format_transactions(transactions, pre, breaks, post))
+
+    def format_transactions(self, transactions, pre='', breaks='', post=''):
+        """Format a list of transactions for output.
+
+        Keyword arguments:
+        transactions -- List of Transaction objects to format
+        pre -- Output before the transactions
+        breaks -- Output in between transactions
+        post -- Output after the transactions
+
+        Returns:
+        The lines of the output as a string
+
         """
         # Tags to not print in children transactions
         restricted = ['ACTIVE', 'TRANSACTION DATE']
-        print(pre)
+        lines = [pre]
         try:
             for parent_transaction in transactions:
                 if parent_transaction.id is not None:
-                    print('------Transaction ID: %d------' %
-                          parent_transaction.id)
-                print((str(parent_transaction).\
-                       replace(budse.str_delimiter, '\n')).\
-                      replace(budse.tag_delimiter, ':'))
+                    lines.append('------Transaction ID: %d------' %
+                                 parent_transaction.id)
+                lines.append((str(parent_transaction).\
+                              replace(budse.str_delimiter, '\n')).\
+                             replace(budse.tag_delimiter, ':'))
                 if parent_transaction.children:
-                    print('Sub-transactions:')
+                    lines.append('Sub-transactions:')
                 for transaction in parent_transaction.children:
                     action = amount = account = description = ''
                     for field in str(transaction).split(budse.str_delimiter):
@@ -316,11 +405,13 @@ class BudseCLI(object):
                             description = ' (%s)' % info
                         elif tag == 'ACCOUNT':
                             account = ' into %s' % info
-                    print('    %s%s%s%s' % (action, amount, account, description))
-                print(breaks)
+                    lines.append('    %s%s%s%s' % (action, amount, account,
+                                                   description))
+                lines.append(breaks)
         except TypeError:
             pass
-        print(post)
+        lines.append(post)
+        return '\n'.join(lines)
 
     def ask_deduction_list(self, prompt='Provide a list of deductions to make'):
         """Prompt the user for their list of deductions
@@ -409,10 +500,7 @@ class BudseCLI(object):
             if self._confirm('Do you have deductions to make on the gross '
                              'amount of the deposit?'):
                 if self._confirm('Use stored deductions?'):
-                    deduction_tuples = self.user.deductions
-                    #TODO load from self.user.deductions instead of assigning
-                    #     them?  maybe change ask_deduction_list to 
-                    #     (optionally) take an initialized deduction list
+                    deduction_tuples = self.user.deductions_for(amount)
                 else:
                     deduction_tuples = self.ask_deduction_list()
                 if deduction_tuples is not None:
@@ -590,7 +678,34 @@ class BudseCLI(object):
             return
     
     def reverse_transaction(self):
-        """Undo whatever effect a transaction group had."""
+        """Undo whatever effect a transaction group (or many) had."""
+        prompt = ('Undo:\n1 - A transaction\n2 - A list of transactions\n'
+                  '3 - Every transaction in a date range\n'
+                  '4 - Every transaction of a batch (e.g., an import)\n'
+                  '%s\n\nChoice: ' % BudseCLI.meta_actions)
+        choice = self._ask_string(prompt)
+        if choice == '2':
+            ids = []
+            for id in self._ask_string('Transaction IDs (separated by '
+                                       'commas): ').split(','):
+                try:
+                    ids.append(int(id))
+                except ValueError:
+                    self.status = 'Invalid ID - %s' % id.strip()
+                    return
+            self._reverse_transactions(ids=ids)
+            return
+        elif choice == '3':
+            begin = self._ask_date(prompt='Start of transactions')
+            end = self._ask_date(prompt='End of transactions')
+            self._reverse_transactions(begin=begin, end=end)
+            return
+        elif choice == '4':
+            self._rollback_batch()
+            return
+        elif choice != '1':
+            self.status = 'Invalid choice - %s' % random.choice(budse.fun)
+            return
         id = self._ask_amount('Transaction ID: ', int)
         try:
             transaction = self.session.query(budse.Transaction).\
@@ -605,9 +720,72 @@ class BudseCLI(object):
             transaction.status = not transaction.status
             app.status = 'Transaction %d reversed' % id
             self.session.commit()
+            # A reversal into a closed month re-opens it
+            if budse.close_periods(self.session, self.user,
+                                   reopened_only=True):
+                self.session.commit()
         else:
             app.status = 'Transaction %d not reversed' % id
 
+    def _reverse_transactions(self, **criteria):
+        """Reverse the active transaction groups matching the criteria of
+        budse.reverse_transactions all at once."""
+        if not self._confirm('Reverse every active transaction of the '
+                             'matching groups? ', default=False):
+            self.status = 'Transactions not reversed'
+            return
+        try:
+            count = budse.reverse_transactions(self.session, self.user,
+                                               **criteria)
+        except budse.ParameterException, e:
+            self.session.rollback()
+            self.status = str(e)
+            return
+        self.session.commit()
+        variance.invalidate(self.user.id)
+        # A reversal into a closed month re-opens it
+        if budse.close_periods(self.session, self.user, reopened_only=True):
+            self.session.commit()
+        self.status = '%d transaction%s reversed' % (count,
+                                                     's' if count != 1 else '')
+
+    def _rollback_batch(self):
+        """Reverse everything a batch of the user made."""
+        made = budse.batches(self.session, self.user)
+        if not made:
+            self.status = 'There are no batches'
+            return
+        clear_screen()
+        print('Batches\n')
+        for batch, count, active in made:
+            print('%d - %s %s (%d transactions, %d active)%s' %
+                  (batch.id, batch.timestamp.strftime('%Y-%m-%d %H:%M'),
+                   batch.description or '', count, active,
+                   '' if batch.status else ' rolled back'))
+        id = self._ask_amount('\nBatch ID: ', int)
+        batches = dict([(batch.id, batch) for batch, count, active in made])
+        if id not in batches:
+            self.status = 'ID is not a valid batch ID'
+            return
+        batch = batches[id]
+        names = dict([(a.id, a.name) for a in self.user.accounts])
+        changes = budse.batch_changes(self.session, batch)
+        print('\nThe batch changed:')
+        for account_id, change in sorted(changes.items()):
+            print('%s %+0.2f' % (names.get(account_id, account_id),
+                                 budse._format_out_amount(change)))
+        if not self._confirm('Roll back the batch? ', default=False):
+            self.status = 'Batch not rolled back'
+            return
+        count = budse.rollback_batch(self.session, batch)
+        self.session.commit()
+        variance.invalidate(self.user.id)
+        # A reversal into a closed month re-opens it
+        if budse.close_periods(self.session, self.user, reopened_only=True):
+            self.session.commit()
+        self.status = 'Batch %d rolled back, %d transaction%s reversed' % (
+            id, count, 's' if count != 1 else '')
+
     def print_balance(self, account=None, include_user_total=True, 
                       include_all=False, include_deactive=False):
         """The balance of a specific account.
@@ -621,26 +799,16 @@ class BudseCLI(object):
         include_deactive -- Include deactivated accounts (default False)
         """
         if account is None:
-            totals = []
-            longest_name = 0
-            longest_total = 4  # length of '0.00'
-            user_total = 0.00
-            for account in self.user.accounts:
-                if account.status == False and not include_deactive:
-                    continue
-                totals.append((account.name, '%0.2f' % account.total))
-                name_length = len(str(account.name))
-                if name_length > longest_name:
-                    longest_name = name_length
-                total_length = len(str('%0.2f' % account.total))
-                if total_length > longest_total:
-                    longest_total = total_length
-                if include_user_total:
-                    user_total += account.total
+            accounts, user_total = balances.balances(
+                self.session, self.user.id, active_only=not include_deactive)
+            totals = [(name, '%0.2f' % budse._format_out_amount(total))
+                      for id, name, active, total in accounts]
+            user_total_string = '%0.2f' % budse._format_out_amount(user_total)
+            longest_name = max([len(name) for name, total in totals] + [0])
+            longest_total = max([len(total) for name, total in totals] +
+                                [4])  # length of '0.00'
             if include_user_total:
-                user_total_length = len(str('%0.2f' % user_total))
-                if user_total_length > longest_total:
-                    longest_total = user_total_length
+                longest_total = max(longest_total, len(user_total_string))
             #TODO this can be done with new str.format function
             if include_all:
                 print('Account balances: ')
@@ -650,16 +818,44 @@ class BudseCLI(object):
             if include_user_total:
                 if include_all:
                     print((' ' * longest_name) + '   ' + ('-' * longest_total))
-                user_total_string = '%0.2f' % user_total
                 print('%s = %s\n' % ('Total'.ljust(longest_name),
                                      user_total_string.rjust(longest_total)))
         else:
             print('%s = $%0.2f' % (account.name, account.total))
 
+    def print_forecast(self):
+        """Project the balances of the accounts forward by month."""
+        months = self._ask_amount('Months to forecast (e.g., 12): ', int)
+        try:
+            accounts, projection = forecast.forecast(self.session, self.user,
+                                                     months)
+        except budse.ParameterException, e:
+            self.status = str(e)
+            return
+        headers = [a.name for a in accounts] + ['Total']
+        rows = []
+        for date, balances in projection:
+            rows.append([date.strftime(BudseCLI.output_date)] +
+                        ['%0.2f' % budse._format_out_amount(b)
+                         for b in balances + [sum(balances)]])
+        widths = [max([len(h)] + [len(r[i+1]) for r in rows])
+                  for i, h in enumerate(headers)]
+        clear_screen()
+        print('Forecast based on the average of the last %d days\n' %
+              forecast.default_history_days)
+        print('%s  %s' % (' ' * 10, '  '.join([h.rjust(w) for h, w in
+                                               zip(headers, widths)])))
+        for row in rows:
+            print('%s  %s' % (row[0], '  '.join([v.rjust(w) for v, w in
+                                                 zip(row[1:], widths)])))
+        print('')
+
     def create_report(self):
         """Report menu."""
         while 1:
-            prompt = ('Create Report\n\n1 - Date Range\n%s\n%s\nChoice: ' % 
+            prompt = ('Create Report\n\n1 - Date Range\n2 - Monthly Spending'
+                      '\n3 - Budget Variance\n4 - Monthly Summary\n%s\n%s\n'
+                      'Choice: ' %
                       (BudseCLI.meta_actions, self.status))
             clear_screen()
             try:
@@ -667,6 +863,15 @@ class BudseCLI(object):
                 if choice == '1':
                     self._create_report_by_date()
                     break
+                elif choice == '2':
+                    self._create_report_by_month()
+                    break
+                elif choice == '3':
+                    self._create_variance_report()
+                    break
+                elif choice == '4':
+                    self._create_summary_report()
+                    break
                 # TODO add Excel report using pyExcelerator
                 # TODO account report for dates
                 else:
@@ -704,50 +909,42 @@ class BudseCLI(object):
         if format == 'tsv':
             delimiter = '\t'
         with open(output_file, 'w') as report_file:
-            report_file.write('Account Name%sDeposits%sWithdrawals%sNet%s%s'
-                              'Report for %s - %s\n' %
+            report_file.write('Account Name%sDeposits%sWithdrawals%s'
+                              'Transfers%sNet%s%sReport for %s - %s\n' %
                               (delimiter, delimiter, delimiter, delimiter,
-                               delimiter,
+                               delimiter, delimiter,
                                (begin_date.strftime(BudseCLI.output_date)),
                                (end_date.strftime(BudseCLI.output_date))))
-            parent_transactions = self.session.query(budse.Transaction).\
-                filter(budse.Transaction.date >= begin_date).\
-                filter(budse.Transaction.date <= end_date).\
-                filter(or_(budse.Transaction.parent == None,
-                           budse.Transaction._parent ==
-                           budse.Transaction.id)).\
-                filter(budse.Transaction.status == True).\
-                order_by(budse.Transaction.date).all()
-            # dict of (account name, deposits, withdrawals, net change) tuples
-            account_summary = {} 
-            for account in self.user.accounts:
-                account_summary[account.id] = (account.name, 0.00, 0.00, 0.00)
-            deductions = 0.00
+            parent_transactions = budse.query_transactions(self.session,
+                self.user.id,
+                [budse.Transaction.date >= begin_date,
+                 budse.Transaction.date <= end_date,
+                 or_(budse.Transaction.parent == None,
+                     budse.Transaction._parent == budse.Transaction.id),
+                 budse.Transaction.status == True], begin_date,
+                descending=False)
+            parent_transactions = list(parent_transactions)
+            # The closed months are read from their summaries
+            summary = budse.summarize_range(self.session, self.user,
+                                            begin_date, end_date)
             transaction_log = ('Transaction Log\n\nDate%sAction%sAmount%s'
                                'Account%sDescription\n' %
                                (delimiter, delimiter, delimiter, delimiter))
             for parent_transaction in parent_transactions:
-                transactions = parent_transaction.children
+                # A copy, archived transactions must not be flushed back
+                transactions = list(parent_transaction.children)
                 if len(transactions) != 1 or parent_transaction.id != parent_transaction._parent:
                     transactions.insert(0, parent_transaction)
                 for transaction in transactions:
                     action = transaction.action
                     if transaction.account is not None:
-                        account_name, deposits, withdrawals, net = \
-                                 account_summary[transaction.account.id]
+                        account_name = transaction.account.name
                         if transaction.action == budse.Transaction.DEPOSIT:
-                            deposits += transaction.amount
-                            net += transaction.amount
                             action = 'Deposit'
                         elif transaction.action == \
                                  budse.Transaction.WITHDRAWAL:
-                            withdrawals += transaction.amount
-                            net -= transaction.amount
                             action = 'Withdrawal'
-                        account_summary[transaction.account.id] = \
-                                     (account_name, deposits, withdrawals, net)
                     elif transaction.action == budse.Transaction.DEDUCTION:
-                        deductions += transaction.amount
                         action = 'Deduction'
                         account_name = 'N/A'
                     elif transaction.action == budse.Transaction.TRANSFER:
@@ -764,11 +961,18 @@ class BudseCLI(object):
                                          account_name, delimiter,
                                          transaction.description))
             total_deposits = total_withdrawals = total_net = 0.00
-            for k, v in account_summary.iteritems():
-                account, deposits, withdrawals, net = v
-                report_file.write('%s%s%0.2f%s%0.2f%s%0.2f\n' %
-                                  (account, delimiter, deposits, delimiter,
-                                   withdrawals, delimiter, net))
+            deductions = 0.00
+            for values in summary.values():
+                deductions += budse._format_out_amount(values[2])
+            for account in self.user.accounts:
+                deposits, withdrawals, trash, transfers = [
+                    budse._format_out_amount(value) for value in
+                    summary.get(account.id, [0, 0, 0, 0])]
+                net = deposits - withdrawals + transfers
+                report_file.write('%s%s%0.2f%s%0.2f%s%0.2f%s%0.2f\n' %
+                                  (account.name, delimiter, deposits,
+                                   delimiter, withdrawals, delimiter,
+                                   transfers, delimiter, net))
                 total_deposits += deposits
                 total_withdrawals += withdrawals
                 total_net += net
@@ -781,6 +985,123 @@ class BudseCLI(object):
             report_file.write('\n\n%s' % transaction_log)
         self.status = '%s successfully created' % output_file
 
+    def _create_report_by_month(self, window=3):
+        """Create a report of the monthly spending of each account.
+
+        Keyword arguments:
+        window -- Months in the rolling average (default 3)
+
+        """
+        extension = 'xls'
+        delimiter = '\t'
+        today = datetime.date.today()
+        default = datetime.date(today.year - 1, today.month, 1)
+        begin_date = self._ask_date(prompt='Date of start of report',
+                                    default_date=default)
+        end_date = self._ask_date(prompt='Date of end of report')
+        filename = 'Budse_Spending_%s%s-%s%s.%s' % (begin_date.year,
+                            begin_date.month, end_date.year, end_date.month,
+                                                    extension)
+        default_filepath = os.getcwd()
+        prompt = 'Output report to %s/%s?' % (default_filepath, filename)
+        output_file = self._ask_filepath(filename=filename, prompt=prompt,
+                                         default_path=default_filepath)
+        months, summary = analytics.spending_summary(self.session, self.user,
+                                                     begin_date, end_date,
+                                                     window)
+        with open(output_file, 'w') as report_file:
+            report_file.write('Monthly Spending%sReport for %s - %s\n\n' %
+                              (delimiter,
+                               begin_date.strftime(BudseCLI.output_date),
+                               end_date.strftime(BudseCLI.output_date)))
+            report_file.write('Account Name%s%s%sMedian%s90th Percentile\n' %
+                              (delimiter, delimiter.join(months), delimiter,
+                               delimiter))
+            for account, spent, rolling, median, high in summary:
+                report_file.write('%s%s%s%s%0.2f%s%0.2f\n' %
+                    (account.name, delimiter,
+                     delimiter.join(['%0.2f' % budse._format_out_amount(s)
+                                     for s in spent]),
+                     delimiter, budse._format_out_amount(median or 0),
+                     delimiter, budse._format_out_amount(high or 0)))
+            report_file.write('\n\n%d Month Rolling Average\n' % window)
+            for account, spent, rolling, median, high in summary:
+                report_file.write('%s%s%s\n' %
+                    (account.name, delimiter,
+                     delimiter.join(['%0.2f' % budse._format_out_amount(r)
+                                     for r in rolling])))
+        self.status = '%s successfully created' % output_file
+
+    def _create_variance_report(self):
+        """Create a report of allocations against spending by month."""
+        extension = 'xls'
+        delimiter = '\t'
+        months = self._ask_amount('Months to include (e.g., 12): ', int)
+        last = budse.period_of(datetime.date.today())
+        first = last - max(months, 1) + 1
+        filename = 'Budse_Variance_%s-%s.%s' % (
+            budse.period_label(first).replace('-', ''),
+            budse.period_label(last).replace('-', ''), extension)
+        default_filepath = os.getcwd()
+        prompt = 'Output report to %s/%s?' % (default_filepath, filename)
+        output_file = self._ask_filepath(filename=filename, prompt=prompt,
+                                         default_path=default_filepath)
+        with open(output_file, 'w') as report_file:
+            report_file.write('Period%sAccount Name%sAllocated%sSpent%s'
+                              'Variance\n' % (delimiter, delimiter, delimiter,
+                                              delimiter))
+            for label, rows in variance.variance(self.session, self.user,
+                                                 first, last):
+                for account, allocated, spent, difference in rows:
+                    report_file.write('%s%s%s%s%0.2f%s%0.2f%s%0.2f\n' %
+                        (label, delimiter, account.name, delimiter,
+                         budse._format_out_amount(allocated), delimiter,
+                         budse._format_out_amount(spent), delimiter,
+                         budse._format_out_amount(difference)))
+        self.status = '%s successfully created' % output_file
+
+    def _create_summary_report(self):
+        """Create a report of the monthly aggregates of each account.
+
+        Months that have been closed are read from their summaries, so
+        reports spanning years stay quick.
+
+        """
+        extension = 'xls'
+        delimiter = '\t'
+        today = datetime.date.today()
+        default = datetime.date(today.year - 1, 1, 1)
+        begin_date = self._ask_date(prompt='Date of start of report',
+                                    default_date=default)
+        end_date = self._ask_date(prompt='Date of end of report')
+        first = budse.period_of(begin_date)
+        last = budse.period_of(end_date)
+        filename = 'Budse_Summary_%s-%s.%s' % (
+            budse.period_label(first).replace('-', ''),
+            budse.period_label(last).replace('-', ''), extension)
+        default_filepath = os.getcwd()
+        prompt = 'Output report to %s/%s?' % (default_filepath, filename)
+        output_file = self._ask_filepath(filename=filename, prompt=prompt,
+                                         default_path=default_filepath)
+        names = {None: 'Whole Account'}
+        for account in self.user.accounts:
+            names[account.id] = account.name
+        with open(output_file, 'w') as report_file:
+            report_file.write('Period%sClosed%sAccount Name%sDeposits%s'
+                              'Withdrawals%sDeductions%sTransfers%s'
+                              'Closing Balance\n' % ((delimiter,) * 7))
+            for label, closed, summary in budse.period_summaries(
+                    self.session, self.user, first, last):
+                for account_id in sorted(summary.keys()):
+                    report_file.write('%s%s%s%s%s' % (label, delimiter,
+                                      'Yes' if closed else 'No', delimiter,
+                                      names.get(account_id, account_id)))
+                    for value in summary[account_id]:
+                        report_file.write('%s%0.2f' %
+                            (delimiter, budse._format_out_amount(value)))
+                    report_file.write('\n')
+        self.status = '%s successfully created' % output_file
+
     def _ask_filepath(self, filename, prompt, default_path=os.getcwd()):
         """Prompt user for a filename.
 
@@ -823,6 +1144,9 @@ class BudseCLI(object):
                       '2 - Add New Account\n3 - Login Name\n4 - %s\n'
                       '5 - Deductions\n6 - Whole Account Actions\n'
                       '7 - Recalculate Account Totals\n'
+                      '8 - Close Past Months\n'
+                      '9 - Archive Old Transactions\n'
+                      '10 - Repair Account Totals From The Ledger\n'
                       '%s\n%s\n\nAction: ') %
                       (status_modification, BudseCLI.meta_actions, self.status))
             clear_screen()
@@ -842,6 +1166,12 @@ class BudseCLI(object):
                     self.modify_user_whole(self.user)
                 elif action == '7':
                     self.recalculate_totals()
+                elif action == '8':
+                    self.close_periods()
+                elif action == '9':
+                    self.archive_transactions()
+                elif action == '10':
+                    self.repair_totals()
                 else:
                     self.status = ('Invalid action - %s' %
                                    random.choice(budse.fun))
@@ -918,15 +1248,18 @@ class BudseCLI(object):
     def modify_user_deductions(self, user):
         """Modify the user's list of saved deductions."""
         deductions_changed = False
-        deductions = user.deductions
+        # List of (amount, description, percentage_or_fixed) tuples
+        deductions = [(d.amount, d.description, d.percentage_or_fixed)
+                      for d in user.deductions]
         status = ''
         while 1:
             clear_screen()
             deduction_list = ''
-            for key, (amount, description) in zip(range(len(deductions)),
-                                                  deductions):
-                deduction_list += ('%d - $%0.2f (%s)\n' %
-                                   (key+1, amount, description))
+            for key, (amount, description, kind) in zip(range(len(deductions)),
+                                                        deductions):
+                deduction_list += ('%d - %s (%s)\n' %
+                                   (key+1, _deduction_amount(amount, kind),
+                                    description))
             else:
                 prompt = ("Deductions (changes saved when user enters D'one):"
                           "\n\n%sn - New Deduction\n%s\n%s\n\nModify: " %
@@ -937,7 +1270,8 @@ class BudseCLI(object):
             except budse.DoneException:
                 if deductions_changed:
                     deductions_changed = True
-                    user.deductions = deductions
+                    user.deductions = [budse.StoredDeduction(*deduction)
+                                       for deduction in deductions]
                     self.session.commit()
                 else:
                     deductions_changed = False
@@ -948,30 +1282,38 @@ class BudseCLI(object):
                 break
             try:
                 if choice.upper() == 'N':
-                    amount = self._ask_amount()
+                    if self._confirm('Deduct a percentage of the gross '
+                                     'amount?', False):
+                        kind = budse.Account.PERCENTAGE
+                    else:
+                        kind = budse.Account.FIXED
+                    amount = self._ask_deduction_amount(kind)
                     description = self._ask_string()
-                    if self._confirm('Add deduction: $%0.2f (%s)?' %
-                                (amount, description), True):
-                        deductions.append((amount, description))
+                    if self._confirm('Add deduction: %s (%s)?' %
+                                (_deduction_amount(amount, kind), description),
+                                     True):
+                        deductions.append((amount, description, kind))
                         status = 'Deduction added'
                         deductions_changed = True
-                elif int(choice)-1 >= 0 and int(choice)-1 <= len(deductions):
-                    amount, description = deductions[int(choice)-1]
-                    prompt = ('1 - Change Amount ($%0.2f)\n'
+                elif int(choice)-1 >= 0 and int(choice)-1 < len(deductions):
+                    amount, description, kind = deductions[int(choice)-1]
+                    prompt = ('1 - Change Amount (%s)\n'
                               '2 - Change Description (%s)\n'
                               '3 - Delete\n\nChoice: ' % 
-                              (amount, description))
+                              (_deduction_amount(amount, kind), description))
                     try:
                         option = self._ask_amount(prompt, int)
                     except budse.DoneException:
                         continue
                     status = 'Deduction unchanged'
                     if option == 1:
-                        new_amount = self._ask_amount()
-                        if self._confirm('Change amount from $%0.2f to $%0.2f?'
-                                         % (amount, new_amount), True):
+                        new_amount = self._ask_deduction_amount(kind)
+                        if self._confirm('Change amount from %s to %s?' %
+                                         (_deduction_amount(amount, kind),
+                                          _deduction_amount(new_amount, kind)),
+                                         True):
                             deductions[int(choice)-1] = (new_amount,
-                                                         description)
+                                                         description, kind)
                             status = 'Deduction amount changed'
                             deductions_changed = True
                     elif option == 2:
@@ -980,12 +1322,12 @@ class BudseCLI(object):
                                          '"%s"?' %
                                          (description, new_description), True):
                             deductions[int(choice)-1] = (amount,
-                                                         new_description)
+                                                         new_description, kind)
                             status = 'Deduction description changed'
                             deductions_changed = True
                     elif option == 3 and self._confirm('Are you sure that '
                            'you want to delete this deduction:\n%s - %s?' %
-                           (amount, description)):
+                           (_deduction_amount(amount, kind), description)):
                         deductions.pop(int(choice)-1)
                         status = 'Deduction deleted'
                         deductions_changed = True
@@ -1002,6 +1344,24 @@ class BudseCLI(object):
         else:
             self.status = 'Deductions not modified'
 
+    def _ask_deduction_amount(self, kind):
+        """Query user for the amount of a stored deduction.
+
+        Keyword arguments:
+        kind -- Account.PERCENTAGE or Account.FIXED
+
+        Returns:
+        Dollars, or the share of the gross amount for percentages
+
+        """
+        if kind != budse.Account.PERCENTAGE:
+            return self._ask_amount()
+        while 1:
+            percentage = self._ask_amount('Percentage of the gross amount: ')
+            if 0 <= percentage <= 100:
+                return percentage / 100
+            print('Out of range! (Must be in the range 0-100)')
+
     def modify_user_whole(self, user): # not hole, that would be inappropriate
         """Change whether user is prompted for whole account actions."""
         if user.whole_account_actions is not None:
@@ -1051,6 +1411,70 @@ class BudseCLI(object):
         else:
             self.status = 'Account totals not recalculated'
 
+    def repair_totals(self):
+        """Set the user's account totals to the balances of the ledger.
+
+        The balances are brought up to date from the ledger events since
+        the last repair (or balance), rather than from every transaction
+        as recalculate_totals does.
+        """
+        projected = ledger.balances(self.session, self.user.id)
+        different = []
+        clear_screen()
+        print('Balances of the ledger:')
+        for account in self.user.accounts:
+            balance = budse._format_out_amount(projected.get(account.id, 0))
+            print('    %s: %0.2f instead of the existing %0.2f%s' %
+                  (account.name, balance, account.total,
+                   ' - DIFFERENCE!' if balance != account.total else ''))
+            if balance != account.total:
+                different.append(account)
+        if different and self._confirm('Save the balances of the ledger?',
+                                       False):
+            ledger.repair_totals(self.session, self.user.id)
+            self.status = 'Repaired %d account total%s' % (
+                len(different), 's' if len(different) > 1 else '')
+        elif different:
+            self.status = 'Account totals not repaired'
+        else:
+            self.status = 'Account totals already match the ledger'
+        # The balances were caught up either way
+        self.session.commit()
+
+    def close_periods(self):
+        """Close the months that have ended to freeze their aggregates."""
+        if not self._confirm('Close all of the months that have ended?',
+                             True):
+            self.status = 'No months closed'
+            return
+        periods = budse.close_periods(self.session, self.user)
+        self.session.commit()
+        if periods:
+            self.status = ('Closed %d month%s (%s - %s)' %
+                           (len(periods), 's' if len(periods) > 1 else '',
+                            budse.period_label(periods[0]),
+                            budse.period_label(periods[-1])))
+        else:
+            self.status = 'All of the past months are already closed'
+
+    def archive_transactions(self):
+        """Move the transactions before a date out to the archive."""
+        today = datetime.date.today()
+        default = datetime.date(today.year - 1, today.month, 1)
+        cutoff = self._ask_date(prompt='Archive transactions before',
+                                default_date=default)
+        if not self._confirm('Archive every transaction before %s?' %
+                             cutoff.strftime(BudseCLI.output_date), False):
+            self.status = 'No transactions archived'
+            return
+        try:
+            count = budse.archive_transactions(self.session, self.user, cutoff)
+        except budse.ParameterException, e:
+            self.status = str(e)
+            return
+        self.status = 'Archived %d transaction%s' % (count,
+                                                     's' if count != 1 else '')
+
     def modify_account(self):
         """Allow the user to modify aspects of an existing account."""
         try:
@@ -1748,7 +2172,9 @@ class BudseCLI(object):
                   'after the gross deposit, before the net deposit \n'
                   '(e.g., pay $50 to social security)\n')
             raw_input(continue_string)
-        new_user.deductions = self.ask_deduction_list()
+        new_user.deductions = [budse.StoredDeduction(amount, description)
+                               for amount, description in
+                               self.ask_deduction_list()]
         clear_screen()
         if newbie:
             clear_screen()
@@ -1873,8 +2299,34 @@ def _clear_screen():
     os.system(os_clear)
 
 
+@contextmanager
+def _action(name):
+    """Trace a main menu action, counting its queries when --profile is
+    given."""
+    with tracing.span(name, user=app.user.id):
+        if not budse.profile:
+            yield
+            return
+        with instrument.profile(name) as stats:
+            yield
+        app.status = str(stats)
+
+def _deduction_amount(amount, kind):
+    """Stored deduction amount as dollars or a percentage."""
+    if kind == budse.Account.PERCENTAGE:
+        return '%0.2f%%' % (amount * 100)
+    return '$%0.2f' % amount
+
+def _print_profile():
+    if instrument.totals():
+        print('Queries by action\n%s' % instrument.report())
+
 if __name__ == "__main__":
-    #TODO 5: program versioning in the database?
+    opts, args = budse.option_parser().parse_args()
+    budse.configure(opts.database, opts.debug, opts.profile, opts.trace)
+    if budse.profile:
+        instrument.install()
+        atexit.register(_print_profile)
     session = budse.initialize()
     continue_string = 'Hit return to continue'
     clear_screen = _clear_screen
@@ -1900,7 +2352,8 @@ if __name__ == "__main__":
     while 1:
         prompt = ('Main Menu\n\n1 - Deposit\n2 - Withdraw\n3 - Balance\n'
                   '4 - Transfer\n5 - Search\n6 - Create Report\n'
-                  '7 - Undo Transaction\n8 - Preferences\nq - Quit\n%s\n\n'
+                  '7 - Undo Transaction\n8 - Preferences\n9 - Forecast\n'
+                  'q - Quit\n%s\n\n'
                   'Action: ' % app.status)
         try:
             action = app._ask_string(prompt)
@@ -1909,35 +2362,50 @@ if __name__ == "__main__":
             continue
         if action == '1':
             clear_screen()
-            app.make_deposit()
+            with _action('deposit'):
+                app.make_deposit()
         elif action == '2':
             clear_screen()
-            app.make_withdrawal()
+            with _action('withdrawal'):
+                app.make_withdrawal()
         elif action == '3':
             clear_screen()
-            app.print_balance(include_all=True)
+            with _action('balance'):
+                app.print_balance(include_all=True)
             raw_input(continue_string)
         elif action == '4':
             clear_screen()
-            app.make_transfer()
+            with _action('transfer'):
+                app.make_transfer()
         elif action == '5':
             try:
                 while True:
                     clear_screen()
-                    app.output_transactions(app.search())
+                    with _action('search'):
+                        app.output_search()
                     raw_input(continue_string)
             except (budse.CancelException, budse.DoneException):
                 app.status = 'Canceled search'
         elif action == '6':
             clear_screen()
-            app.create_report()
+            with _action('report'):
+                app.create_report()
         elif action == '7':
             try:
-                app.reverse_transaction()
+                with _action('reversal'):
+                    app.reverse_transaction()
             except (budse.CancelException, budse.DoneException):
                 app.status = 'Canceled reversal'
         elif action == '8':
             app.modify_user_settings()
+        elif action == '9':
+            clear_screen()
+            try:
+                with _action('forecast'):
+                    app.print_forecast()
+                raw_input(continue_string)
+            except (budse.CancelException, budse.DoneException):
+                app.status = 'Canceled forecast'
         else:
             app.status = 'Invalid action - %s' % random.choice(budse.fun)
         clear_screen()
@@ -22,15 +22,20 @@
 ############################
 
 from PyQt4 import QtCore, QtGui
-from sqlalchemy import and_, or_, desc
+from sqlalchemy import and_, or_, case, func, literal
 from budse_main import Ui_BudseWindow
 from withdrawal_dialog import Ui_Withdrawal
 from transfer_dialog import Ui_Transfer
 from deposit_dialog import Ui_Deposit
 from preferences import Ui_Preferences
+import balances
 import budse
 import datetime
+import forecast
+import instrument
 import random
+import searchcache
+import tracing
 
 
 #############
@@ -139,6 +144,322 @@ class DateTableWidgetItem(QtGui.QTableWidgetItem):
         return ge
 
 
+#############
+# Models
+#############
+
+class TransactionTableModel(QtCore.QAbstractTableModel):
+    """Transactions of a search to be shown in a QTableView.
+
+    The transactions are fetched a page at a time as the view scrolls
+    (see canFetchMore and fetchMore), from the archive as well once
+    there is one.
+    Sorting orders the query in the database and starts over from the
+    first page instead of comparing items in Python.  Pages are fetched
+    by the QueryWorker and continue after the last row shown rather than
+    counting rows with an OFFSET.
+
+    """
+    headers = ('Date', 'Amount', 'Account', 'Type', 'Description')
+    # Rows fetched by each trip to the database
+    page_size = 100
+
+    def __init__(self, run_query, user_id, criteria, names, page,
+                 limit=None, column=0, order=QtCore.Qt.DescendingOrder,
+                 parent=None):
+        """Initialize the model with its first page.
+
+        Keyword parameters:
+        run_query - BudseGUI.run_query to fetch the other pages with
+        user_id - ID of the user searching
+        criteria - List of the search criteria on the Transaction columns
+        names - Dictionary of account ID to name
+        page - First page from fetch
+        limit - Maximum number of rows to show (default None for all)
+        column - Column to sort by (default the date)
+        order - Qt.SortOrder of the column (default newest first)
+        parent - Parent QObject (default None)
+
+        """
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.run_query = run_query
+        self.user_id = user_id
+        self.criteria = criteria
+        self.names = names
+        self.limit = limit
+        self.column = column
+        self.order = order
+        # Whether a page is on its way from the QueryWorker
+        self.loading = False
+        self.rows = []
+        self._set_page(page)
+
+    @staticmethod
+    def sort_key(column, names):
+        """Database expression that a column sorts by.
+
+        Keyword parameters:
+        column - Column to sort by
+        names - Dictionary of account ID to name
+
+        Returns:
+        (expression on the Transaction columns, function of a Transaction
+        giving its value)
+
+        """
+        if column == 1:
+            return (budse.Transaction._amount, lambda t: t._amount)
+        if column == 2:
+            # Accounts are ranked by name so that archived transactions,
+            # which cannot be joined to them, sort the same way
+            ranks = dict([(id, rank) for rank, id in
+                          enumerate(sorted(names, key=names.get))])
+            rank_of = lambda t: ranks.get(t._account, -1)
+            if not ranks:
+                return (literal(-1), rank_of)
+            return (case([(budse.Transaction._account == id, rank)
+                          for id, rank in ranks.items()], else_=-1),
+                    rank_of)
+        if column == 3:
+            return (budse.Transaction.action, lambda t: t.action)
+        if column == 4:
+            return (func.coalesce(budse.Transaction.description, ''),
+                    lambda t: t.description or '')
+        return (budse.Transaction.date, lambda t: t.date)
+
+    @classmethod
+    def fetch(cls, session, user_id, criteria, names, column, order, after,
+              size):
+        """Fetch a page of rows without touching the model.
+
+        This only touches the database, so it is run by the QueryWorker
+        and the page handed to the model afterwards.
+
+        Keyword parameters:
+        session - Session to query with
+        user_id - ID of the user searching
+        criteria - List of the search criteria on the Transaction columns
+        names - Dictionary of account ID to name
+        column - Column to sort by
+        order - Qt.SortOrder of the column
+        after - (sort key, ID) of the last row shown, or None for the
+            first page
+        size - Maximum number of rows
+
+        Returns:
+        (list of the text of each column, one tuple per row, (sort key,
+        ID) of the last row)
+
+        """
+        if size <= 0:
+            return ([], after)
+        key, value_of = cls.sort_key(column, names)
+        id = budse.Transaction.id
+        descending = order == QtCore.Qt.DescendingOrder
+        if after is not None:
+            value, last = after
+            if descending:
+                criteria = criteria + [or_(key < value,
+                                           and_(key == value, id < last))]
+            else:
+                criteria = criteria + [or_(key > value,
+                                           and_(key == value, id > last))]
+        # The ID keeps the order stable across pages
+        transactions = list(budse.query_transactions(
+            session, user_id, criteria, descending=descending, limit=size,
+            order_by=[key, id]))
+        if transactions:
+            after = (value_of(transactions[-1]), transactions[-1].id)
+        return ([cls._display(t, names) for t in transactions], after)
+
+    @staticmethod
+    def _display(transaction, names):
+        """Convert a fetched transaction into the text of each column."""
+        action = transaction.action
+        account = transaction._account
+        name = names.get(account)
+        if account is not None:
+            if action == budse.Transaction.WITHDRAWAL:
+                action = 'Withdrawal'
+            else:
+                action = 'Deposit'
+        # Special logic for non-account transactions (aka meta
+        # transactions)
+        elif action == budse.Transaction.DEDUCTION:
+            name, action = '', 'Deduction'
+        elif action == budse.Transaction.TRANSFER:
+            name, action = '', 'Transfer'
+        else:
+            name, action = 'Whole Account', 'Deposit'
+        return (transaction.date.strftime('%m/%d/%y'),
+                '%0.2f' % budse._format_out_amount(transaction._amount or 0),
+                name, action, transaction.description or '')
+
+    def _page_size(self, shown):
+        """Number of rows the page after those shown may hold."""
+        size = self.page_size
+        if self.limit is not None:
+            size = min(size, self.limit - shown)
+        return size
+
+    def _set_page(self, page):
+        """Append the rows of a page that was just fetched."""
+        rows, self.after = page
+        self.exhausted = len(rows) < self._page_size(len(self.rows)) or \
+                         (self.limit is not None and
+                          len(self.rows) + len(rows) >= self.limit)
+        # Extending copies the rows, since the page may be cached
+        self.rows.extend(rows)
+
+    def _request(self, after, callback):
+        """Fetch the page after a row on the QueryWorker."""
+        user_id, criteria, names = self.user_id, self.criteria, self.names
+        column, order = self.column, self.order
+        size = self._page_size(0 if after is None else len(self.rows))
+        self.loading = True
+        self.run_query('page',
+                       lambda session: self.fetch(session, user_id, criteria,
+                                                  names, column, order, after,
+                                                  size),
+                       callback)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return self.rows[index.row()][index.column()]
+        if role == QtCore.Qt.TextAlignmentRole and index.column() == 1:
+            return int(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and \
+               orientation == QtCore.Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid() or self.exhausted or self.loading:
+            return
+        self._request(self.after, self._more_fetched)
+
+    def _more_fetched(self, page):
+        self.loading = False
+        first = len(self.rows)
+        if page[0]:
+            self.beginInsertRows(QtCore.QModelIndex(), first,
+                                 first + len(page[0]) - 1)
+            self._set_page(page)
+            self.endInsertRows()
+        else:
+            self._set_page(page)
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        if (column, order) == (self.column, self.order):
+            return
+        # The rows shown stay until the first page in the new order
+        # arrives, and replace any page still on its way
+        self.column = column
+        self.order = order
+        self._request(None, self._sorted)
+
+    def _sorted(self, page):
+        self.loading = False
+        self.beginResetModel()
+        self.rows = []
+        self._set_page(page)
+        self.endResetModel()
+
+
+#############
+# Background Queries
+#############
+
+class QueryWorker(QtCore.QObject):
+    """Run database queries away from the GUI thread.
+
+    The worker is moved to its own QThread and has its own session.  A
+    job is a callable that takes the session and returns plain data
+    (mapped objects belong to the worker's session and must not be
+    handed back).  Every job has a kind, and submitting a job makes any
+    unfinished job of the same kind obsolete: one that has not started
+    is skipped and the results of one that is running are dropped.
+
+    """
+    # Queued to the worker's thread by submit
+    submitted = QtCore.pyqtSignal(str, int, object)
+    # (kind, request, result) back on the GUI thread
+    finished = QtCore.pyqtSignal(str, int, object)
+    # (kind, request, error message)
+    failed = QtCore.pyqtSignal(str, int, str)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.session = None
+        self.requests = 0
+        # Dictionary of kind to the request number of its newest job
+        self.latest = {}
+        self.submitted.connect(self._run)
+
+    def submit(self, kind, job):
+        """Queue a job, superseding any unfinished job of its kind.
+
+        Keyword parameters:
+        kind - Name shared by jobs that replace one another
+        job - Callable taking a session and returning plain data
+
+        Returns:
+        Request number of the job
+
+        """
+        self.requests += 1
+        self.latest[kind] = self.requests
+        self.submitted.emit(kind, self.requests, job)
+        return self.requests
+
+    def is_current(self, kind, request):
+        """Whether a request is the newest of its kind."""
+        return self.latest.get(str(kind)) == request
+
+    @QtCore.pyqtSlot(str, int, object)
+    def _run(self, kind, request, job):
+        kind = str(kind)
+        if not self.is_current(kind, request):
+            return
+        if self.session is None:
+            # Connections have to be made in the thread that uses them
+            self.session = budse.Session()
+        try:
+            with tracing.span(kind):
+                if budse.profile:
+                    with instrument.profile(kind) as stats:
+                        result = job(self.session)
+                    print(stats)
+                else:
+                    result = job(self.session)
+        except Exception, e:
+            self.failed.emit(kind, request, str(e))
+        else:
+            if self.is_current(kind, request):
+                self.finished.emit(kind, request, result)
+        finally:
+            # End the transaction so the next job sees new commits
+            self.session.close()
+
+
 #############
 # Transaction Dialogs
 #############
@@ -338,13 +659,16 @@ class DepositDialog(QtGui.QDialog):
         d.setHorizontalHeaderLabels(('Amount', 'Description'))
         d.verticalHeader().hide()
         row = 0
-        for a, desc in deductions:
+        for deduction in deductions:
             # Description
-            twi = QtGui.QTableWidgetItem(desc)
+            twi = QtGui.QTableWidgetItem(deduction.description)
             twi.setTextAlignment(QtCore.Qt.AlignLeft)
             d.setItem(row, 0, twi)
-            # Amount
-            twi = MonetaryTableWidgetItem(a)
+            # Amount, a percentage is taken of the gross amount on save
+            if deduction.percentage_or_fixed == budse.Account.PERCENTAGE:
+                twi = PercentageTableWidgetItem(deduction.amount)
+            else:
+                twi = MonetaryTableWidgetItem(deduction.amount)
             twi.setTextAlignment(QtCore.Qt.AlignRight)
             d.setItem(row, 1, twi)
             row += 1
@@ -421,7 +745,10 @@ class DepositDialog(QtGui.QDialog):
                 # Description
                 d = str((table.item(r, 0)).text())
                 # Amount
-                a = (table.item(r, 1)).value
+                item = table.item(r, 1)
+                a = item.value
+                if isinstance(item, PercentageTableWidgetItem):
+                    a = round(amount * a, 2)
                 deductions.append(budse.Deduction(user=self.user, date=date,
                                                   amount=a, description=d))
 
@@ -557,8 +884,10 @@ class PreferencesDialog(QtGui.QDialog):
         self.dt = self.ui.deductionsTable
 
         row = 0
-        for a, d in self.user.deductions:
-            self.insert_deduction(row, d, a)
+        for d in self.user.deductions:
+            self.insert_deduction(row, d.description, d.amount,
+                                  d.percentage_or_fixed ==
+                                  budse.Account.PERCENTAGE)
             row += 1
         self.dt.resizeRowsToContents()
 
@@ -617,7 +946,7 @@ class PreferencesDialog(QtGui.QDialog):
     def add_deduction(self):
         self.insert_deduction(self.dt.rowCount(), '', 0)
 
-    def insert_deduction(self, row, description, amount):
+    def insert_deduction(self, row, description, amount, percentage=False):
         dc = 0 # Description column
         ac = 1 # Amount column
         
@@ -631,7 +960,10 @@ class PreferencesDialog(QtGui.QDialog):
         twi.setTextAlignment(QtCore.Qt.AlignLeft)
         self.dt.setItem(row, dc, twi)
         # Amount
-        twi = MonetaryTableWidgetItem(amount)
+        if percentage:
+            twi = PercentageTableWidgetItem(amount)
+        else:
+            twi = MonetaryTableWidgetItem(amount)
         twi.setTextAlignment(QtCore.Qt.AlignHCenter)
         self.dt.setItem(row, ac, twi)
         self.dt.resizeRowsToContents()
@@ -677,6 +1009,10 @@ class BudseGUI(QtGui.QMainWindow):
     transaction_made = QtCore.pyqtSignal()
 
     show_all = True
+    # How far ahead the snapshot forecasts the account totals
+    forecast_months = 12
+    # Milliseconds to wait for more changes before searching
+    search_delay = 250
 
     def __init__(self, user, parent=None):
         """Initialize GUI and signals/slots.
@@ -696,6 +1032,19 @@ class BudseGUI(QtGui.QMainWindow):
         self.user = self.session.query(budse.User).\
                     filter(budse.User.name == user).one()
 
+        # First pages of recent searches
+        self.search_cache = searchcache.SearchCache()
+
+        # Queries run in the background so the window stays responsive
+        # Dictionary of query kind to (request number, callback)
+        self.pending = {}
+        self.query_thread = QtCore.QThread(self)
+        self.worker = QueryWorker()
+        self.worker.moveToThread(self.query_thread)
+        self.worker.finished.connect(self.query_finished)
+        self.worker.failed.connect(self.query_failed)
+        self.query_thread.start()
+
         # Snapshot
         self.ui.snapshot.horizontalHeader().setResizeMode(
             QtGui.QHeaderView.Stretch)
@@ -709,8 +1058,13 @@ class BudseGUI(QtGui.QMainWindow):
         self.keyword_added.connect(self.ui.searchButton.click)
 
         # Search
+        # Rapid changes (e.g., toggling several accounts) only search once
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(self.search_delay)
+        self.search_timer.timeout.connect(self.search)
         self.ui.searchButton.clicked.connect(self.search)
-        self.do_search.connect(self.search)
+        self.do_search.connect(self.search_timer.start)
 
         # Calendar
         # self.ui.endDate.setSelectedDate(QtCore.QDate.currentDate())
@@ -754,11 +1108,13 @@ class BudseGUI(QtGui.QMainWindow):
         acct_vlayout.addWidget(self.deselect_accounts)
 
         # TODO expand item to fill the space allocated for it
-        for a in self.user.accounts:
-            cb = QtGui.QCheckBox(a.name)
-            cb.setToolTip(a.description)
+        self.load_accounts()
+        for id in self.account_order:
+            name, description = self.accounts_by_id[id]
+            cb = QtGui.QCheckBox(name)
+            cb.setToolTip(description)
             self.account_buttons.addButton(cb)
-            self.account_buttons.setId(cb, a.id)
+            self.account_buttons.setId(cb, id)
             acct_vlayout.addWidget(cb)
 #        self.accounts.setSizePolicy(QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Expanding)
         self.accounts.setLayout(acct_vlayout)
@@ -803,7 +1159,8 @@ class BudseGUI(QtGui.QMainWindow):
             self.whole_account.setChecked(False)
             # No transactions will match if it's empty
             self.no_transactions()
-            # Clear out the snapshot
+            # Clear out the snapshot, dropping one that is on its way
+            self.pending.pop('snapshot', None)
 	    self.ui.snapshot.clear()
             self.ui.snapshot.horizontalHeader().hide()
             self.ui.snapshot.setRowCount(1)
@@ -853,135 +1210,114 @@ class BudseGUI(QtGui.QMainWindow):
         and display the matching transactions to the user.
 
         """
-        self.ui.transactions.clear()
-        # Base query no matter what the other criteria are
-        query = self.session.query(budse.Transaction).\
-                filter(budse.Transaction.user == self.user).\
-                filter(budse.Transaction.status == True)
-
         # Keywords
         # List of lists (e.g., [[key1, key2], [key3]])
-        kws = [[k for k in keyword.split('\s', QtCore.QString.SkipEmptyParts)]
+        kws = [[unicode(k) for k in keyword.split('\s',
+                                                QtCore.QString.SkipEmptyParts)]
                    for keyword in self.ui.keywords.toPlainText().\
                                   split('\n', QtCore.QString.SkipEmptyParts)]
-        if kws:
-            query = query.filter(or_(*map(self.parse_keyword, kws)))
 
         # Accounts
-        if self.whole_account.isChecked():
-            # Do not include subtransactions (e.g., a deposit from a whole
-            #     account deposit) when a high level view is desired
-            query = query.filter(budse.Transaction.parent == None)
-        else:
-            # Hide high level transactions (i.e., those w/o an account)
-            query = query.filter(budse.Transaction.account != None)
-
-            accts = []
-            s = budse.Session()
-            for b in self.account_buttons.buttons():
-                if b.isChecked():
-                    id = self.account_buttons.id(b)
-                    accts.append(s.query(budse.Account).\
-                            filter(budse.Account.id == id).one())
-            if accts:
-		# Cannot just do budse.Transaction.account.id w/ SQLAlchemy
-		# in the query construction
-		# Need to retrieve the object in order to compare it since
-		# it does not recognize the property correctly
-                query = query.filter(or_(*map(lambda n:
-                                              budse.Transaction.account == n,
-                                              accts)))
-            else:
-                self.no_transactions()
-        
+        whole_account = self.whole_account.isChecked()
+        account_ids = [self.account_buttons.id(b)
+                       for b in self.account_buttons.buttons()
+                       if b.isChecked() and self.account_buttons.id(b) > 0]
+        if not whole_account and not account_ids:
+            self.no_transactions()
+            return
+
         # Date
         # q_date = self.ui.endDate.selectedDate()
         # date = datetime.date(q_date.year(), q_date.month(), q_date.day())
         # if self.ui.endDate.selectedDate() != QtCore.QDate.currentDate():
         #     query = query.filter(budse.Transaction.date == date)
 
-        # Order
-        query = query.order_by(desc(budse.Transaction.date))
-
         # Limit
         try:
-            query = query.limit(int(self.ui.limit.currentText()))
-        except TypeError:
-            pass
-
-        # Columns positions, this makes it easier to re-arrange them if desired
-#        undo_c = 0
-        date_c = 0
-        amt_c = 1
-        act_c = 2
-        action_c = 3
-        desc_c = 4
-
-        size = query.count()
-        if size == 0:
-            self.no_transactions()
-        else:
-            self.ui.transactions.horizontalHeader().show()
-            self.ui.transactions.setRowCount(size)
+            limit = int(self.ui.limit.currentText())
+        except (TypeError, ValueError):
+            limit = None
+
+        # Rows are fetched by the model as they are scrolled to, in the
+        # order the header is currently sorted by
+        header = self.ui.transactions.horizontalHeader()
+        column = header.sortIndicatorSection()
+        order = header.sortIndicatorOrder()
+        user_id = self.user.id
+        key = searchcache.search_key(user_id,
+                                     None if whole_account else account_ids,
+                                     kws, None, None, limit, int(column),
+                                     int(order))
+        version = budse.ledger_version(user_id)
+        criteria = self.search_criteria(user_id, kws, whole_account,
+                                        account_ids)
+        size = TransactionTableModel.page_size
+        if limit is not None:
+            size = min(size, limit)
+
+        names = dict([(id, name) for id, (name, description) in
+                      self.accounts_by_id.items()])
+
+        def first_page(session):
+            page = TransactionTableModel.fetch(session, user_id, criteria,
+                                               names, column, order, None,
+                                               size)
+            self.search_cache.put(key, page, version)
+            return page
+
+        def show(page):
+            if not page[0]:
+                self.no_transactions()
+                return
+            # Pages of the model shown before are no longer wanted
+            self.pending.pop('page', None)
             # TODO add Undo column
-            self.ui.transactions.setColumnCount(5)
-            self.ui.transactions.setHorizontalHeaderLabels(
-                ('Date', 'Amount', 'Account', 'Type', 'Description'))
-
-            row = 0
-	        #self.undo_buttons = QtGui.QButtonGroup()
-            for t in query.all():
-                # TODO Undo Button
-                # twi = QtGui.QTableWidgetItem('u')
-                # q = QtGui.QPushButton('undo', parent=twi)
-                # self.undo_buttons.addButton(q)
-                # self.undo_buttons.setId(q, t.id)
-                #self.ui.transactions.setItem(row, undo_c, twi)
-
-                # Date
-                twi = DateTableWidgetItem(
-                    datetime.date(t.date.year, t.date.month, t.date.day))
-                self.ui.transactions.setItem(row, date_c, twi)
-                # Amount
-                twi = MonetaryTableWidgetItem(t.amount)
-                twi.setTextAlignment(QtCore.Qt.AlignRight)
-                self.ui.transactions.setItem(row, amt_c, twi)
-                # Action and Account
-                if t.account is not None:
-                    twi = QtGui.QTableWidgetItem(t.account.name)
-                    self.ui.transactions.setItem(row, act_c, twi)
-                    if t.action == budse.Transaction.DEPOSIT:
-                        twi = QtGui.QTableWidgetItem('Deposit')
-                    if t.action == budse.Transaction.WITHDRAWAL:
-                        twi = QtGui.QTableWidgetItem('Withdrawal')
-                    self.ui.transactions.setItem(row, action_c, twi)
-                # Special logic for non-account transactions (aka meta
-                # transactions)
-                else:
-                    if t.action == budse.Transaction.DEDUCTION:
-                        twi = QtGui.QTableWidgetItem('')
-                        self.ui.transactions.setItem(row, act_c, twi)
-                        twi = QtGui.QTableWidgetItem('Deduction')
-                        self.ui.transactions.setItem(row, action_c, twi)
-                    elif t.action == budse.Transaction.TRANSFER:
-                        twi = QtGui.QTableWidgetItem('')
-                        self.ui.transactions.setItem(row, act_c, twi)
-                        twi = QtGui.QTableWidgetItem('Transfer')
-                        self.ui.transactions.setItem(row, action_c, twi)
-                    else:
-                        twi = QtGui.QTableWidgetItem('Whole Account')
-                        self.ui.transactions.setItem(row, act_c, twi)
-                        twi = QtGui.QTableWidgetItem('Deposit')
-                        self.ui.transactions.setItem(row, action_c, twi)
-                # Description
-                twi = QtGui.QTableWidgetItem(t.description)
-                self.ui.transactions.setItem(row, desc_c, twi)
-
-                row += 1
-            self.ui.transactions.setSortingEnabled(True)
+            model = TransactionTableModel(self.run_query, user_id, criteria,
+                                          names, page, limit, column, order,
+                                          parent=self)
+            header.show()
+            self.ui.transactions.setModel(model)
             self.ui.transactions.resizeColumnsToContents()
             self.ui.transactions.resizeRowsToContents()
 
+        # Searches that were just shown (e.g., going back to the whole
+        # account) do not need to wait for the database
+        page = self.search_cache.get(key)
+        if page is not None:
+            self.pending.pop('search', None)
+            show(page)
+        else:
+            self.run_query('search', first_page, show)
+
+    def search_criteria(self, user_id, keywords, whole_account, account_ids):
+        """Criteria of the transactions matching a search.
+
+        Keyword parameters:
+        user_id - ID of the user searching
+        keywords - List of lists of keywords (see parse_keyword)
+        whole_account - Whether the whole account is selected
+        account_ids - IDs of the selected accounts
+
+        Returns:
+        List of clauses on the budse.Transaction columns
+
+        """
+        # Base criteria no matter what the other criteria are
+        criteria = [budse.Transaction._user == user_id,
+                    budse.Transaction.status == True]
+        if keywords:
+            criteria.append(or_(*map(self.parse_keyword, keywords)))
+        if whole_account:
+            # Do not include subtransactions (e.g., a deposit from a whole
+            #     account deposit) when a high level view is desired
+            criteria.append(budse.Transaction._parent == None)
+        else:
+            # Compare the column so no Account objects have to be loaded,
+            # which also hides high level transactions (i.e., those w/o
+            # an account)
+            criteria.append(budse.Transaction._account.in_(account_ids))
+        return criteria
+
     def parse_keyword(self, keys):
         """Parse a list of keywords for searching Transaction objects.
 
@@ -1004,11 +1340,12 @@ class BudseGUI(QtGui.QMainWindow):
         
     def no_transactions(self):
         """Show a special message when no matching transactions are found."""
+        # Drop a search that is on its way since it is out of date
+        self.pending.pop('search', None)
         self.ui.transactions.horizontalHeader().hide()
-        self.ui.transactions.setRowCount(1)
-        self.ui.transactions.setColumnCount(1)
-        twi = QtGui.QTableWidgetItem('No matching transactions')
-        self.ui.transactions.setItem(0, 0, twi)
+        message = QtGui.QStandardItemModel(1, 1, self)
+        message.setItem(0, 0, QtGui.QStandardItem('No matching transactions'))
+        self.ui.transactions.setModel(message)
         self.ui.transactions.resizeColumnsToContents()
         self.ui.transactions.resizeRowsToContents()
 
@@ -1016,43 +1353,74 @@ class BudseGUI(QtGui.QMainWindow):
         """Displays a snapshot of the whole account.
 
         The snapshot will be the names and totals of all
-        of the accounts.  There will also be a total included
-        that will be the summation of the account totals.
+        of the accounts, along with where each total is headed
+        according to the forecast.  There will also be a total
+        included that will be the summation of the account totals.
+        The forecast is queried in the background and shown by
+        show_whole_account_snapshot.
 
         """
+        user_id = self.user.id
+        months = self.forecast_months
+
+        def totals(session):
+            accounts, user_total = balances.balances(session, user_id)
+            user = session.query(budse.User).get(user_id)
+            ignored, projection = forecast.forecast(session, user, months,
+                                                    active_only=False)
+            date, projected = projection[-1]
+            return ([(name, total, p) for (id, name, active, total), p
+                     in zip(accounts, projected)], user_total)
+
+        self.run_query('snapshot', totals, self.show_whole_account_snapshot)
+
+    def show_whole_account_snapshot(self, snapshot):
+        """Fill in the snapshot of the whole account.
+
+        Keyword parameters:
+        snapshot - (accounts, user total) where accounts is a list of
+            (name, total, forecast total) tuples, all in cents
+
+        """
+        accounts, user_total = snapshot
         self.ui.snapshot.clear()
         self.ui.snapshot.setWordWrap(False)
-        self.ui.snapshot.setColumnCount(2)
+        self.ui.snapshot.setColumnCount(3)
         self.ui.snapshot.horizontalHeader().show()
         self.ui.snapshot.setHorizontalHeaderLabels(('Account Name',
-                                                    'Account Total'))
-        self.ui.snapshot.setRowCount(len(self.user.accounts) + 2)
-        user_total = 0.00
+            'Account Total', '%d Month Forecast' % self.forecast_months))
+        self.ui.snapshot.setRowCount(len(accounts) + 2)
+        projected_total = 0
         row = 0
         # Calculate the snapshot for all of the user's accounts
-        for a in self.user.accounts:
-            user_total += a.total
+        for name, total, p in accounts:
+            projected_total += p
             # Account name
-            twi = QtGui.QTableWidgetItem(a.name)
+            twi = QtGui.QTableWidgetItem(name)
             twi.setTextAlignment(QtCore.Qt.AlignLeft)
             self.ui.snapshot.setItem(row, 0, twi)
-            # Account total
-            twi = QtGui.QTableWidgetItem('%0.2f' % a.total)
-            twi.setTextAlignment(QtCore.Qt.AlignRight)
-            if a.total < 0:
-                twi.setTextColor(QtGui.QColor('red'))
-            self.ui.snapshot.setItem(row, 1, twi)
+            # Account total and forecast
+            for column, value in ((1, total), (2, p)):
+                twi = QtGui.QTableWidgetItem(
+                    '%0.2f' % budse._format_out_amount(value))
+                twi.setTextAlignment(QtCore.Qt.AlignRight)
+                if value < 0:
+                    twi.setTextColor(QtGui.QColor('red'))
+                self.ui.snapshot.setItem(row, column, twi)
             row += 1
         # Print out the summation of the account totals
-        twi = QtGui.QTableWidgetItem('-------')
-        twi.setTextAlignment(QtCore.Qt.AlignRight)
-        self.ui.snapshot.setItem(row, 1, twi)
+        for column in (1, 2):
+            twi = QtGui.QTableWidgetItem('-------')
+            twi.setTextAlignment(QtCore.Qt.AlignRight)
+            self.ui.snapshot.setItem(row, column, twi)
         row += 1
-        twi = QtGui.QTableWidgetItem('%0.2f' % user_total)
-        twi.setTextAlignment(QtCore.Qt.AlignRight)
-        if user_total < 0:
-            twi.setTextColor(QtGui.QColor('red'))
-        self.ui.snapshot.setItem(row, 1, twi)
+        for column, value in ((1, user_total), (2, projected_total)):
+            twi = QtGui.QTableWidgetItem(
+                '%0.2f' % budse._format_out_amount(value))
+            twi.setTextAlignment(QtCore.Qt.AlignRight)
+            if value < 0:
+                twi.setTextColor(QtGui.QColor('red'))
+            self.ui.snapshot.setItem(row, column, twi)
         self.ui.snapshot.resizeRowsToContents()
 
     def accounts_snapshot(self):
@@ -1062,58 +1430,119 @@ class BudseGUI(QtGui.QMainWindow):
         no accounts are selected then call deselect_accounts (since
         that is essentially what is happening).  Otherwise display
         the pertinent details for the accounts selected, up to (and
-        including) all of the accounts.
+        including) all of the accounts.  The accounts are queried in
+        the background and shown by show_accounts_snapshot.
 
         """
-        checked_buttons = []
-        no_accounts = True
-        
-        for b in self.account_buttons.buttons():
-            if b.isChecked():
-                no_accounts = False
-                checked_buttons.append(b)
-        if no_accounts:
+        account_ids = [self.account_buttons.id(b)
+                       for b in self.account_buttons.buttons()
+                       if b.isChecked() and self.account_buttons.id(b) > 0]
+        if not account_ids:
             self.deselect_accounts.click()
             return
-        else:
-            self.ui.snapshot.clear()
-            self.ui.snapshot.setColumnCount(2)
-            self.ui.snapshot.horizontalHeader().hide()
-            # 7 properties: name, description, balance, type, amount,
-            #               affects gross/net, active
-            # plus whitespace line between them
-            self.ui.snapshot.setRowCount(len(checked_buttons) * 8)
-            row = 0
-            for b in checked_buttons:
-                b_id = self.account_buttons.id(b)
-                a = self.session.query(budse.Account).\
-                    filter(budse.Account.id == b_id).one()
-                # Loop through account's properties
-                for s in str(a).split(budse.str_delimiter):
-                    fields = s.split(budse.tag_delimiter)
-                    k = str(fields[0]).strip()
-                    v = str(fields[1]).strip()
-
-                    # Key/Tag
-                    twi = QtGui.QTableWidgetItem('%s' % k)
-                    twi.setTextAlignment(QtCore.Qt.AlignRight)
-                    twi.setTextColor(QtGui.QColor('gray'))
-                    self.ui.snapshot.setItem(row, 0, twi)
-                    k = k.upper()   # For comparisons
-
-                    # Value
-                    twi = QtGui.QTableWidgetItem('%s' % v)
-                    twi.setTextAlignment(QtCore.Qt.AlignLeft)
-                    # Chop off the currency symbol for comparisons
-                    if k == 'BALANCE' and float(v[1:]) < 0.00:  
-                        twi.setTextColor(QtGui.QColor('red'))
-                    self.ui.snapshot.setItem(row, 1, twi)
-                    row += 1
-                # Account delimiter (i.e., a blank line)
-                self.ui.snapshot.setItem(row, 0, QtGui.QTableWidgetItem(''))
+
+        def properties(session):
+            accounts = session.query(budse.Account).\
+                       filter(budse.Account.id.in_(account_ids))
+            descriptions = dict([(a.id, str(a)) for a in accounts])
+            return [descriptions[id] for id in account_ids
+                    if id in descriptions]
+
+        self.run_query('snapshot', properties, self.show_accounts_snapshot)
+
+    def show_accounts_snapshot(self, accounts):
+        """Fill in the snapshot of the selected accounts.
+
+        Keyword parameters:
+        accounts - List of the str() of each budse.Account
+
+        """
+        self.ui.snapshot.clear()
+        self.ui.snapshot.setColumnCount(2)
+        self.ui.snapshot.horizontalHeader().hide()
+        # 7 properties: name, description, balance, type, amount,
+        #               affects gross/net, active
+        # plus whitespace line between them
+        self.ui.snapshot.setRowCount(len(accounts) * 8)
+        row = 0
+        for a in accounts:
+            # Loop through account's properties
+            for s in a.split(budse.str_delimiter):
+                fields = s.split(budse.tag_delimiter)
+                k = str(fields[0]).strip()
+                v = str(fields[1]).strip()
+
+                # Key/Tag
+                twi = QtGui.QTableWidgetItem('%s' % k)
+                twi.setTextAlignment(QtCore.Qt.AlignRight)
+                twi.setTextColor(QtGui.QColor('gray'))
+                self.ui.snapshot.setItem(row, 0, twi)
+                k = k.upper()   # For comparisons
+
+                # Value
+                twi = QtGui.QTableWidgetItem('%s' % v)
+                twi.setTextAlignment(QtCore.Qt.AlignLeft)
+                # Chop off the currency symbol for comparisons
+                if k == 'BALANCE' and float(v[1:]) < 0.00:  
+                    twi.setTextColor(QtGui.QColor('red'))
+                self.ui.snapshot.setItem(row, 1, twi)
                 row += 1
-            self.ui.snapshot.setWordWrap(True)
-            self.ui.snapshot.resizeRowsToContents()
+            # Account delimiter (i.e., a blank line)
+            self.ui.snapshot.setItem(row, 0, QtGui.QTableWidgetItem(''))
+            row += 1
+        self.ui.snapshot.setWordWrap(True)
+        self.ui.snapshot.resizeRowsToContents()
+
+    def load_accounts(self):
+        """Load the registry of the user's accounts in a single query.
+
+        accounts_by_id is a dictionary of account ID to (name,
+        description) and account_order is the list of IDs in the order
+        the accounts are shown.
+
+        """
+        self.accounts_by_id = {}
+        self.account_order = []
+        for id, name, description in self.session.query(
+                budse.Account.id, budse.Account._name,
+                budse.Account.description).\
+                filter(budse.Account._user == self.user.id).\
+                order_by(budse.Account.id):
+            self.accounts_by_id[id] = (name, description)
+            self.account_order.append(id)
+
+    def run_query(self, kind, job, callback):
+        """Run a job on the QueryWorker and pass its result to a callback.
+
+        A newer job of the same kind replaces the callback, so only the
+        results of the latest one are shown.
+
+        Keyword parameters:
+        kind - Kind of query (e.g., 'search' or 'snapshot')
+        job - Callable taking a session and returning plain data
+        callback - Called on the GUI thread with the result
+
+        """
+        self.pending[kind] = (self.worker.submit(kind, job), callback)
+
+    def query_finished(self, kind, request, result):
+        kind = str(kind)
+        if self.pending.get(kind, (None, None))[0] == request:
+            request, callback = self.pending.pop(kind)
+            callback(result)
+
+    def query_failed(self, kind, request, message):
+        kind = str(kind)
+        if self.pending.get(kind, (None, None))[0] == request:
+            del self.pending[kind]
+            self.ui.statusBar.showMessage('Unable to query the %s: %s' %
+                                          (kind, message))
+
+    def closeEvent(self, event):
+        """Stop the query thread before the window closes."""
+        self.query_thread.quit()
+        self.query_thread.wait()
+        QtGui.QMainWindow.closeEvent(self, event)
 
     def account_changed(self, button):
         if not button.isChecked():
@@ -1145,6 +1574,14 @@ class BudseGUI(QtGui.QMainWindow):
     def change_preferences(self):
         preferences = PreferencesDialog(self.user, self.session)
         preferences.exec_()
+        # Names and descriptions may have changed
+        self.load_accounts()
+        for b in self.account_buttons.buttons():
+            id = self.account_buttons.id(b)
+            if id in self.accounts_by_id:
+                name, description = self.accounts_by_id[id]
+                b.setText(name)
+                b.setToolTip(description)
 
     def undo(self):
         print('undo')
@@ -0,0 +1,223 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Cash-flow forecasting for the accounts of a user
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import datetime
+
+from sqlalchemy import and_
+from sqlalchemy.sql.expression import func, select
+
+import balances
+import budse
+
+# How far back the history goes when calculating the average flow
+default_history_days = 365
+
+def add_months(date, months):
+    """Move a date forward a number of months, clamping to the month end.
+
+    Keyword arguments:
+    date -- datetime.date to start from
+    months -- Number of months to move forward
+
+    Returns:
+    datetime.date
+
+    """
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    for day in (date.day, 30, 29, 28):
+        try:
+            return datetime.date(year, month, day)
+        except ValueError:
+            continue
+
+def account_flows(session, user, since):
+    """Sum the active deposits and withdrawals of each account.
+
+    The sums are done by the database in a single grouped query so
+    that the cost does not grow with the number of accounts.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User whose accounts are summed
+    since -- datetime.date of the oldest transaction to include
+
+    Returns:
+    Dictionary of account ID to (deposits, withdrawals, first date)
+    where the sums are in integer cents
+
+    """
+    t = budse.transactions_table(session, user.id, since)
+    query = select([t.c.account_id, t.c.action, func.sum(t.c.amount),
+                    func.min(t.c.date)],
+                   and_(t.c.user_id == user.id,
+                        t.c.account_id != None,
+                        t.c.status == True,
+                        t.c.date >= since,
+                        t.c.action.in_([budse.Transaction.DEPOSIT,
+                                        budse.Transaction.WITHDRAWAL]))).\
+            group_by(t.c.account_id, t.c.action)
+    flows = {}
+    for account_id, action, amount, first in session.execute(query):
+        deposits, withdrawals, earliest = flows.get(account_id,
+                                                    (0, 0, None))
+        if isinstance(first, basestring):    # SQLite hands back text
+            first = datetime.datetime.strptime(first[:10], '%Y-%m-%d').date()
+        if earliest is None or (first is not None and first < earliest):
+            earliest = first
+        if action == budse.Transaction.DEPOSIT:
+            deposits += amount or 0
+        else:
+            withdrawals += amount or 0
+        flows[account_id] = (deposits, withdrawals, earliest)
+    return flows
+
+def daily_rates(flows, today, history_days=default_history_days):
+    """Convert summed flows into an average net change per day.
+
+    Accounts younger than the history window are averaged over their
+    own lifetime so that a new account is not diluted by empty days.
+
+    Keyword arguments:
+    flows -- Dictionary returned by account_flows
+    today -- datetime.date the history ends on
+    history_days -- Length of the history window (default 365)
+
+    Returns:
+    Dictionary of account ID to net cents per day (float)
+
+    """
+    rates = {}
+    for account_id, (deposits, withdrawals, first) in flows.items():
+        days = history_days
+        if first is not None:
+            days = min(days, (today - first).days + 1)
+        rates[account_id] = float(deposits - withdrawals) / max(days, 1)
+    return rates
+
+def project_daily(totals, rates, start, days):
+    """Project balances forward day by day.
+
+    Keyword arguments:
+    totals -- List of (account ID, balance in cents) tuples
+    rates -- Dictionary of account ID to net cents per day
+    start -- datetime.date the balances are current as of
+    days -- Number of days to project
+
+    Returns:
+    (dates, grid) where dates is the list of the days after start and
+    grid has a row for each account, in the same order as totals, of
+    its balance in cents on each of those days
+
+    """
+    dates = [start + datetime.timedelta(days=day)
+             for day in range(1, days + 1)]
+    grid = []
+    for id, total in totals:
+        rate = rates.get(id, 0)
+        grid.append([total + int(round(rate * day))
+                     for day in xrange(1, days + 1)])
+    return dates, grid
+
+def project(totals, rates, start, months):
+    """Project balances forward at the end of each month.
+
+    The month ends are read from the daily projection.
+
+    Keyword arguments:
+    totals -- List of (account ID, balance in cents) tuples
+    rates -- Dictionary of account ID to net cents per day
+    start -- datetime.date the balances are current as of
+    months -- Number of months to project
+
+    Returns:
+    List of (datetime.date, [balance in cents, ...]) tuples, one per
+    month, with the balances in the same order as totals
+
+    """
+    ends = [add_months(start, month) for month in range(1, months + 1)]
+    dates, grid = project_daily(totals, rates, start,
+                                (ends[-1] - start).days)
+    projection = []
+    for date in ends:
+        day = (date - start).days - 1
+        projection.append((date, [row[day] for row in grid]))
+    return projection
+
+def _current(session, user, today, history_days, active_only):
+    """The accounts, their balances and their daily rates."""
+    if today is None:
+        today = datetime.date.today()
+    accounts = [a for a in user.accounts if a.status or not active_only]
+    since = today - datetime.timedelta(days=history_days)
+    rates = daily_rates(account_flows(session, user, since), today,
+                        history_days)
+    current = dict([(id, total) for id, name, active, total
+                    in balances.balances(session, user.id)[0]])
+    totals = [(a.id, current.get(a.id, 0)) for a in accounts]
+    return accounts, totals, rates, today
+
+def forecast(session, user, months=12, today=None,
+             history_days=default_history_days, active_only=True):
+    """Forecast the balance of each of the user's accounts.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User to forecast for
+    months -- Number of months to project (default 12)
+    today -- datetime.date to project from (default today)
+    history_days -- Days of history to average (default 365)
+    active_only -- Only forecast the active accounts (default True)
+
+    Returns:
+    (accounts, projection) where accounts is the list of Account
+    objects and projection is the list returned by project
+
+    """
+    if months < 1:
+        raise budse.ParameterException('Must forecast at least one month')
+    accounts, totals, rates, today = _current(session, user, today,
+                                              history_days, active_only)
+    return accounts, project(totals, rates, today, months)
+
+def daily_forecast(session, user, days=365, today=None,
+                   history_days=default_history_days, active_only=True):
+    """Forecast the balance of each of the user's accounts on every day.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User to forecast for
+    days -- Number of days to project (default 365)
+    today -- datetime.date to project from (default today)
+    history_days -- Days of history to average (default 365)
+    active_only -- Only forecast the active accounts (default True)
+
+    Returns:
+    (accounts, dates, grid) where accounts is the list of Account
+    objects and dates and grid are as returned by project_daily
+
+    """
+    if days < 1:
+        raise budse.ParameterException('Must forecast at least one day')
+    accounts, totals, rates, today = _current(session, user, today,
+                                              history_days, active_only)
+    dates, grid = project_daily(totals, rates, today, days)
+    return accounts, dates, grid
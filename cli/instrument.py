@@ -0,0 +1,181 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Count the queries, rows and SQL time of operations
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+from __future__ import with_statement
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import mapper
+
+import budse
+
+class Stats(object):
+    """Queries, rows and SQL time of an operation.
+
+    Rows are those changed by INSERT, UPDATE and DELETE statements plus
+    the objects the ORM loaded; the rows of a plain SELECT that were
+    not loaded into objects are not counted.  Seconds are the time
+    spent executing SQL, not the whole operation, so the time a user
+    takes to answer a prompt does not count.
+
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.runs = 0
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, other):
+        self.runs += other.runs
+        self.queries += other.queries
+        self.rows += other.rows
+        self.seconds += other.seconds
+
+    def __str__(self):
+        return ('%s: %d queries, %d rows, %0.1f ms SQL' %
+                (self.name or 'SQL', self.queries, self.rows,
+                 self.seconds * 1000))
+
+# Engines being counted
+_engines = set()
+_loads_counted = False
+# Stats being counted by each thread, innermost last
+_local = threading.local()
+# Dictionary of operation name to the Stats of all its runs
+_totals = {}
+_lock = threading.Lock()
+
+def _active():
+    return getattr(_local, 'active', None)
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    if _active():
+        conn.info.setdefault('instrument_start', []).append(time.time())
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    active = _active()
+    if not active or not conn.info.get('instrument_start'):
+        return
+    elapsed = time.time() - conn.info['instrument_start'].pop()
+    rows = max(cursor.rowcount, 0)
+    for stats in active:
+        stats.queries += 1
+        stats.rows += rows
+        stats.seconds += elapsed
+
+def _loaded(target, context):
+    for stats in _active() or ():
+        stats.rows += 1
+
+def install(engine=None):
+    """Start counting the statements run by an engine.
+
+    Connections opened before this keep running uncounted, so it is
+    best called right after the library is configured.  Outside of
+    profile blocks nothing is counted.
+
+    Keyword arguments:
+    engine -- Engine to count (default budse.engine, configured with
+        the defaults if it is not yet)
+
+    """
+    global _loads_counted
+    if engine is None:
+        engine = budse.engine or budse.configure()
+    _lock.acquire()
+    try:
+        if engine not in _engines:
+            event.listen(engine, 'before_cursor_execute', _before_execute)
+            event.listen(engine, 'after_cursor_execute', _after_execute)
+            _engines.add(engine)
+        if not _loads_counted:
+            event.listen(mapper, 'load', _loaded)
+            _loads_counted = True
+    finally:
+        _lock.release()
+
+@contextmanager
+def profile(name=None, budget=None):
+    """Count the queries, rows and SQL time of a block.
+
+    Blocks can be nested, and the statements of an inner block count
+    toward the outer ones as well.  Named blocks are added to the
+    totals (see totals).  Only the statements of the current thread
+    are counted.
+
+        with instrument.profile('deposit') as stats:
+            ...
+        print stats
+
+    Keyword arguments:
+    name -- Name of the operation (default None)
+    budget -- Most queries the block may run, QueryBudgetException is
+        raised at its end when it runs more (default None)
+
+    """
+    if not _engines:
+        install()
+    stats = Stats(name)
+    stats.runs = 1
+    if _active() is None:
+        _local.active = []
+    _local.active.append(stats)
+    try:
+        yield stats
+    finally:
+        _local.active.remove(stats)
+        if name is not None:
+            _lock.acquire()
+            try:
+                _totals.setdefault(name, Stats(name)).add(stats)
+            finally:
+                _lock.release()
+    if budget is not None and stats.queries > budget:
+        raise budse.QueryBudgetException('%s ran %d queries, over its budget '
+                                         'of %d' % (name or 'Block',
+                                                    stats.queries, budget),
+                                         stats)
+
+def totals():
+    """Stats of every named operation so far, by name."""
+    _lock.acquire()
+    try:
+        return [_totals[name] for name in sorted(_totals)]
+    finally:
+        _lock.release()
+
+def report():
+    """Totals of each named operation as lines of text."""
+    return '\n'.join(['%s (%d run%s)' % (stats, stats.runs,
+                                         's' if stats.runs != 1 else '')
+                      for stats in totals()])
+
+def reset():
+    """Forget the totals."""
+    _lock.acquire()
+    try:
+        _totals.clear()
+    finally:
+        _lock.release()
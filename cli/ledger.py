@@ -0,0 +1,266 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Balance, daily balance and period projections of the ledger
+#     events, brought up to date incrementally
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+from sqlalchemy import and_, case
+from sqlalchemy.sql.expression import func, select
+
+import budse
+
+BALANCES = 'balances'
+DAILY_BALANCES = 'daily_balances'
+PERIOD_ACTIVITY = 'period_activity'
+projections = (BALANCES, DAILY_BALANCES, PERIOD_ACTIVITY)
+
+def _sign(e):
+    """1 for the events that post a transaction, -1 for reversals."""
+    return case([(e.c.kind == budse.LedgerEvent.REVERSE, -1)], else_=1)
+
+def _change(e):
+    """What an event does to the balance of its account, in cents."""
+    return _sign(e) * case([(e.c.action == budse.Transaction.DEPOSIT,
+                             e.c.amount),
+                            (e.c.action == budse.Transaction.WITHDRAWAL,
+                             -e.c.amount)], else_=0)
+
+def _events(e, first, last):
+    """Transaction events after one event ID up to another."""
+    return and_(e.c.event_id > first, e.c.event_id <= last,
+                e.c.kind.in_([budse.LedgerEvent.POST,
+                              budse.LedgerEvent.REVERSE]))
+
+def _add(session, table, key, values):
+    """Add values to the columns of a projection's row, making it first
+    if needed."""
+    criteria = and_(*[table.c[name] == value for name, value in key.items()])
+    if session.execute(table.update().where(criteria).values(
+            dict([(name, table.c[name] + value)
+                  for name, value in values.items()]))).rowcount == 0:
+        row = dict(key)
+        row.update(values)
+        session.execute(table.insert(), row)
+
+def _apply_balances(session, first, last):
+    e = budse.LedgerEvent.__table__
+    table = budse.AccountBalance.__table__
+    query = select([e.c.account_id, func.sum(_change(e))],
+                   and_(_events(e, first, last), e.c.account_id != None)).\
+            group_by(e.c.account_id)
+    for account_id, change in session.execute(query).fetchall():
+        _add(session, table, {'account_id': account_id},
+             {'balance': change or 0})
+
+def _apply_daily_balances(session, first, last):
+    e = budse.LedgerEvent.__table__
+    table = budse.DailyBalance.__table__
+    query = select([e.c.account_id, e.c.date, func.sum(_change(e))],
+                   and_(_events(e, first, last), e.c.account_id != None)).\
+            group_by(e.c.account_id, e.c.date)
+    for account_id, date, change in session.execute(query).fetchall():
+        _add(session, table, {'account_id': account_id, 'date': date},
+             {'change': change or 0})
+
+def _apply_period_activity(session, first, last):
+    e = budse.LedgerEvent.__table__
+    table = budse.PeriodActivity.__table__
+    month = func.strftime('%Y-%m', e.c.date)
+    # Whole account deposits and transfers are counted by their parts
+    query = select([e.c.user_id, e.c.account_id, month, e.c.action,
+                    func.sum(_sign(e) * e.c.amount)],
+                   and_(_events(e, first, last),
+                        e.c.date != None,
+                        e.c.action.in_([budse.Transaction.DEPOSIT,
+                                        budse.Transaction.WITHDRAWAL,
+                                        budse.Transaction.DEDUCTION]),
+                        (e.c.account_id != None) |
+                        (e.c.action == budse.Transaction.DEDUCTION))).\
+            group_by(e.c.user_id, e.c.account_id, month, e.c.action)
+    columns = {budse.Transaction.DEPOSIT: 'deposits',
+               budse.Transaction.WITHDRAWAL: 'withdrawals',
+               budse.Transaction.DEDUCTION: 'deductions'}
+    for user_id, account_id, label, action, amount in \
+            session.execute(query).fetchall():
+        year, month_number = label.split('-')
+        _add(session, table, {'user_id': user_id, 'account_id': account_id,
+                              'period': int(year) * 12 + int(month_number) - 1},
+             {columns[action]: amount or 0})
+
+_appliers = {BALANCES: _apply_balances,
+             DAILY_BALANCES: _apply_daily_balances,
+             PERIOD_ACTIVITY: _apply_period_activity}
+
+def catch_up(session, names=projections):
+    """Apply the ledger events that the projections have not seen yet.
+
+    Each projection remembers the last event applied to it, so only
+    the events since are read, grouped by what they change.  Nothing
+    is committed.
+
+    Keyword arguments:
+    session -- Session to use
+    names -- Names of the projections to bring up to date (default all)
+
+    Returns:
+    Number of events applied to the projection that was furthest behind
+
+    """
+    session.flush()
+    last = session.query(func.max(budse.LedgerEvent.id)).scalar() or 0
+    applied = 0
+    for name in names:
+        mark = session.query(budse.ProjectionMark).get(name)
+        if mark is None:
+            mark = budse.ProjectionMark(name=name, last_event=0)
+            session.add(mark)
+        if mark.last_event >= last:
+            continue
+        _appliers[name](session, mark.last_event, last)
+        applied = max(applied, last - mark.last_event)
+        mark.last_event = last
+    session.flush()
+    return applied
+
+def rebuild(session, names=projections):
+    """Replay every ledger event into the projections from scratch.
+
+    Nothing is committed.
+
+    Keyword arguments:
+    session -- Session to use
+    names -- Names of the projections to rebuild (default all)
+
+    """
+    tables = {BALANCES: budse.AccountBalance.__table__,
+              DAILY_BALANCES: budse.DailyBalance.__table__,
+              PERIOD_ACTIVITY: budse.PeriodActivity.__table__}
+    for name in names:
+        session.execute(tables[name].delete())
+        mark = session.query(budse.ProjectionMark).get(name)
+        if mark is not None:
+            mark.last_event = 0
+    return catch_up(session, names)
+
+def balances(session, user_id):
+    """Balance of each of a user's accounts from the projection.
+
+    Returns:
+    Dictionary of account ID to balance in integer cents
+
+    """
+    catch_up(session, (BALANCES,))
+    a = budse.Account.__table__
+    b = budse.AccountBalance.__table__
+    query = select([b.c.account_id, b.c.balance],
+                   and_(b.c.account_id == a.c.account_id,
+                        a.c.user_id == user_id))
+    return dict(session.execute(query).fetchall())
+
+def daily_balances(session, account_id, first, last):
+    """Closing balance of an account on each day that it changed.
+
+    Keyword arguments:
+    session -- Session to use
+    account_id -- ID of the account
+    first -- datetime.date of the first day
+    last -- datetime.date of the last day
+
+    Returns:
+    (opening balance, [(datetime.date, closing balance), ...]) in
+    integer cents, where the opening balance is that before the first
+    day
+
+    """
+    catch_up(session, (DAILY_BALANCES,))
+    d = budse.DailyBalance.__table__
+    opening = session.execute(select([func.sum(d.c.change)],
+                                     and_(d.c.account_id == account_id,
+                                          d.c.date < first))).scalar() or 0
+    balance = opening
+    days = []
+    for date, change in session.execute(
+            select([d.c.date, d.c.change],
+                   and_(d.c.account_id == account_id, d.c.date >= first,
+                        d.c.date <= last)).order_by(d.c.date)):
+        balance += change
+        days.append((date, balance))
+    return opening, days
+
+def period_activity(session, user_id, first, last):
+    """Deposits, withdrawals and deductions of each account by period.
+
+    Keyword arguments:
+    session -- Session to use
+    user_id -- ID of the user
+    first -- First period number (see budse.period_of)
+    last -- Last period number
+
+    Returns:
+    Dictionary of period to {account ID (None for the deductions):
+    (deposits, withdrawals, deductions)} in integer cents
+
+    """
+    catch_up(session, (PERIOD_ACTIVITY,))
+    p = budse.PeriodActivity.__table__
+    periods = {}
+    for period in range(first, last + 1):
+        periods[period] = {}
+    for period, account_id, deposits, withdrawals, deductions in \
+            session.execute(select([p.c.period, p.c.account_id, p.c.deposits,
+                                    p.c.withdrawals, p.c.deductions],
+                                   and_(p.c.user_id == user_id,
+                                        p.c.period >= first,
+                                        p.c.period <= last))):
+        periods[period][account_id] = (deposits, withdrawals, deductions)
+    return periods
+
+def repair_totals(session, user_id=None):
+    """Set the account totals to the balances projected from the events.
+
+    For recovering from a crash or a bad write to accounts.account_total
+    without going through every transaction again.  Nothing is
+    committed.
+
+    Keyword arguments:
+    session -- Session to use
+    user_id -- ID of the user whose totals to repair (default everyone)
+
+    Returns:
+    Number of accounts whose total was changed
+
+    """
+    catch_up(session, (BALANCES,))
+    a = budse.Account.__table__
+    b = budse.AccountBalance.__table__
+    projected = select([func.coalesce(func.sum(b.c.balance), 0)],
+                       b.c.account_id == a.c.account_id).as_scalar()
+    criteria = func.coalesce(a.c.account_total, 0) != projected
+    if user_id is not None:
+        criteria = and_(criteria, a.c.user_id == user_id)
+    users = [row[0] for row in session.execute(
+        select([a.c.user_id], criteria).distinct()).fetchall()]
+    changed = session.execute(a.update().where(criteria).values(
+        account_total=projected)).rowcount
+    for obj in session.identity_map.values():
+        if isinstance(obj, budse.Account):
+            session.expire(obj, ['_total'])
+    # The totals were changed with SQL, which the ORM events do not see
+    for user in users:
+        budse.bump_ledger_version(user)
+    return changed
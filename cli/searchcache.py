@@ -0,0 +1,142 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Least recently used cache of search results
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import threading
+
+import budse
+
+def search_key(user_id, account_ids=None, keywords=None, begin_date=None,
+               end_date=None, limit=None, *extra):
+    """Normalize search criteria into a key for a SearchCache.
+
+    Criteria that select the same transactions make the same key, no
+    matter the order the accounts were checked or the keywords were
+    entered in.
+
+    Keyword arguments:
+    user_id -- ID of the user searching
+    account_ids -- IDs of the accounts searched (default None for all)
+    keywords -- List of lists of keywords (default None)
+    begin_date -- datetime.date the search starts on (default None)
+    end_date -- datetime.date the search ends on (default None)
+    limit -- Maximum number of results (default None)
+    extra -- Anything else the results depend on (e.g., the sort order)
+
+    Returns:
+    Hashable tuple
+
+    """
+    if account_ids is not None:
+        account_ids = tuple(sorted(set(account_ids)))
+    if keywords:
+        keywords = tuple(sorted(set([tuple(sorted(set([unicode(k).lower()
+                                                       for k in group])))
+                                     for group in keywords])))
+    else:
+        keywords = ()
+    return (user_id, account_ids, keywords, begin_date, end_date,
+            limit) + tuple(extra)
+
+class SearchCache(object):
+    """Search results of the most recent searches.
+
+    Each result is stored with the ledger version (see
+    budse.ledger_version) of the user it was computed at, and it is
+    only handed back while that is still the current version.  Any
+    commit that changes the user's transactions therefore invalidates
+    exactly the results that it could have changed.  The cache is
+    shared between threads, so the results should be plain values
+    (e.g., formatted output or rows of text) rather than mapped objects,
+    which belong to the session that loaded them.
+
+    """
+    def __init__(self, size=32):
+        """Initialize an empty cache.
+
+        Keyword arguments:
+        size -- Most results to keep (default 32)
+
+        """
+        if size < 1:
+            raise budse.ParameterException('Cache size must be at least 1')
+        self.size = size
+        # Dictionary of key to (ledger version, result)
+        self._results = {}
+        # Keys from the least to the most recently used
+        self._order = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, default=None):
+        """Result of a search, if it is cached and still current.
+
+        Keyword arguments:
+        key -- Key made by search_key
+        default -- Returned when there is no current result (default None)
+
+        """
+        self._lock.acquire()
+        try:
+            if key not in self._results:
+                return default
+            version, result = self._results[key]
+            self._order.remove(key)
+            if version != budse.ledger_version(key[0]):
+                del self._results[key]
+                return default
+            self._order.append(key)
+            return result
+        finally:
+            self._lock.release()
+
+    def put(self, key, result, version=None):
+        """Cache the result of a search.
+
+        Keyword arguments:
+        key -- Key made by search_key
+        result -- Result of the search
+        version -- Ledger version the search started at (default the
+            current version); passing it in keeps a search that raced
+            with a commit from being cached as current
+
+        """
+        if version is None:
+            version = budse.ledger_version(key[0])
+        self._lock.acquire()
+        try:
+            if key in self._results:
+                self._order.remove(key)
+            self._results[key] = (version, result)
+            self._order.append(key)
+            while len(self._order) > self.size:
+                del self._results[self._order.pop(0)]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Forget every cached result."""
+        self._lock.acquire()
+        try:
+            self._results.clear()
+            del self._order[:]
+        finally:
+            self._lock.release()
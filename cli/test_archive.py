@@ -0,0 +1,94 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Tests that archiving transactions keeps the accounts balanced.
+#     Run from this directory with
+#
+#         python -m unittest test_archive
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import budse
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.db')
+        budse.configure(self.path)
+        self.session = budse.initialize()
+        budse.session = self.session
+        self.user = budse.User('bob')
+        self.spam = budse.Account(self.user, 'Spam', None,
+                                  budse.Account.PERCENTAGE, 0.5, False)
+        self.eggs = budse.Account(self.user, 'Eggs', None,
+                                  budse.Account.PERCENTAGE, 0.5, False)
+        self.spam.name = 'Spam'
+        self.eggs.name = 'Eggs'
+        self.session.add_all([self.user, self.spam, self.eggs])
+        self.session.commit()
+        for month in range(1, 13):
+            date = datetime.date(2025, month, 10)
+            deposit = budse.Deposit(self.user, 1000, date, 'pay',
+                                    duplicate_override=True)
+            deposit.commit()
+            self.session.add(deposit)
+            withdrawal = budse.Withdrawal(self.user, 5 * month, date, 'food',
+                                          self.spam, duplicate_override=True)
+            withdrawal.commit()
+            self.session.add(withdrawal)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        budse.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _ids(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            return set([row[0] for row in connection.execute(
+                'SELECT transaction_id FROM transactions')])
+        finally:
+            connection.close()
+
+    def _assert_reconciled(self):
+        for account, total, recalculated in \
+                budse.recalculate_account_totals([self.spam, self.eggs]):
+            self.assertEqual(total, recalculated)
+
+    def test_totals_reconcile(self):
+        self._assert_reconciled()
+        before = self._ids(self.path)
+        for cutoff in (datetime.date(2025, 2, 1), datetime.date(2025, 7, 1)):
+            budse.archive_transactions(self.session, self.user, cutoff)
+            self._assert_reconciled()
+            main = self._ids(self.path)
+            archived = self._ids(budse.archive_file)
+            self.assertEqual(main & archived, set())
+            self.assertEqual(main | archived, before)
+        # Each month is a deposit split into two and a withdrawal
+        self.assertEqual(len(archived), 6 * 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Tests that snapshots carry the batches of the command line
+#     database and which transactions each one made.  Run from this
+#     directory with
+#
+#         python -m unittest test_snapshot
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+from __future__ import with_statement
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import budse
+import snapshot
+
+class BatchRoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        budse.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _make(self, name, label):
+        """A database with a batch of two deposits, a transfer made
+        before its batch block and a withdrawal in no batch."""
+        budse.configure(self._path(name))
+        session = budse.initialize()
+        user = budse.User(label)
+        spam = budse.Account(user, 'Spam', None, budse.Account.PERCENTAGE,
+                             0.5, False)
+        eggs = budse.Account(user, 'Eggs', None, budse.Account.PERCENTAGE,
+                             0.5, False)
+        spam.name = 'Spam'
+        eggs.name = 'Eggs'
+        session.add_all([user, spam, eggs])
+        session.commit()
+        today = datetime.date(2012, 3, 1)
+        with budse.batch(session, user, '%s import' % label):
+            for amount in (100, 200):
+                deposit = budse.Deposit(user, amount, today, label,
+                                        duplicate_override=True)
+                deposit.commit()
+                session.add(deposit)
+        transfer = budse.Transfer(user, 5, today, eggs, spam, label)
+        with budse.batch(session, user, '%s transfer' % label) as made:
+            transfer.commit()
+            made.add(transfer)
+            session.add(transfer)
+        withdrawal = budse.Withdrawal(user, 7, today, label, spam,
+                                      duplicate_override=True)
+        withdrawal.commit()
+        session.add(withdrawal)
+        session.commit()
+        session.close()
+        return self._path(name)
+
+    def _members(self, path):
+        """Description of each batch and the transactions it made."""
+        connection = sqlite3.connect(path)
+        try:
+            members = {}
+            for description, action, amount in connection.execute(
+                    'SELECT b.description, t.action, t.amount '
+                    'FROM transactions t LEFT JOIN batches b '
+                    'ON b.batch_id = t.batch_id'):
+                members.setdefault(description, []).append((action, amount))
+            for transactions in members.values():
+                transactions.sort()
+            return members
+        finally:
+            connection.close()
+
+    def _round_trip(self, source, target):
+        path = self._path('data.snap')
+        database = snapshot.CliDatabase(source)
+        try:
+            snapshot.dump(database, path)
+        finally:
+            database.close()
+        database = snapshot.CliDatabase(target)
+        try:
+            counts = snapshot.load(database, path)
+        finally:
+            database.close()
+        self.assertEqual(counts['batches'], (2, 2))
+
+    def test_batches_made(self):
+        members = self._members(self._make('source.db', 'bob'))
+        self.assertEqual(len(members['bob import']), 6)
+        self.assertEqual(len(members['bob transfer']), 3)
+        self.assertEqual(members[None], [('-', 700)])
+
+    def test_empty_database(self):
+        source = self._make('source.db', 'bob')
+        target = self._path('target.db')
+        self._round_trip(source, target)
+        self.assertEqual(self._members(target), self._members(source))
+
+    def test_after_other_batches(self):
+        source = self._make('source.db', 'bob')
+        target = self._make('target.db', 'alice')
+        expected = self._members(source)
+        for description, transactions in self._members(target).items():
+            if description is None:
+                transactions = sorted(transactions + expected[None])
+            expected[description] = transactions
+        self._round_trip(source, target)
+        self.assertEqual(self._members(target), expected)
+
+if __name__ == '__main__':
+    unittest.main()
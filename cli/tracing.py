@@ -0,0 +1,150 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Timing spans around the operations of the library, written as
+#     JSON lines or kept in a ring buffer
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+from __future__ import with_statement
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class RingBuffer(object):
+    """Keeps the most recent spans in memory."""
+    def __init__(self, size=1000):
+        self.spans = deque(maxlen=size)
+
+    def write(self, span):
+        self.spans.append(span)
+
+    def recent(self, count=None):
+        """The most recent spans, oldest first."""
+        spans = list(self.spans)
+        if count is not None:
+            spans = spans[-count:]
+        return spans
+
+class JsonLinesFile(object):
+    """Appends each span to a file as a line of JSON."""
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._file = open(filename, 'a')
+
+    def write(self, span):
+        line = json.dumps(span, sort_keys=True, default=str)
+        self._lock.acquire()
+        try:
+            self._file.write(line + '\n')
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._file.close()
+
+# Where finished spans go; nothing is timed while this is empty
+sinks = []
+_ids = itertools.count(1)
+# Open spans of each thread, innermost last
+_local = threading.local()
+
+def enabled():
+    return bool(sinks)
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def begin(name, **attributes):
+    """Open a span, returning it for finish (None when not tracing).
+
+    For spans that start and end in different callbacks; span is
+    simpler everywhere else.
+
+    """
+    if not sinks:
+        return None
+    stack = _stack()
+    id = _ids.next()
+    span = {'name': name, 'span': id,
+            'trace': stack[-1]['trace'] if stack else id,
+            'parent': stack[-1]['span'] if stack else None,
+            'thread': threading.currentThread().getName(),
+            'start': time.time()}
+    if attributes:
+        span['attributes'] = attributes
+    stack.append(span)
+    return span
+
+def finish(span, error=None):
+    """Close a span opened with begin and hand it to the sinks."""
+    if span is None:
+        return
+    span['duration_ms'] = (time.time() - span['start']) * 1000
+    if error is not None:
+        span['error'] = error
+    stack = _stack()
+    if span in stack:
+        # Spans left open inside it (e.g., by an exception) end with it
+        del stack[stack.index(span):]
+    for sink in sinks:
+        sink.write(span)
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a span, nested in the span open around it.
+
+        with tracing.span('deposit', user=user.id):
+            ...
+
+    Keyword arguments:
+    name -- Name of the operation
+    attributes -- Anything else to record with the span
+
+    """
+    opened = begin(name, **attributes)
+    try:
+        yield opened
+    except BaseException, e:
+        finish(opened, e.__class__.__name__)
+        raise
+    finish(opened)
+
+def configure(filename=None, buffer_size=None):
+    """Start tracing to a JSON lines file and/or a ring buffer.
+
+    Keyword arguments:
+    filename -- File to append the spans to (default None)
+    buffer_size -- Spans to keep in memory (default None for none)
+
+    Returns:
+    The RingBuffer, if there is one
+
+    """
+    buffer = None
+    if filename is not None:
+        sinks.append(JsonLinesFile(filename))
+    if buffer_size:
+        buffer = RingBuffer(buffer_size)
+        sinks.append(buffer)
+    return buffer
@@ -0,0 +1,132 @@
+############################
+# BUDget for Spam and Eggs (Budse)
+#
+# Description:
+#     Budget variance of allocations against actual spending
+#
+# Requirements:
+#     1) Python 2.6.* - might be (but not guaranteed to be) Py3k compatible
+#     2) SQL Alchemy
+#
+# License:
+#     Released under the GPL, a copy of which can be found at
+#     http://www.gnu.org/copyleft/gpl.html
+#
+# Author:
+#     Derek Wong
+#     http://www.goingthewongway.com
+#
+############################
+
+import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+
+import budse
+
+# Variances of the months that have ended, which only change when a
+# transaction is back-dated into them
+# Dictionary of (user ID, period) to {account ID: (allocated, spent)}
+_closed_periods = {}
+
+def _period_sums(session, user, first, last):
+    """Sum deposits and withdrawals by account and period in one query.
+
+    Returns:
+    Dictionary of period to {account ID: (allocated, spent)} in cents
+
+    """
+    begin, trash = budse.period_bounds(first)
+    trash, end = budse.period_bounds(last)
+    periods = {}
+    for period in range(first, last + 1):
+        periods[period] = {}
+    for period, accounts in budse.summarize_dates(session, user.id, begin,
+                                                  end, by_period=True).\
+            items():
+        periods[period] = _allocations(accounts)
+    return periods
+
+def _allocations(accounts):
+    """Allocated and spent of each account from the deposits,
+    withdrawals, deductions and transfers that it was summarized to."""
+    allocations = {}
+    for account_id, values in accounts.items():
+        if account_id is not None:
+            # A transfer moves an allocation from one account to another
+            allocations[account_id] = (values[0] + values[3], values[1])
+    return allocations
+
+def variance(session, user, first, last, today=None):
+    """Allocation against spending for each account and period.
+
+    Allocations are whatever was deposited into an account (i.e., the
+    whole account deposit configuration or a direct deposit) plus what
+    was transferred into it less what was transferred out, and the
+    spending is whatever was withdrawn.  Closed periods are read from
+    their summaries and the other periods that have ended are cached,
+    so only the open period and any that have not been seen yet are
+    summed from the transaction log, and those with a single query.
+
+    Keyword arguments:
+    session -- Session to query with
+    user -- User to compare the accounts of
+    first -- First period number (see budse.period_of)
+    last -- Last period number
+    today -- datetime.date that decides the open period (default today)
+
+    Returns:
+    List of (period label, [(Account, allocated, spent, variance)])
+    tuples in cents, one per period
+
+    """
+    if first > last:
+        raise budse.ParameterException('First period is after the last')
+    if today is None:
+        today = datetime.date.today()
+    current = budse.period_of(today)
+    closed = budse.closed_summaries(session, user, first, last)
+    needed = [p for p in range(first, last + 1) if p not in closed and
+              (p >= current or (user.id, p) not in _closed_periods)]
+    sums = {}
+    if needed:
+        sums = _period_sums(session, user, min(needed), max(needed))
+        for period, accounts in sums.items():
+            if period < current:
+                _closed_periods[(user.id, period)] = accounts
+    results = []
+    for period in range(first, last + 1):
+        if period in closed:
+            accounts = _allocations(closed[period])
+        elif period in sums:
+            accounts = sums[period]
+        else:
+            accounts = _closed_periods[(user.id, period)]
+        rows = []
+        for account in user.accounts:
+            allocated, spent = accounts.get(account.id, (0, 0))
+            rows.append((account, allocated, spent, allocated - spent))
+        results.append((budse.period_label(period), rows))
+    return results
+
+def invalidate(user_id, date=None):
+    """Forget the cached variance for the period of a date (default
+    every period of the user)."""
+    if date is not None:
+        _closed_periods.pop((user_id, budse.period_of(date)), None)
+        return
+    for key in [key for key in _closed_periods if key[0] == user_id]:
+        del _closed_periods[key]
+
+def _invalidate_flushed(session, flush_context):
+    """Forget the cached periods that flushed transactions fall in."""
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, budse.Transaction):
+            added, unchanged, deleted = get_history(obj, 'date')
+            for date in list(added or ()) + list(unchanged or ()) + \
+                        list(deleted or ()):
+                if date is not None:
+                    invalidate(obj._user, date)
+
+event.listen(budse.Session, 'after_flush', _invalidate_flushed)
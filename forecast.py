@@ -0,0 +1,141 @@
+import datetime
+from sqlalchemy import and_
+from sqlalchemy.sql.expression import func, select
+from app import db
+from models import Account, Transaction, ParameterException
+import balances
+import membership
+
+# How far back the history goes when calculating the average flow
+default_history_days = 365
+
+def add_months(date, months):
+    """Move a date forward a number of months, clamping to the month end."""
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    for day in (date.day, 30, 29, 28):
+        try:
+            return datetime.date(year, month, day)
+        except ValueError:
+            continue
+
+def account_flows(user, since):
+    """Sum the active deposits and withdrawals of each account.
+
+    Keyword arguments:
+    user -- User whose accounts (including shared ones) are summed
+    since -- datetime.date of the oldest transaction to include
+
+    Returns:
+    Dictionary of account ID to (deposits, withdrawals, first date)
+    where the sums are in integer cents
+
+    """
+    t = Transaction.__table__
+    query = select([t.c.account_id, t.c.action, func.sum(t.c.amount),
+                    func.min(t.c.date)],
+                   and_(t.c.account_id.in_(
+                            select([Account.id],
+                                   membership.accounts_clause(user.id))),
+                        t.c.active == True,
+                        t.c.date >= since,
+                        t.c.action.in_([Transaction.DEPOSIT,
+                                        Transaction.WITHDRAWAL]))).\
+            group_by(t.c.account_id, t.c.action)
+    flows = {}
+    for account_id, action, amount, first in db.session.execute(query):
+        deposits, withdrawals, earliest = flows.get(account_id,
+                                                    (0, 0, None))
+        if earliest is None or (first is not None and first < earliest):
+            earliest = first
+        if action == Transaction.DEPOSIT:
+            deposits += amount or 0
+        else:
+            withdrawals += amount or 0
+        flows[account_id] = (deposits, withdrawals, earliest)
+    return flows
+
+def daily_rates(flows, today, history_days=default_history_days):
+    """Convert summed flows into an average net change (cents) per day."""
+    rates = {}
+    for account_id, (deposits, withdrawals, first) in flows.items():
+        days = history_days
+        if first is not None:
+            days = min(days, (today - first).days + 1)
+        rates[account_id] = float(deposits - withdrawals) / max(days, 1)
+    return rates
+
+def project_daily(totals, rates, start, days):
+    """Project balances (in cents) forward day by day.
+
+    Returns:
+    (dates, grid) where grid has a row per account, in the order of
+    totals, of its balance on each of the dates
+
+    """
+    dates = [start + datetime.timedelta(days=day)
+             for day in range(1, days + 1)]
+    grid = []
+    for id, total in totals:
+        rate = rates.get(id, 0)
+        grid.append([total + int(round(rate * day))
+                     for day in xrange(1, days + 1)])
+    return dates, grid
+
+def project(totals, rates, start, months):
+    """Project balances (in cents) forward at the end of each month,
+    read from the daily projection.
+
+    Returns:
+    List of (datetime.date, [balance, ...]) tuples in the order of totals
+
+    """
+    ends = [add_months(start, month) for month in range(1, months + 1)]
+    dates, grid = project_daily(totals, rates, start,
+                                (ends[-1] - start).days)
+    projection = []
+    for date in ends:
+        day = (date - start).days - 1
+        projection.append((date, [row[day] for row in grid]))
+    return projection
+
+def _current(user, today, history_days):
+    """The active accounts, their balances and their daily rates."""
+    if today is None:
+        today = datetime.date.today()
+    accounts = Account.query.filter(membership.accounts_clause(user.id)).\
+               filter(Account.active == True).order_by(Account.id).all()
+    since = today - datetime.timedelta(days=history_days)
+    rates = daily_rates(account_flows(user, since), today, history_days)
+    current = dict([(id, total) for id, name, active, total
+                    in balances.balances(user)[0]])
+    totals = [(a.id, current.get(a.id, 0)) for a in accounts]
+    return accounts, totals, rates, today
+
+def forecast(user, months=12, today=None, history_days=default_history_days):
+    """Forecast the balance of each of the user's active accounts.
+
+    Returns:
+    (accounts, projection) where projection is the list from project
+
+    """
+    if months < 1:
+        raise ParameterException('Must forecast at least one month')
+    accounts, totals, rates, today = _current(user, today, history_days)
+    return accounts, project(totals, rates, today, months)
+
+def daily_forecast(user, days=365, today=None,
+                   history_days=default_history_days):
+    """Forecast the balance of each of the user's active accounts on
+    every day.
+
+    Returns:
+    (accounts, dates, grid) as from project_daily
+
+    """
+    if days < 1:
+        raise ParameterException('Must forecast at least one day')
+    accounts, totals, rates, today = _current(user, today, history_days)
+    dates, grid = project_daily(totals, rates, today, days)
+    return accounts, dates, grid
@@ -0,0 +1,73 @@
+import sys
+from app import app, db
+
+try:
+    import gevent
+    import gevent.socket
+except ImportError:
+    gevent = None
+
+def async_enabled():
+    """Whether the process is serving with gevent (see gunicorn_async.py)."""
+    return gevent is not None and 'gevent.monkey' in sys.modules and \
+           gevent.monkey.is_module_patched('socket')
+
+def _wait(connection, timeout=None):
+    """psycopg2 wait callback that yields to other greenlets."""
+    import psycopg2.extensions
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            gevent.socket.wait_read(connection.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            gevent.socket.wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError('Bad result from poll: %r' %
+                                            state)
+
+def patch_psycopg():
+    """Make psycopg2 wait for the database without blocking the process.
+
+    psycopg2 is a C library that gevent cannot patch, so without this
+    every query blocks all the greenlets of the worker until it is done.
+
+    """
+    import psycopg2.extensions
+    psycopg2.extensions.set_wait_callback(_wait)
+
+def _call(function, args):
+    # A new application context gets its own database session, which
+    # is removed (and its connection returned) when the context ends
+    ctx = app.app_context()
+    ctx.push()
+    try:
+        return function(*args)
+    finally:
+        ctx.pop()
+
+def run_concurrently(*jobs):
+    """Run independent read-only queries at the same time.
+
+    Each job is run in a greenlet, with a database session of its own,
+    when serving with gevent, so nothing loaded by one job (or the
+    request) may be handed to another; pass IDs and return plain values
+    instead.  Otherwise the jobs run one after another in the request's
+    session: threads would each check out a connection, and a few
+    concurrent requests would use up the pool.
+
+    Keyword arguments:
+    jobs -- (function, args) tuples
+
+    Returns:
+    List of the return values of the jobs, in order
+
+    """
+    if async_enabled():
+        greenlets = [gevent.spawn(_call, function, args)
+                     for function, args in jobs]
+        gevent.joinall(greenlets, raise_error=True)
+        return [g.value for g in greenlets]
+
+    return [function(*args) for function, args in jobs]
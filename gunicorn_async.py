@@ -0,0 +1,21 @@
+# gunicorn settings for serving with gevent instead of sync workers:
+#
+#     gunicorn app:app -c gunicorn_async.py
+#
+# Needs gevent installed.  A worker then serves many requests at once
+# (including idle long-polling ones) and the queries behind a
+# dashboard run concurrently (see green.run_concurrently).
+import os
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 500))
+
+# Concurrent requests each hold a connection, so every worker needs a
+# bigger pool than a sync one (or pgbouncer, see DATABASE_PGBOUNCER)
+os.environ.setdefault('DATABASE_POOL_SIZE', '10')
+os.environ.setdefault('DATABASE_MAX_OVERFLOW', '10')
+
+def post_fork(server, worker):
+    import green
+    green.patch_psycopg()
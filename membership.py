@@ -0,0 +1,78 @@
+from flask import g, has_request_context
+from sqlalchemy import or_
+from sqlalchemy.sql.expression import select
+from app import db
+from models import Account, GroupMember, ParameterException, Transaction
+
+def memberships(user_id):
+    """Groups of a user, resolved once per request.
+
+    Returns:
+    Dictionary of group ID to (is_owner, can_share)
+
+    """
+    cache = None
+    if has_request_context():
+        cache = getattr(g, 'memberships', None)
+        if cache is None:
+            cache = g.memberships = {}
+        if user_id in cache:
+            return cache[user_id]
+    m = GroupMember.__table__
+    groups = dict([(group_id, (bool(is_owner), bool(can_share)))
+                   for group_id, is_owner, can_share in db.session.execute(
+                       select([m.c.group_id, m.c.is_owner, m.c.can_share],
+                              m.c.user_id == user_id))])
+    if cache is not None:
+        cache[user_id] = groups
+    return groups
+
+def forget(user_id=None):
+    """Drop the request's resolved memberships after they change."""
+    if has_request_context() and getattr(g, 'memberships', None):
+        if user_id is None:
+            g.memberships.clear()
+        else:
+            g.memberships.pop(user_id, None)
+
+def accounts_clause(user_id):
+    """Criteria for the accounts a user may see and use: their own and
+    those shared with any of their groups."""
+    groups = memberships(user_id).keys()
+    if not groups:
+        return Account._user == user_id
+    return or_(Account._user == user_id, Account._group.in_(groups))
+
+def transactions_clause(user_id):
+    """Criteria for the transactions a user may see: their own and those
+    on accounts shared with any of their groups."""
+    groups = memberships(user_id).keys()
+    if not groups:
+        return Transaction._user == user_id
+    a = Account.__table__
+    return or_(Transaction._user == user_id,
+               Transaction._account.in_(select([a.c.id],
+                                               a.c.group_id.in_(groups))))
+
+def can_use(user_id, account):
+    """Whether a user may see and transact on an account."""
+    return account._user == user_id or \
+           (account._group is not None and
+            account._group in memberships(user_id))
+
+def share(user, account, group):
+    """Share one of a user's accounts with the members of a group.
+
+    Keyword arguments:
+    user -- User sharing, who must own the account and be allowed to
+        share in the group
+    account -- Account to share
+    group -- Group to share it with, or None to stop sharing it
+
+    """
+    if account._user != user.id:
+        raise ParameterException('Only the owner can share an account')
+    if group is not None and \
+           not memberships(user.id).get(group.id, (False, False))[1]:
+        raise ParameterException('Not allowed to share with this group')
+    account.group = group
@@ -11,6 +11,7 @@ from sqlalchemy.ext.associationproxy import association_proxy
 from comparator import UpperComparator
 from datetime import datetime
 from app import db
+from cli import tracing
 
 class User(db.Model):
     """The user that is accessing the library."""
@@ -98,7 +99,10 @@ class GroupMember(db.Model):
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
     user = relationship('User', backref=backref('user_groups',
                                                   cascade="all, delete-orphan"))
-    group_id = Column(Integer, ForeignKey('groups.id'), primary_key=True)
+    # The primary key covers finding a user's groups, this index a
+    # group's members
+    group_id = Column(Integer, ForeignKey('groups.id'), primary_key=True,
+                      index=True)
     group = relationship('Group', backref=backref('group_members',
                                                   cascade="all, delete-orphan"))
     is_owner = Column(Boolean, default=True)
@@ -117,12 +121,15 @@ class Account(db.Model):
 
     id = Column(Integer, primary_key=True)
     _user = Column('user_id', Integer, ForeignKey('users.id'))
+    # Group whose members share the account, if any
+    _group = Column('group_id', Integer, ForeignKey('groups.id'), index=True)
     active = Column(Boolean, default=True)
     _total = Column('total', Integer, default=0)
     _name = Column('name', String, nullable=False)
     description = Column('description', String)
 
     user = relation('User', backref=backref('accounts', order_by=id))
+    group = relation('Group', backref=backref('accounts', order_by=id))
 
     def __init__(self, user, name=None, description=None, total=0):
         self.user = user
@@ -215,6 +222,32 @@ class SubDeposit(db.Model):
                  self.amount, delimiter, self.percentage_or_fixed, delimiter,
                  'Gross' if self.affect_gross else 'Net', delimiter, self.active))
 
+class Batch(db.Model):
+    """Transactions that a bulk request created.
+
+    It is no longer active once the batch has been rolled back.
+
+    """
+
+    __tablename__ = 'batches'
+
+    id = Column(Integer, primary_key=True)
+    _user = Column('user_id', Integer, ForeignKey('users.id'), index=True)
+    timestamp = Column(DateTime)
+    description = Column(String)
+    active = Column(Boolean, default=True)
+
+    user = relation('User')
+
+    def __init__(self, user, description=None):
+        self.user = user
+        self.description = description
+        self.timestamp = datetime.now()
+
+    def __repr__(self):
+        return '%s %s %s %s' % (self.__class__.__name__, self.id,
+                                self.description, self.active)
+
 class Transaction(db.Model):
     """Base class for all transactions."""
 
@@ -239,10 +272,13 @@ class Transaction(db.Model):
     tags = Column(String)
     _parent = Column('parent_id', Integer, ForeignKey('transactions.id'))
     _active = Column('active', Boolean, default=True)
+    # Request that made the transaction when it was made in bulk
+    _batch = Column('batch_id', Integer, ForeignKey('batches.id'), index=True)
     __mapper_args__ = {'polymorphic_on':action,
                        'polymorphic_identity':INFORMATIONAL}
 
     user = relation('User', backref=backref('transactions', order_by=id))
+    batch = relation('Batch')
     account = relation('Account', backref=backref('transactions', order_by=id))
     children = relation('Transaction', primaryjoin=_parent == id, cascade='all',
                         backref=backref('parent', remote_side=id),
@@ -261,19 +297,18 @@ class Transaction(db.Model):
         self.timestamp = datetime.now()
 
         if not duplicate_override:
-            duplicates = []
-            for t in db.session.query(Transaction).\
-                filter(or_(Transaction.parent != parent,
-                           Transaction.parent == None)).\
-                filter(Transaction.action != Transaction.TRANSFER).\
-                filter(Transaction.action != Transaction.DEDUCTION).\
-                filter(Transaction.action != Transaction.INFORMATIONAL).\
-                filter(Transaction.date == date).\
-                filter(Transaction.active).\
-                filter(Transaction.account == account).\
-                filter(Transaction.amount ==
-                       _format_db_amount(amount)).all():
-                duplicates.append(t)
+            with tracing.span('duplicate_check'):
+                duplicates = db.session.query(Transaction).\
+                    filter(or_(Transaction.parent != parent,
+                               Transaction.parent == None)).\
+                    filter(Transaction.action != Transaction.TRANSFER).\
+                    filter(Transaction.action != Transaction.DEDUCTION).\
+                    filter(Transaction.action != Transaction.INFORMATIONAL).\
+                    filter(Transaction.date == date).\
+                    filter(Transaction.active).\
+                    filter(Transaction.account == account).\
+                    filter(Transaction.amount ==
+                           _format_db_amount(amount)).all()
             if len(duplicates) > 0:
                 if len(duplicates) == 1:
                     error = 'Possible duplicate found'
@@ -314,9 +349,10 @@ class Transaction(db.Model):
         return self._active
     def _set_active(self, active):
         if active != self._active:
-            self._undo_action(active)
-            for t in self.children:
-                t._undo_action(active)
+            with tracing.span('balance_update', transaction=self.id):
+                self._undo_action(active)
+                for t in self.children:
+                    t._undo_action(active)
     active = synonym('_active', descriptor=property(_get_active, _set_active))
 
     def _undo_action(self, active):
@@ -483,92 +519,97 @@ class Deposit(Transaction):
         
         if account is not None:
             self.amount -= deduction_total
-            self.account.total += self.amount
+            with tracing.span('balance_update', account=self.account.id):
+                self.account.total += self.amount
         elif sub_deposits is None or len(sub_deposits) == 0:
             raise DepositException('Accounts are required.')
         else:
             self.deposits = []
             
-            # list of (Account, amount) tuples
-            deposits = []
-
-            # Calculate minimum deposit before embarking
-            minimum_deposit = deduction_total
-            for sd in sub_deposits:
-                # Fixed
-                if sd.percentage_or_fixed == SubDeposit.FIXED:
-                    minimum_deposit += sd.amount
-                # Percentage, gross
-                elif sd.affect_gross:
-                    minimum_deposit += self.amount * amount
+            with tracing.span('allocation', accounts=len(sub_deposits)):
+                # list of (Account, amount) tuples
+                deposits = []
+
+                # Calculate minimum deposit before embarking
+                minimum_deposit = deduction_total
+                for sd in sub_deposits:
+                    # Fixed
+                    if sd.percentage_or_fixed == SubDeposit.FIXED:
+                        minimum_deposit += sd.amount
+                    # Percentage, gross
+                    elif sd.affect_gross:
+                        minimum_deposit += self.amount * amount
             
-            if self.amount < minimum_deposit:
-                raise FundsException('Insufficient funds for whole account'
-                                     ' deposit.  (Minimum $%0.2f)' %
-                                     minimum_deposit)
+                if self.amount < minimum_deposit:
+                    raise FundsException('Insufficient funds for whole account'
+                                         ' deposit.  (Minimum $%0.2f)' %
+                                         minimum_deposit)
 
-            total = 0.00 # Verify that every cent is getting deposited!
-            gross = running_total = self.amount
+                total = 0.00 # Verify that every cent is getting deposited!
+                gross = running_total = self.amount
             
-            # Calculate gross deposits
-            for gsd in [sd for sd in sub_deposits
-                        if sd.percentage_or_fixed == SubDeposit.PERCENTAGE and
-                        sd.affect_gross]:
-                amount = gross * gsd.amount
-                if amount > 0:
-                    amount = round(amount, 2)
-                    total += amount
-                    running_total -= amount
-                    deposits.append((gsd.account, amount))
-
-            # Execute deductions
-            running_total -= deduction_total
-            total += deduction_total
-
-            # Calculate fixed deposits
-            for fsd in [sd for sd in sub_deposits
-                        if sd.percentage_or_fixed == SubDeposit.FIXED]:
-                if running_total > 0:
-                    if fsd.amount >= 0:
-                        running_total -= fsd.amount
-                        total += fsd.amount
-                        deposits.append((fsd.account, fsd.amount))
-                    else:
-                        raise DepositException('Invalid negative deposit')
-                else:
-                    raise FundsException('Insufficient funds available for '
-                                         'specified deposits')
-                
-            # Calculate net deposits
-            if running_total > 0:
-                net = running_total
-                for nsd in [sd for sd in sub_deposits
-                            if sd.percentage_or_fixed == SubDeposit.PERCENTAGE
-                            and not sd.affect_gross]:
-                    amount = net * nsd.amount
+                # Calculate gross deposits
+                for gsd in [sd for sd in sub_deposits
+                            if sd.percentage_or_fixed ==
+                            SubDeposit.PERCENTAGE and sd.affect_gross]:
+                    amount = gross * gsd.amount
                     if amount > 0:
                         amount = round(amount, 2)
                         total += amount
                         running_total -= amount
-                        deposits.append((nsd.account, amount))
-
-            # Sanity check on the deposit to ensure that everything is
-            # accounted for.  The difference SHOULD always be zero, but
-            # rounding is a beast (especially with percentages).
-            difference = gross - total
-            if difference != 0.00:
-                account, amount = deposits.pop()
-                amount += difference
-                deposits.append((account, amount))
+                        deposits.append((gsd.account, amount))
+
+                # Execute deductions
+                running_total -= deduction_total
+                total += deduction_total
+
+                # Calculate fixed deposits
+                for fsd in [sd for sd in sub_deposits
+                            if sd.percentage_or_fixed == SubDeposit.FIXED]:
+                    if running_total > 0:
+                        if fsd.amount >= 0:
+                            running_total -= fsd.amount
+                            total += fsd.amount
+                            deposits.append((fsd.account, fsd.amount))
+                        else:
+                            raise DepositException('Invalid negative deposit')
+                    else:
+                        raise FundsException('Insufficient funds available '
+                                             'for specified deposits')
+                
+                # Calculate net deposits
+                if running_total > 0:
+                    net = running_total
+                    for nsd in [sd for sd in sub_deposits
+                                if sd.percentage_or_fixed ==
+                                SubDeposit.PERCENTAGE and
+                                not sd.affect_gross]:
+                        amount = net * nsd.amount
+                        if amount > 0:
+                            amount = round(amount, 2)
+                            total += amount
+                            running_total -= amount
+                            deposits.append((nsd.account, amount))
+
+                # Sanity check on the deposit to ensure that everything is
+                # accounted for.  The difference SHOULD always be zero, but
+                # rounding is a beast (especially with percentages).
+                difference = gross - total
+                if difference != 0.00:
+                    account, amount = deposits.pop()
+                    amount += difference
+                    deposits.append((account, amount))
                 
-            # Execute the deposits
-            for account, amount in deposits:
-                deposit = Deposit(user=self.user, amount=amount, parent=self,
-                                  date=self.date, account=account, 
-                                  description=self.description,
-                                  duplicate_override=duplicate_override)
-                db.session.add(deposit)
-                self.deposits.append(deposit)
+            with tracing.span('fan_out', children=len(deposits)):
+                # Execute the deposits
+                for account, amount in deposits:
+                    deposit = Deposit(user=self.user, amount=amount,
+                                      parent=self, date=self.date,
+                                      account=account,
+                                      description=self.description,
+                                      duplicate_override=duplicate_override)
+                    db.session.add(deposit)
+                    self.deposits.append(deposit)
 
 class Withdrawal(Transaction):
     """Subtract from the total of an Account."""
@@ -594,7 +635,8 @@ class Withdrawal(Transaction):
         Transaction.__init__(self, user=user, amount=amount, account=account,
                              description=description, parent=parent, date=date,
                              duplicate_override=duplicate_override)
-        self.account.total -= self.amount
+        with tracing.span('balance_update', account=self.account.id):
+            self.account.total -= self.amount
 
 def _format_db_amount(amount):
     return int(round(float(amount) * 100)) if amount is not None else 0
@@ -0,0 +1,125 @@
+import datetime
+from flask import jsonify, request, abort
+from sqlalchemy import desc
+from app import app
+from models import User, Transaction, ParameterException, _format_out_amount
+import analytics
+import balances
+import forecast
+import green
+import membership
+
+def _date_arg(name):
+    """Parse an optional YYYY-MM-DD query string argument."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+@app.route('/users/<int:user_id>/balances')
+def user_balances(user_id):
+    """Balance of each of the user's accounts and their total."""
+    user = User.query.get_or_404(user_id)
+    accounts, total = balances.balances(
+        user, active_only=request.args.get('active', 0, type=int) == 1)
+    return jsonify(accounts=[{'id': id, 'name': name, 'active': active,
+                              'balance': _format_out_amount(balance)}
+                             for id, name, active, balance in accounts],
+                   total=_format_out_amount(total))
+
+def _balances_json(user_id):
+    accounts, total = balances.balances(User.query.get(user_id))
+    return {'accounts': [{'id': id, 'name': name, 'active': active,
+                          'balance': _format_out_amount(balance)}
+                         for id, name, active, balance in accounts],
+            'total': _format_out_amount(total)}
+
+def _recent_json(user_id, limit):
+    return [{'id': t.id, 'date': t.date.isoformat(), 'action': t.action,
+             'amount': t.amount, 'account_id': t._account,
+             'description': t.description}
+            for t in Transaction.query.\
+                filter(membership.transactions_clause(user_id)).\
+                filter(Transaction._parent == None).\
+                filter(Transaction._active == True).\
+                order_by(desc(Transaction.date), desc(Transaction.id)).\
+                limit(limit)]
+
+def _forecast_json(user_id, months):
+    accounts, projection = forecast.forecast(User.query.get(user_id),
+                                             months=months)
+    return [{'date': date.isoformat(),
+             'total': _format_out_amount(sum(balances))}
+            for date, balances in projection]
+
+@app.route('/users/<int:user_id>/dashboard')
+def user_dashboard(user_id):
+    """Balances, recent transactions and forecast totals at once.
+
+    The three are independent, so they are queried concurrently (see
+    green.run_concurrently).
+
+    """
+    User.query.get_or_404(user_id)
+    months = request.args.get('months', 6, type=int)
+    if months < 1:
+        abort(400)
+    summary, recent, projection = green.run_concurrently(
+        (_balances_json, (user_id,)),
+        (_recent_json, (user_id, request.args.get('recent', 10, type=int))),
+        (_forecast_json, (user_id, months)))
+    return jsonify(balances=summary, recent=recent, forecast=projection)
+
+@app.route('/users/<int:user_id>/forecast')
+def user_forecast(user_id):
+    """Month-end balance forecast for each of the user's accounts."""
+    user = User.query.get_or_404(user_id)
+    try:
+        accounts, projection = forecast.forecast(
+            user, months=request.args.get('months', 12, type=int))
+    except ParameterException:
+        abort(400)
+    return jsonify(accounts=[{'id': a.id, 'name': a.name} for a in accounts],
+                   forecast=[{'date': date.isoformat(),
+                              'balances': [_format_out_amount(b)
+                                           for b in balances],
+                              'total': _format_out_amount(sum(balances))}
+                             for date, balances in projection])
+
+@app.route('/users/<int:user_id>/forecast/daily')
+def user_daily_forecast(user_id):
+    """Daily balance forecast for each of the user's accounts."""
+    user = User.query.get_or_404(user_id)
+    try:
+        accounts, dates, grid = forecast.daily_forecast(
+            user, days=request.args.get('days', 90, type=int))
+    except ParameterException:
+        abort(400)
+    return jsonify(dates=[date.isoformat() for date in dates],
+                   accounts=[{'id': a.id, 'name': a.name,
+                              'balances': [_format_out_amount(b)
+                                           for b in row]}
+                             for a, row in zip(accounts, grid)])
+
+@app.route('/users/<int:user_id>/spending')
+def user_spending(user_id):
+    """Monthly spending of each account with rolling average and percentiles.
+    """
+    user = User.query.get_or_404(user_id)
+    try:
+        months, summary = analytics.spending_summary(
+            user, _date_arg('start'), _date_arg('end'),
+            request.args.get('window', 3, type=int))
+    except ParameterException:
+        abort(400)
+    return jsonify(months=months,
+                   accounts=[{'id': a.id, 'name': a.name,
+                              'spent': [_format_out_amount(s) for s in spent],
+                              'rolling': [_format_out_amount(r)
+                                          for r in rolling],
+                              'median': _format_out_amount(median),
+                              'percentile_90': _format_out_amount(high)}
+                             for a, spent, rolling, median, high in summary])